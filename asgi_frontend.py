@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Production front end for the FAIryTale image server.
+
+`python local_ai_server.py` (SERVER_MODE=serve) runs the Flask app behind
+uvicorn through this ASGI layer instead of the Werkzeug dev server:
+
+- Request bodies are received on the event loop (spooled to disk past 1 MB,
+  bounded by MAX_UPLOAD_MB and REQUEST_TIMEOUT) before a handler thread is
+  used, so a slow upload over the tunnel doesn't hold a thread.
+- Job long-polls (/jobs/<id>?wait=N) and SSE streams (/jobs/<id>/events)
+  are answered on the event loop and woken by the JobManager, so idle
+  readers cost no threads at all.
+- Everything else runs on SERVER_THREADS handler threads. Past
+  MAX_PENDING_REQUESTS waiting requests new ones get 503 with Retry-After,
+  and uvicorn refuses connections beyond MAX_CONNECTIONS.
+- On SIGTERM/Ctrl+C new generation requests are refused, event streams end
+  and running jobs get DRAIN_SECONDS to finish before the process exits.
+
+Denoising itself stays on the worker pool's batcher threads.
+"""
+
+import asyncio
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import metrics
+from jobs import parse_wait
+
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '16'))
+# Requests waiting for a handler thread before new ones are refused
+MAX_PENDING_REQUESTS = int(os.getenv('MAX_PENDING_REQUESTS', '64'))
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', '1000'))
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', '20'))
+# Seconds allowed to receive a whole request body
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '60'))
+DRAIN_SECONDS = float(os.getenv('DRAIN_SECONDS', '60'))
+# Request bodies bigger than this are spooled to a temp file
+SPOOL_BYTES = 1024 * 1024
+# Files (images) are handed to the event loop in blocks this big
+FILE_BLOCK_BYTES = 256 * 1024
+
+_JOB_PATH = re.compile(r'/jobs/([0-9a-f]{32})(/events)?')
+
+
+class JobWatcher:
+    """Wakes asyncio waiters when the JobManager reports a job change"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        # job id -> events of the coroutines waiting on it
+        self.waiters = {}
+
+    def notify(self, job):
+        """JobManager listener; runs on worker threads"""
+        self.loop.call_soon_threadsafe(self._wake, job.id)
+
+    def _wake(self, job_id):
+        for event in self.waiters.get(job_id, ()):
+            event.set()
+
+    def wake_all(self):
+        for events in self.waiters.values():
+            for event in events:
+                event.set()
+
+    async def wait(self, job, version, timeout, event=None):
+        """Wait until the job changes past `version`, `event` is set or timeout passes"""
+        event = event or asyncio.Event()
+        if job.version != version or job.done or event.is_set():
+            return job.version
+        self.waiters.setdefault(job.id, set()).add(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            events = self.waiters.get(job.id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self.waiters[job.id]
+        return job.version
+
+
+class _FileWrapper:
+    """wsgi.file_wrapper with large blocks, so send_file needs few thread hops per image"""
+
+    def __init__(self, file, block_size=8192):
+        self.file = file
+        self.block_size = max(block_size, FILE_BLOCK_BYTES)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(self.block_size)
+        if not data:
+            raise StopIteration()
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class FrontEnd:
+    """ASGI application: event-loop job streams in front of the Flask app on a bounded thread pool"""
+
+    def __init__(self, wsgi_app, job_manager, on_startup=None, threads=SERVER_THREADS,
+                 max_pending=MAX_PENDING_REQUESTS, max_upload_bytes=MAX_UPLOAD_MB * 1024 * 1024,
+                 request_timeout=REQUEST_TIMEOUT, drain_seconds=DRAIN_SECONDS):
+        self.wsgi_app = wsgi_app
+        # job_manager() -> the JobManager once it exists (never blocks on model loading), else None
+        self.job_manager = job_manager
+        self.on_startup = on_startup
+        self.threads = threads
+        self.max_pending = max_pending
+        self.max_upload_bytes = max_upload_bytes
+        self.request_timeout = request_timeout
+        self.drain_seconds = drain_seconds
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self.loop = None
+        self.watcher = None
+        self.watched_manager = None
+        # Requests handed to (or waiting for) a handler thread
+        self.in_flight = 0
+        self.rejected = 0
+        self.draining = False
+        self.drain_deadline = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        match = _JOB_PATH.fullmatch(scope['path'])
+        manager = self._manager()
+        if match and scope['method'] == 'GET' and manager is not None:
+            job = manager.get(match.group(1))
+            if job is not None:
+                if match.group(2):
+                    await self._job_events(manager, job, receive, send)
+                else:
+                    await self._job_status(manager, job, scope, send)
+                return
+        await self._call_wsgi(scope, receive, send)
+
+    def _manager(self):
+        manager = self.job_manager()
+        if manager is not None and manager is not self.watched_manager and self.watcher is not None:
+            manager.add_listener(self.watcher.notify)
+            self.watched_manager = manager
+        return manager
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.loop = asyncio.get_running_loop()
+                self.watcher = JobWatcher(self.loop)
+                if self.on_startup is not None:
+                    self.on_startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.begin_drain()
+                await self._drain_jobs()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def begin_drain(self):
+        """Stop taking generation requests and end event streams; safe to call from a signal handler"""
+        if self.draining:
+            return
+        self.draining = True
+        self.drain_deadline = time.time() + self.drain_seconds
+        print(f"[server] Draining: refusing new generations, waiting up to {self.drain_seconds:.0f}s for running ones")
+        if self.loop is not None and self.watcher is not None:
+            self.loop.call_soon_threadsafe(self.watcher.wake_all)
+
+    async def _drain_jobs(self):
+        manager = self.job_manager()
+        if manager is None:
+            return
+        while time.time() < self.drain_deadline:
+            counts = manager.status()
+            if not counts.get('queued', 0) and not counts.get('running', 0):
+                print("[server] All jobs finished")
+                return
+            await asyncio.sleep(0.5)
+        cancelled = manager.cancel_all()
+        print(f"[server] Drain timed out, cancelled {cancelled} job(s)")
+
+    async def _job_status(self, manager, job, scope, send):
+        """Event-loop version of GET /jobs/<id>: ?wait=N long-polls without a thread"""
+        start = time.perf_counter()
+        args = parse_qs(scope['query_string'].decode('latin-1'))
+        wait = parse_wait(args.get('wait', ['0'])[0])
+        if wait is None:
+            await _send_json(send, 400, {'error': 'wait must be a number of seconds'})
+            _count('/jobs/<job_id>', 400, start)
+            return
+        if wait > 0 and not job.done and not self.draining:
+            await self.watcher.wait(job, job.version, wait)
+        data = manager.snapshot(job)
+        if args.get('trace', [''])[0] == '1' and job.request.trace is not None:
+            data['trace'] = job.request.trace.to_dict()
+        await _send_json(send, 200, data)
+        _count('/jobs/<job_id>', 200, start)
+
+    async def _job_events(self, manager, job, receive, send):
+        """Event-loop version of GET /jobs/<id>/events (Server-Sent Events)"""
+        start = time.perf_counter()
+        wake = asyncio.Event()
+        disconnected = asyncio.Event()
+        watch = asyncio.ensure_future(_watch_disconnect(receive, disconnected, wake))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]})
+        try:
+            last_sent = None
+            last_write = time.time()
+            version = job.version
+            while not disconnected.is_set():
+                snapshot = manager.snapshot(job)
+                if snapshot != last_sent:
+                    event = 'progress' if snapshot['status'] == 'running' else snapshot['status']
+                    chunk = f"event: {event}\ndata: {json.dumps(snapshot)}\n\n"
+                    last_sent = snapshot
+                    last_write = time.time()
+                elif time.time() - last_write >= 15:
+                    chunk = ": keep-alive\n\n"
+                    last_write = time.time()
+                else:
+                    chunk = None
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+                if snapshot['status'] in ('completed', 'failed', 'cancelled') or self.draining:
+                    break
+                wake.clear()
+                # Queue position moves without the job itself changing, so re-check while queued
+                version = await self.watcher.wait(job, version, 1 if job.status == 'queued' else 15, wake)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watch.cancel()
+            _count('/jobs/<job_id>/events', 200, start)
+
+    async def _call_wsgi(self, scope, receive, send):
+        """Receive the body on the loop, then run the Flask app on a handler thread"""
+        if self.draining and scope['method'] == 'POST':
+            await _send_json(send, 503, {'error': 'Image server is shutting down'}, retry_after=30)
+            return
+        body, error = await self._receive_body(scope, receive)
+        if error is None and self.in_flight >= self.threads + self.max_pending:
+            self.rejected += 1
+            error = (503, {'error': 'Image server is overloaded'}, 1)
+        if error is not None:
+            if error:
+                await _send_json(send, *error)
+            body.close()
+            return
+
+        loop = asyncio.get_running_loop()
+        environ = self._environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+            return lambda data: None
+
+        def run():
+            result = self.wsgi_app(environ, start_response)
+            iterator = iter(result)
+            return result, iterator, next(iterator, None)
+
+        self.in_flight += 1
+        try:
+            result, iterator, chunk = await loop.run_in_executor(self.executor, run)
+        finally:
+            self.in_flight -= 1
+        disconnected = asyncio.Event()
+        watch = asyncio.ensure_future(_watch_disconnect(receive, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in started['headers']]})
+            # Streamed responses (NDJSON stories, images) are pulled a chunk at a time
+            while chunk is not None and not disconnected.is_set():
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watch.cancel()
+            if hasattr(result, 'close'):
+                # Runs the generators' cleanup, e.g. cancelling a story's unfinished panels
+                await loop.run_in_executor(self.executor, result.close)
+            body.close()
+
+    async def _receive_body(self, scope, receive):
+        """(spooled body, None), or (body, (status, payload)) / (body, ()) when it can't be used"""
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        length = _header(scope, b'content-length')
+        if length and length.isdigit() and int(length) > self.max_upload_bytes:
+            return body, (413, {'error': f'Request body over {self.max_upload_bytes // (1024 * 1024)} MB'})
+
+        async def read():
+            size = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return ()
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if size > self.max_upload_bytes:
+                    return 413, {'error': f'Request body over {self.max_upload_bytes // (1024 * 1024)} MB'}
+                body.write(chunk)
+                if not message.get('more_body'):
+                    return None
+
+        try:
+            error = await asyncio.wait_for(read(), self.request_timeout)
+        except asyncio.TimeoutError:
+            error = (408, {'error': 'Request body not received in time'})
+        body.seek(0)
+        return body, error
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        size = body.seek(0, os.SEEK_END)
+        body.seek(0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(size),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': _Errors(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': _FileWrapper,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def status(self):
+        return {
+            'threads': self.threads,
+            'in_flight': self.in_flight,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected,
+            'draining': self.draining,
+        }
+
+
+class _Errors:
+    """wsgi.errors that goes to the console like the rest of the server's logging"""
+
+    def write(self, text):
+        print(text, end='')
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def _watch_disconnect(receive, disconnected, wake=None):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            if wake is not None:
+                wake.set()
+            return
+
+
+async def _send_json(send, status, payload, retry_after=None):
+    body = json.dumps(payload).encode('utf-8')
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    if retry_after is not None:
+        headers.append((b'retry-after', str(retry_after).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _count(endpoint, status, start):
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method='GET', status=status)
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+
+
+def serve(frontend, host, port, max_connections=MAX_CONNECTIONS):
+    """Run the front end under uvicorn until SIGINT/SIGTERM, then drain"""
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        def handle_exit(self, sig, frame):
+            # Before uvicorn stops accepting, so open streams end instead of running out the clock
+            frontend.begin_drain()
+            super().handle_exit(sig, frame)
+
+    config = uvicorn.Config(frontend, host=host, port=port, lifespan='on', log_level='info',
+                            limit_concurrency=max_connections,
+                            timeout_graceful_shutdown=int(frontend.drain_seconds))
+    DrainingServer(config).run()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Micro-batching in front of the resident StoryEngine.
+
+Requests that arrive within a short window and share the same batch key
+(steps, scale, LoRA style, with/without reference) are rendered together in
+one batched denoising call, then each image is handed back to its caller.
+Requests in the LoRA style of the previous batch are preferred for a short
+while so mixed-genre traffic doesn't switch adapters on every batch.
+
+The queue is ordered by priority class (interactive, prefetch, batch) and then
+by deadline (queued time + latency target). A more urgent request stops a
+running lower-priority batch between steps, and that batch is queued again.
+When the measured time per step says queued requests would miss their
+targets, the next batch runs with fewer steps, down to the requests' floor.
+"""
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from generation import PRIORITIES, GenerationCancelled, GenerationPreempted
+
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '4'))
+BATCH_MAX_WAIT_MS = int(os.getenv('BATCH_MAX_WAIT_MS', '50'))
+# How long the oldest request may be passed over for one in the engine's current LoRA style
+STYLE_AFFINITY_MS = int(os.getenv('STYLE_AFFINITY_MS', '2000'))
+# A more urgent request preempts a running batch until it is this far through its steps (0 = never)
+PREEMPT_BEFORE = float(os.getenv('PREEMPT_BEFORE', '0.5'))
+# Weight of the latest batch in the moving averages of step time and per-batch overhead
+TIMING_SMOOTHING = 0.3
+
+
+class QueueFull(Exception):
+    """Raised when a request is refused because too many images are already queued"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Image queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Pending:
+    """A queued request together with the future its caller is waiting on"""
+
+    def __init__(self, request):
+        self.request = request
+        self.key = request.batch_key()
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        target = request.latency_target
+        self.deadline = self.enqueued_at + target if target else None
+        # Times dispatched; more than one after preemption, when the future is already running
+        self.runs = 0
+
+    def urgency(self):
+        """Sort key: priority class, then earliest deadline, then arrival"""
+        deadline = self.deadline if self.deadline is not None else float('inf')
+        return (self.request.rank, deadline, self.enqueued_at)
+
+
+class MicroBatcher:
+    """Collects concurrent requests into compatible groups for engine.generate_batch"""
+
+    def __init__(self, engine, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+                 name='micro-batcher', on_start=None, style_affinity_ms=STYLE_AFFINITY_MS,
+                 preempt_before=PREEMPT_BEFORE):
+        self.engine = engine
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.style_affinity = style_affinity_ms / 1000.0
+        # LoRA style of the last batch; requests in that style go first to avoid adapter switches
+        self.last_style = None
+        self.pending = []
+        self.cond = threading.Condition()
+        self.batches = 0
+        self.images = 0
+        self.largest_batch = 0
+        # Images currently being denoised and time spent denoising, for load estimates
+        self.running = 0
+        self.busy_seconds = 0.0
+        # The running batch, its most urgent priority class and how far through its steps it is
+        self.running_items = []
+        self.running_rank = None
+        self.progress = 0.0
+        self.preempt_before = preempt_before
+        self.preemptions = 0
+        self.degraded_batches = 0
+        self.missed_targets = 0
+        # Measured seconds per denoising step by batch size, and per-batch time outside the steps
+        self.step_seconds = {}
+        self.overhead_seconds = None
+        # Called once on the batcher thread before it starts serving (e.g. per-thread torch settings)
+        self.on_start = on_start
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, request):
+        """Queue a GenerationRequest and return a Future resolving to its PIL image"""
+        item = _Pending(request)
+        with self.cond:
+            self.pending.append(item)
+            self._maybe_preempt(request)
+            self.cond.notify()
+        return item.future
+
+    def escalate(self, request, priority, latency_target):
+        """Make a queued or running request at least as urgent as another caller that now waits
+        on it: the more urgent priority class and the earlier deadline. False if it isn't here"""
+        with self.cond:
+            running = any(item.request is request for item in self.running_items)
+            item = next((p for p in self.pending if p.request is request), None)
+            if item is None and not running:
+                return False
+            if PRIORITIES.index(priority) < request.rank:
+                request.priority = priority
+            if item is not None:
+                if latency_target:
+                    deadline = time.monotonic() + latency_target
+                    if item.deadline is None or deadline < item.deadline:
+                        item.deadline = deadline
+                self._maybe_preempt(request)
+                self.cond.notify()
+            else:
+                self.running_rank = min(self.running_rank, request.rank)
+            return True
+
+    def _maybe_preempt(self, request):
+        """Stop the running batch at its next step if it is less urgent than `request` and not
+        yet far enough along that finishing it is cheaper"""
+        if self.running_rank is None or request.rank >= self.running_rank:
+            return
+        if self.progress >= self.preempt_before:
+            return
+        for item in self.running_items:
+            item.request.preempt()
+
+    def load(self):
+        """Images queued or in progress on this batcher"""
+        with self.cond:
+            return len(self.pending) + self.running
+
+    def queued(self):
+        with self.cond:
+            return len(self.pending)
+
+    def has_pending_key(self, key):
+        """Whether a request with this batch key is waiting, so a new one could join its batch"""
+        with self.cond:
+            return any(item.key == key for item in self.pending)
+
+    def avg_batch_seconds(self):
+        return self.busy_seconds / self.batches if self.batches else None
+
+    def position(self, request):
+        """0-based place of a request in the queue, or None once it has left the queue"""
+        with self.cond:
+            for i, item in enumerate(sorted(self.pending, key=_Pending.urgency)):
+                if item.request is request:
+                    return i
+        return None
+
+    def _anchor(self):
+        """Request whose batch key goes next: the most urgent, unless one of its priority class
+        in the current style can go first without making it wait longer than style_affinity"""
+        queue = sorted(self.pending, key=_Pending.urgency)
+        first = queue[0]
+        if time.monotonic() - first.enqueued_at < self.style_affinity:
+            for item in queue:
+                if item.request.rank != first.request.rank:
+                    break
+                if item.request.style_lora == self.last_style:
+                    return item
+        return first
+
+    def _next_batch(self):
+        """Block until a group is full or its oldest request has waited max_wait"""
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            anchor = self._anchor()
+            deadline = anchor.enqueued_at + self.max_wait
+            while True:
+                group = [p for p in sorted(self.pending, key=_Pending.urgency)
+                         if p.key == anchor.key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(group) >= self.max_batch_size or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            for item in group:
+                self.pending.remove(item)
+            self.last_style = anchor.request.style_lora
+            try:
+                steps = self._plan_steps(group)
+            except Exception as e:
+                # The group is already out of the queue; run it as asked rather than lose it
+                print(f"[batcher] Could not plan steps, running as requested: {e!r}")
+                steps = group[0].request.requested_steps
+            for item in group:
+                item.request.steps = steps
+            requested = anchor.request.requested_steps
+            if steps < requested:
+                self.degraded_batches += 1
+                metrics.SCHEDULER_EVENTS.inc(event='degraded')
+                print(f"[batcher] Running {len(group)} image(s) at {steps}/{requested} steps "
+                      f"to meet latency targets ({len(self.pending)} queued)")
+            return group
+
+    def _plan_steps(self, group):
+        """Steps for the next batch: as asked, or fewer (not below the requests' floor) when the
+        measured step time says it or the requests queued behind it would miss their deadlines"""
+        requested = group[0].request.requested_steps
+        floor = min(requested, max(item.request.min_steps for item in group))
+        step_seconds = self._estimate_step_seconds(len(group))
+        if floor >= requested or step_seconds is None:
+            return requested
+        now = time.monotonic()
+        overhead = self.overhead_seconds or 0.0
+        steps = requested
+        # Assume every batch until a request's own runs at the planned step count
+        queue = group + sorted(self.pending, key=_Pending.urgency)
+        for i, item in enumerate(queue):
+            if item.deadline is None:
+                continue
+            batches = 1 if i < len(group) else 2 + (i - len(group)) // self.max_batch_size
+            share = item.request.strength if item.request.continues else 1.0
+            fits = ((item.deadline - now) / batches - overhead) / (step_seconds * share)
+            if math.isfinite(fits):
+                steps = min(steps, int(fits))
+        return max(floor, steps)
+
+    def _estimate_step_seconds(self, batch_size):
+        """Seconds per step for a batch of this size, None before anything was measured"""
+        if not self.step_seconds:
+            return None
+        if batch_size in self.step_seconds:
+            return self.step_seconds[batch_size]
+        # Closest measured size; scaling up linearly overestimates, which errs towards fewer steps
+        nearest = min(self.step_seconds, key=lambda size: abs(size - batch_size))
+        return self.step_seconds[nearest] * max(1.0, batch_size / nearest)
+
+    def _record_timing(self, batch_size, seconds, step_times):
+        """Update the step time and overhead averages from one batch's step callbacks"""
+        if len(step_times) < 2:
+            return
+        (first_at, first_step), (last_at, last_step) = step_times[0], step_times[-1]
+        if last_step <= first_step:
+            return
+        per_step = (last_at - first_at) / (last_step - first_step)
+        overhead = max(0.0, seconds - per_step * last_step)
+        previous = self.step_seconds.get(batch_size)
+        self.step_seconds[batch_size] = per_step if previous is None else (
+            previous + TIMING_SMOOTHING * (per_step - previous))
+        self.overhead_seconds = overhead if self.overhead_seconds is None else (
+            self.overhead_seconds + TIMING_SMOOTHING * (overhead - self.overhead_seconds))
+
+    def _claim(self, item):
+        """Mark a dispatched request running; False if its caller gave up before it started"""
+        item.runs += 1
+        if item.runs > 1:
+            # Preempted earlier, so the future is already running
+            if item.request.cancelled:
+                item.future.set_exception(GenerationCancelled())
+                return False
+            return True
+        if item.request.cancelled:
+            item.future.cancel()
+        return item.future.set_running_or_notify_cancel()
+
+    def _run(self):
+        if self.on_start is not None:
+            self.on_start()
+        while True:
+            group = []
+            try:
+                group = self._next_batch()
+                self._serve(group)
+            except Exception as e:
+                # Whatever went wrong, this thread is the worker's only one: fail the batch's
+                # requests and keep serving the queue
+                print(f"[batcher] Unexpected error serving a batch of {len(group)}: {e!r}")
+                for item in group:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    def _serve(self, group):
+        """Run one batch from _next_batch and resolve its futures"""
+        # Callers that gave up before we started don't get a slot in the batch
+        live = [p for p in group if self._claim(p)]
+        if not live:
+            return
+
+        with self.cond:
+            self.running = len(live)
+            self.running_items = live
+            self.running_rank = min(p.request.rank for p in live)
+            self.progress = 0.0
+        started = time.monotonic()
+        for item in live:
+            if item.runs == 1:
+                metrics.observe('queue_wait', started - item.enqueued_at, [item.request.trace])
+        metrics.BATCH_SIZE.observe(len(live))
+
+        # Time the steps through the first request's progress callback
+        first = live[0].request
+        report = first.on_step
+        step_times = []
+
+        def on_step(step, total):
+            step_times.append((time.monotonic(), step))
+            with self.cond:
+                self.progress = step / total
+            if report is not None:
+                report(step, total)
+
+        first.on_step = on_step
+        try:
+            images = self.engine.generate_batch([p.request for p in live])
+        except GenerationPreempted:
+            self._requeue(live)
+            return
+        except GenerationCancelled as e:
+            # Every caller gave up mid-way; not a failure
+            print(f"[batcher] Batch of {len(live)} cancelled")
+            for item in live:
+                item.future.set_exception(e)
+            return
+        except Exception as e:
+            print(f"[batcher] Batch of {len(live)} failed: {e}")
+            for item in live:
+                item.future.set_exception(e)
+            return
+        finally:
+            first.on_step = report
+            with self.cond:
+                self.running = 0
+                self.running_items = []
+                self.running_rank = None
+
+        finished = time.monotonic()
+        self._record_timing(len(live), finished - started, step_times)
+        missed = sum(1 for p in live if p.deadline is not None and finished > p.deadline)
+        if missed:
+            self.missed_targets += missed
+            metrics.SCHEDULER_EVENTS.inc(missed, event='missed_target')
+        self.busy_seconds += finished - started
+        self.batches += 1
+        self.images += len(live)
+        self.largest_batch = max(self.largest_batch, len(live))
+        for item, image in zip(live, images):
+            item.future.set_result(image)
+
+    def _requeue(self, items):
+        """Put a preempted batch back in the queue, keeping its requests' deadlines"""
+        self.preemptions += 1
+        metrics.SCHEDULER_EVENTS.inc(event='preempted')
+        print(f"[batcher] Preempted a batch of {len(items)} for more urgent work")
+        with self.cond:
+            for item in items:
+                item.request.preempt_event.clear()
+                self.pending.append(item)
+            self.cond.notify()
+        for item in items:
+            if item.request.on_requeue is not None:
+                item.request.on_requeue()
+
+    def status(self):
+        """Queue and batch-size statistics for /health"""
+        with self.cond:
+            queued = len(self.pending)
+            running = self.running
+            by_priority = {}
+            for item in self.pending:
+                by_priority[item.request.priority] = by_priority.get(item.request.priority, 0) + 1
+        avg_seconds = self.avg_batch_seconds()
+        return {
+            'queued': queued,
+            'running': running,
+            'avg_batch_seconds': round(avg_seconds, 3) if avg_seconds is not None else None,
+            'batches': self.batches,
+            'images': self.images,
+            'avg_batch_size': round(self.images / self.batches, 2) if self.batches else 0,
+            'largest_batch': self.largest_batch,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': int(self.max_wait * 1000),
+            'queued_by_priority': by_priority,
+            'step_seconds': {size: round(seconds, 4) for size, seconds in sorted(self.step_seconds.items())},
+            'overhead_seconds': round(self.overhead_seconds, 3) if self.overhead_seconds is not None else None,
+            'preemptions': self.preemptions,
+            'degraded_batches': self.degraded_batches,
+            'missed_targets': self.missed_targets,
+        }
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+CPU seconds-per-image benchmark for the generation engine (story_engine.py).
+
+Loads a StoryEngine on the CPU once per execution profile, runs an untimed
+warmup (which is also when torch.compile compiles) and then times --images
+generations, so profiles can be compared before adding CPU workers.
+
+A profile is a '+'-joined list of settings on top of the CPU_* environment:
+  fp32 / bf16 / auto    dtype (auto = bf16 when the CPU has native bf16)
+  cl / nocl             channels_last on or off
+  slice / noslice       attention slicing on or off
+  compile / nocompile   torch.compile the UNet
+  ddim / dpm / unipc    scheduler
+  steps=N               cap denoising steps at N
+"baseline" is fp32+nocl+noslice+nocompile+ddim, "env" the environment as is.
+
+Examples:
+  python benchmark_cpu.py --model ./tiny-sd --images 4
+  python benchmark_cpu.py --profiles baseline,bf16,bf16+dpm+steps=15 --steps 25
+  python benchmark_cpu.py --profiles env,compile --threads 8 --output cpu.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+SCENES = [
+    "walks into an enchanted forest at dawn",
+    "finds a glowing map inside an old tree",
+    "crosses a rope bridge over a misty canyon",
+    "meets a talking fox by the river",
+]
+
+BASELINE = 'fp32+nocl+noslice+nocompile+ddim'
+TOKENS = {
+    'fp32': ('dtype', 'float32'),
+    'bf16': ('dtype', 'bfloat16'),
+    'auto': ('dtype', 'auto'),
+    'cl': ('channels_last', True),
+    'nocl': ('channels_last', False),
+    'slice': ('attention_slicing', True),
+    'noslice': ('attention_slicing', False),
+    'compile': ('compile', True),
+    'nocompile': ('compile', False),
+    'ddim': ('scheduler', 'ddim'),
+    'dpm': ('scheduler', 'dpm'),
+    'unipc': ('scheduler', 'unipc'),
+}
+
+
+def parse_profile(spec):
+    """'bf16+dpm+steps=15' -> overrides for story_engine.cpu_profile()"""
+    overrides = {}
+    for token in (BASELINE if spec == 'baseline' else spec).split('+'):
+        token = token.strip()
+        if not token or token == 'env':
+            continue
+        if token.startswith('steps='):
+            overrides['max_steps'] = int(token.split('=', 1)[1])
+        elif token in TOKENS:
+            key, value = TOKENS[token]
+            overrides[key] = value
+        else:
+            raise SystemExit(f"Unknown profile setting '{token}' in '{spec}'")
+    return overrides
+
+
+def run_profile(spec, args):
+    """Load an engine with the profile, warm it up and time --images generations"""
+    import torch
+    from generation import GenerationRequest
+    from story_engine import StoryEngine, cpu_profile
+
+    engine = StoryEngine(args.work_dir, device='cpu', num_threads=args.threads,
+                         profile=cpu_profile(**parse_profile(spec)))
+    engine.bind_thread()
+    load_start = time.perf_counter()
+    engine.load()
+    load_s = time.perf_counter() - load_start
+
+    def batch(index, steps):
+        return [GenerationRequest(f"Pip, {SCENES[(index + i) % len(SCENES)]}", seed=index + i, steps=steps,
+                                  style_lora=None)
+                for i in range(args.batch_size)]
+
+    warmup_start = time.perf_counter()
+    for i in range(args.warmup):
+        engine.generate_batch(batch(i, args.steps))
+    warmup_s = time.perf_counter() - warmup_start
+
+    timings = []
+    for i in range(0, args.images, args.batch_size):
+        start = time.perf_counter()
+        engine.generate_batch(batch(i, args.steps))
+        timings.append(time.perf_counter() - start)
+    images = len(timings) * args.batch_size
+    result = {
+        'profile': spec,
+        'settings': engine.profile,
+        'dtype': str(engine.dtype).replace('torch.', ''),
+        'compiled': engine.compiled,
+        'steps': engine.steps_for(args.steps),
+        'threads': torch.get_num_threads(),
+        'load_s': round(load_s, 2),
+        'warmup_s': round(warmup_s, 2),
+        'images': images,
+        'seconds_per_image': round(sum(timings) / images, 3),
+        'fastest_batch_s': round(min(timings), 3),
+        'peak_memory_mb': engine.max_peak_mb,
+        'memory_mode': engine.memory_mode,
+    }
+    del engine
+    gc.collect()
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', help="model path or id (SD_MODEL_ID)")
+    parser.add_argument('--profiles', default='baseline,env', help="comma-separated profiles, see above")
+    parser.add_argument('--images', type=int, default=4, help="timed images per profile")
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=25, help="requested denoising steps")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed batches per profile")
+    parser.add_argument('--threads', type=int, help="torch threads (default: all cores)")
+    parser.add_argument('--work-dir', default='.', help="directory holding loras/ (default: here)")
+    parser.add_argument('--output', default='benchmark_cpu.json')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.model:
+        os.environ['SD_MODEL_ID'] = args.model
+    os.environ.setdefault('WARMUP_STEPS', '0')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import torch
+
+    results = []
+    for spec in [p.strip() for p in args.profiles.split(',') if p.strip()]:
+        print(f"[bench] Profile {spec}")
+        result = run_profile(spec, args)
+        print(f"[bench] {spec}: {result['seconds_per_image']}s/image "
+              f"({result['dtype']}, {result['steps']} steps, {result['threads']} threads)")
+        results.append(result)
+
+    report = {
+        'created_at': time.time(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'cpu_capability': torch.backends.cpu.get_cpu_capability(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"[bench] Wrote {args.output}")
+    baseline = results[0]['seconds_per_image']
+    for result in results:
+        speedup = baseline / result['seconds_per_image'] if result['seconds_per_image'] else 0.0
+        print(f"  {result['profile']:<32} {result['seconds_per_image']:>8.3f} s/image  {speedup:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
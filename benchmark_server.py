@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the FAIryTale image server (local_ai_server.py).
+
+Starts the server in-process on a free port (or targets a running one with
+--url), drives /generate and the /jobs API at each requested concurrency and
+writes throughput, latency percentiles, queue wait and memory as JSON, so
+runs can be compared with --compare to catch regressions.
+
+Backends for the in-process server:
+  fake  deterministic stub with FAKE_STEP_LATENCY_MS per step, no torch needed
+  tiny  the real StoryEngine on the CPU with a small model (--model)
+
+Examples:
+  python benchmark_server.py --backend fake --concurrency 1,4,8 --requests 32
+  python benchmark_server.py --backend tiny --model ./tiny-sd --requests 8
+  python benchmark_server.py --url http://localhost:5001 --endpoints jobs
+  python benchmark_server.py --backend fake --output new.json --compare baseline.json
+"""
+
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+SCENES = [
+    "walks into an enchanted forest at dawn",
+    "finds a glowing map inside an old tree",
+    "crosses a rope bridge over a misty canyon",
+    "meets a talking fox by the river",
+    "discovers a hidden castle in the clouds",
+    "sails a tiny boat across a silver lake",
+]
+
+
+def percentiles(values):
+    """p50/p95/p99/mean/max in milliseconds of a list of seconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'p50': round(pick(0.50) * 1000, 1),
+        'p95': round(pick(0.95) * 1000, 1),
+        'p99': round(pick(0.99) * 1000, 1),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 1),
+        'max': round(ordered[-1] * 1000, 1),
+    }
+
+
+def memory_usage():
+    """Resident memory of this process (which hosts the server in-process mode)"""
+    usage = {'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    usage['rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        usage['cuda_peak_allocated_mb'] = round(torch.cuda.max_memory_allocated() / 2 ** 20, 1)
+    return usage
+
+
+class Client:
+    """Minimal form-posting HTTP client (stdlib only, so it runs anywhere)"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, form=None):
+        data = urllib.parse.urlencode(form).encode('utf-8') if form is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read() or b'null')
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            try:
+                return e.code, json.loads(body)
+            except ValueError:
+                return e.code, {'error': body.decode('utf-8', 'replace')}
+
+
+def reference_data_url():
+    """Small PNG character reference as a data URL, like the web client sends"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 120, 40)).save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def make_form(index, args, reference):
+    """Distinct scene per request so the result cache and dedup don't short-circuit the run"""
+    scene = SCENES[index % len(SCENES)]
+    form = {
+        'description': scene if args.repeat_prompts else f"{scene}, moment {index}",
+        'character_name': 'Pip',
+        'genre': args.genre,
+    }
+    if reference:
+        form['character_image'] = reference
+    return form
+
+
+def run_generate(client, form):
+    """One blocking /generate call; returns (status, latency seconds, job id)"""
+    start = time.perf_counter()
+    status, body = client.request('POST', '/generate', form)
+    latency = time.perf_counter() - start
+    return status, latency, (body or {}).get('job_id')
+
+
+def run_job(client, form):
+    """Submit to /jobs and long-poll until finished; returns (status, latency seconds, job id)"""
+    start = time.perf_counter()
+    status, body = client.request('POST', '/jobs', form)
+    if status != 202:
+        return status, time.perf_counter() - start, None
+    job_id = body['job_id']
+    while True:
+        status, body = client.request('GET', f"/jobs/{job_id}?wait=30")
+        if status != 200 or body['status'] in ('completed', 'failed', 'cancelled'):
+            break
+    latency = time.perf_counter() - start
+    ok = status == 200 and body['status'] == 'completed'
+    return (200 if ok else 500), latency, job_id
+
+
+def queue_wait(client, job_id):
+    """Seconds from submission until the job's first denoising step finished"""
+    status, body = client.request('GET', f"/jobs/{job_id}")
+    if status != 200 or not body.get('started_at') or body.get('cached'):
+        return None
+    return body['started_at'] - body['created_at']
+
+
+def run_level(client, endpoint, concurrency, total, args, reference, offset):
+    """Fire `total` requests with `concurrency` in flight and summarize them"""
+    call = run_generate if endpoint == 'generate' else run_job
+    results = []
+    lock = threading.Lock()
+
+    def one(i):
+        status, latency, job_id = call(client, make_form(offset + i, args, reference))
+        with lock:
+            results.append((status, latency, job_id))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    duration = time.perf_counter() - start
+
+    ok = [r for r in results if r[0] in (200, 202)]
+    waits = [w for w in (queue_wait(client, job_id) for _, _, job_id in ok if job_id) if w is not None]
+    return {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': total,
+        'completed': len(ok),
+        'rejected': sum(1 for r in results if r[0] == 429),
+        'failed': sum(1 for r in results if r[0] not in (200, 202, 429)),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(ok) / duration, 3) if duration else 0.0,
+        'latency_ms': percentiles([r[1] for r in ok]),
+        'queue_wait_ms': percentiles(waits),
+    }
+
+
+def configure_backend(args):
+    """Environment for the in-process server; must run before local_ai_server is imported"""
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='fairytale-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    os.environ['FAIRYTALE_WORK_DIR'] = work_dir
+    os.environ['GENERATION_MODE'] = 'engine'
+    os.environ['RESULT_CACHE'] = '1' if args.result_cache else '0'
+    if args.workers:
+        os.environ['WORKER_DEVICES'] = args.workers
+    os.environ.setdefault('WORKER_DEVICES', 'cpu')
+    if args.backend == 'fake':
+        os.environ['ENGINE_BACKEND'] = 'fake'
+        os.environ['FAKE_STEP_LATENCY_MS'] = str(args.step_latency_ms)
+    else:
+        os.environ['ENGINE_BACKEND'] = 'diffusers'
+        os.environ['SD_MODEL_ID'] = args.model
+        os.environ.setdefault('SD_DEVICE', 'cpu')
+        # A scratch work dir has no loras/ folder
+        os.environ.setdefault('STYLE_LORA', 'none')
+    return work_dir
+
+
+def start_in_process_server():
+    """Load the pool, then serve the Flask app on a free local port in a thread"""
+    from werkzeug.serving import make_server
+    import local_ai_server
+
+    # One access-log line per poll would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    local_ai_server.get_pool()
+    startup = time.perf_counter() - start
+    server = make_server('127.0.0.1', 0, local_ai_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server, startup
+
+
+def wait_until_ready(client, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            status, _ = client.request('GET', '/health')
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(1)
+    return False
+
+
+def compare(results, baseline_path, tolerance):
+    """Regressions against a previous results file: throughput down or p95 up by more than tolerance"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(run['endpoint'], run['concurrency']): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        old = previous.get((run['endpoint'], run['concurrency']))
+        if old is None or not run['latency_ms'] or not old['latency_ms']:
+            continue
+        label = f"{run['endpoint']} @ {run['concurrency']}"
+        if run['throughput_rps'] < old['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {old['throughput_rps']} -> {run['throughput_rps']} req/s")
+        if run['latency_ms']['p95'] > old['latency_ms']['p95'] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {old['latency_ms']['p95']} -> {run['latency_ms']['p95']} ms")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the FAIryTale image server")
+    parser.add_argument('--backend', choices=['fake', 'tiny'], default='fake',
+                        help="engine for the in-process server (ignored with --url)")
+    parser.add_argument('--model', default='tiny-sd', help="model path or id for --backend tiny")
+    parser.add_argument('--url', help="benchmark an already running server instead")
+    parser.add_argument('--endpoints', default='generate,jobs', help="comma-separated: generate, jobs")
+    parser.add_argument('--concurrency', default='1,4,8', help="comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=16, help="requests per endpoint and level")
+    parser.add_argument('--warmup', type=int, default=2, help="untimed requests before measuring")
+    parser.add_argument('--step-latency-ms', type=float, default=20.0, help="fake backend time per step")
+    parser.add_argument('--workers', help="WORKER_DEVICES for the in-process server (default: cpu)")
+    parser.add_argument('--genre', default='fantasy')
+    parser.add_argument('--reference', action='store_true', help="send a character reference image")
+    parser.add_argument('--repeat-prompts', action='store_true',
+                        help="reuse the same few scenes (exercises dedup and the result cache)")
+    parser.add_argument('--result-cache', action='store_true', help="leave the result cache enabled")
+    parser.add_argument('--work-dir', help="server working directory (default: a fresh temp dir)")
+    parser.add_argument('--timeout', type=float, default=600, help="per-request HTTP timeout")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="previous results JSON to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="allowed relative slowdown")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    startup = None
+    if args.url:
+        base_url = args.url
+        client = Client(base_url, args.timeout)
+        if not wait_until_ready(client, 600):
+            print(f"Server at {base_url} never became ready")
+            return 1
+    else:
+        work_dir = configure_backend(args)
+        print(f"Starting in-process server ({args.backend} backend) in {work_dir}")
+        base_url, _, startup = start_in_process_server()
+        client = Client(base_url, args.timeout)
+
+    reference = reference_data_url() if args.reference else None
+    endpoints = [e.strip() for e in args.endpoints.split(',') if e.strip()]
+    levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+
+    offset = 0
+    if args.warmup:
+        run_level(client, endpoints[0], 1, args.warmup, args, reference, offset)
+        offset += args.warmup
+
+    runs = []
+    for endpoint in endpoints:
+        for concurrency in levels:
+            run = run_level(client, endpoint, concurrency, args.requests, args, reference, offset)
+            offset += args.requests
+            runs.append(run)
+            latency = run['latency_ms'] or {}
+            print(f"{endpoint:>8} x{concurrency:<3} {run['throughput_rps']:>8.2f} req/s  "
+                  f"p50 {latency.get('p50')} ms  p95 {latency.get('p95')} ms  p99 {latency.get('p99')} ms  "
+                  f"ok {run['completed']}/{run['requests']}  rejected {run['rejected']}")
+
+    _, health = client.request('GET', '/health')
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'target': args.url or f"in-process ({args.backend})",
+            'model': args.model if args.backend == 'tiny' and not args.url else None,
+            'step_latency_ms': args.step_latency_ms if args.backend == 'fake' and not args.url else None,
+            'workers': os.getenv('WORKER_DEVICES') if not args.url else None,
+            'requests_per_level': args.requests,
+            'reference': args.reference,
+            'repeat_prompts': args.repeat_prompts,
+            'result_cache': args.result_cache,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'startup_s': round(startup, 2) if startup is not None else None,
+        'runs': runs,
+        # Only meaningful in-process, where the server shares this process
+        'memory': memory_usage() if not args.url else None,
+        'server': {
+            'pool': (health or {}).get('pool'),
+            'jobs': (health or {}).get('jobs'),
+            'result_cache': (health or {}).get('result_cache'),
+        },
+    }
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions against {baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
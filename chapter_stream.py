@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Incremental reading of the chapter JSON the language model streams.
+
+ollama.ts asks the model for {"sceneDescription": ..., "content": ...,
+"choices": ...}. /chapter feeds the tokens to a JsonFieldScanner as they
+arrive, so the illustration can be queued the moment the sceneDescription
+string is closed instead of after the whole chapter has been written.
+
+Standard library only.
+"""
+
+import json
+import re
+
+
+class JsonFieldScanner:
+    """Fed the text of a streamed JSON object in chunks, returns the top-level string fields
+    named in `fields` as soon as each one's closing quote arrives
+
+    Text before the first '{' (models like to chat first) is skipped, nested objects and
+    arrays are stepped over, and scanning stops when the top-level object is closed.
+    """
+
+    def __init__(self, fields):
+        self.fields = set(fields)
+        self.found = {}
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.raw = []
+        self.expect_key = False
+        self.key = None
+        self.closed = False
+
+    def feed(self, chunk):
+        """Scan a chunk; [(field, value)] for the watched fields completed in it"""
+        completed = []
+        for char in chunk:
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        field = self._string_done()
+                        if field is not None:
+                            completed.append(field)
+                    continue
+                if self.depth == 1:
+                    self.raw.append(char)
+            elif char == '"':
+                self.in_string = self.depth > 0
+                self.raw = []
+            elif char in '{[':
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_key = char == '{'
+                    self.closed = char != '{'
+            elif char in '}]' and self.depth:
+                self.depth -= 1
+                self.closed = self.depth == 0
+            elif self.depth == 1 and char == ':':
+                self.expect_key = False
+            elif self.depth == 1 and char == ',':
+                self.expect_key = True
+        return completed
+
+    def _string_done(self):
+        try:
+            value = json.loads('"' + ''.join(self.raw) + '"')
+        except ValueError:
+            value = ''.join(self.raw)
+        if self.expect_key:
+            self.key = value
+            return None
+        if self.key in self.fields and self.key not in self.found:
+            self.found[self.key] = value
+            return self.key, value
+        return None
+
+
+def parse_chapter(text):
+    """The chapter object in the model's answer (the outermost {...}), or None"""
+    match = re.search(r'\{[\s\S]*\}', text)
+    if not match:
+        return None
+    try:
+        chapter = json.loads(match.group(0))
+    except ValueError:
+        return None
+    return chapter if isinstance(chapter, dict) else None
+
+
+def first_sentence(text, limit=100):
+    """Opening sentence of a chapter, for a scene when the model wrote none"""
+    sentences = [s for s in re.split(r'[.!?]+', text) if s.strip()]
+    sentence = sentences[0] if sentences else text
+    return re.sub(r'[^\w\s]', ' ', sentence.lower()[:limit]).strip()
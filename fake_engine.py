@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in for StoryEngine, for benchmarks and CI machines.
+
+ENGINE_BACKEND=fake makes the worker pool build these instead of loading
+Stable Diffusion. A batch sleeps FAKE_STEP_LATENCY_MS per denoising step
+(plus a fraction of that for every extra image in the batch, so batching
+behaves like it does on a GPU), reports progress through the same step
+callbacks, honours cancellation and preemption and returns an image derived
+from the prompt and seed. Nothing here needs torch or diffusers.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+import metrics
+from generation import PREVIEW_SIZE, GenerationCancelled, GenerationPreempted, continuation_steps, preview_step
+
+FAKE_STEP_LATENCY_MS = float(os.getenv('FAKE_STEP_LATENCY_MS', '20'))
+# Extra step time per additional image in a batch, as a fraction of FAKE_STEP_LATENCY_MS
+FAKE_BATCH_ITEM_COST = float(os.getenv('FAKE_BATCH_ITEM_COST', '0.25'))
+FAKE_IMAGE_SIZE = int(os.getenv('FAKE_IMAGE_SIZE', '512'))
+# Time to "encode" a character reference the first time it is seen
+FAKE_REFERENCE_LATENCY_MS = float(os.getenv('FAKE_REFERENCE_LATENCY_MS', '50'))
+
+
+class _FakeEmbeddingCache:
+    """Just enough of EmbeddingCache for /references"""
+
+    def __init__(self):
+        self.keys = set()
+
+    def contains(self, key):
+        return key in self.keys
+
+
+class FakeEngine:
+    """Same interface as StoryEngine, with sleeps instead of a UNet"""
+
+    def __init__(self, work_dir, device='cpu', num_threads=None, step_latency_ms=FAKE_STEP_LATENCY_MS):
+        self.work_dir = work_dir
+        self.device = device
+        self.num_threads = num_threads
+        self.model_id = 'fake'
+        self.step_latency = step_latency_ms / 1000.0
+        self.reference_embeds = _FakeEmbeddingCache()
+        self.batches = 0
+        self.images = 0
+        self.startup = {}
+        # story id -> output_key of its latest panel, like StoryEngine's latent cache
+        self.story_latents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        return self
+
+    def warmup(self):
+        return self
+
+    def bind_thread(self):
+        pass
+
+    def generate_batch(self, requests):
+        first = requests[0]
+        if any(r.batch_key() != first.batch_key() for r in requests):
+            raise ValueError("generate_batch needs requests with the same batch_key")
+
+        step_time = self.step_latency * (1 + FAKE_BATCH_ITEM_COST * (len(requests) - 1))
+        traces = [r.trace for r in requests]
+        with self.lock:
+            if first.reference is not None:
+                with metrics.span('ip_adapter_encode', traces):
+                    for r in requests:
+                        self._encode(r.reference_key or r.reference)
+            steps = continuation_steps(first.steps, first.strength) if first.continues else first.steps
+            with metrics.span('denoise', traces, batch_size=len(requests), steps=steps):
+                for step in range(steps):
+                    time.sleep(step_time)
+                    if step + 1 == preview_step(steps) and step + 1 < steps:
+                        for r in requests:
+                            if r.on_preview is not None:
+                                r.on_preview(self._render(r).resize((PREVIEW_SIZE // 4, PREVIEW_SIZE // 4))
+                                             .resize((PREVIEW_SIZE, PREVIEW_SIZE)))
+                    for r in requests:
+                        if r.on_step is not None:
+                            r.on_step(step + 1, steps)
+                    if all(r.cancelled for r in requests):
+                        raise GenerationCancelled()
+                    if any(r.preempted for r in requests):
+                        raise GenerationPreempted()
+            for r in requests:
+                if r.story_id and r.publish_key:
+                    self.story_latents[r.story_id] = r.publish_key
+                    self.story_latents.move_to_end(r.story_id)
+            self.batches += 1
+            self.images += len(requests)
+            with metrics.span('vae_decode', traces, batch_size=len(requests)):
+                return [self._render(r) for r in requests]
+
+    def encode_reference(self, reference, reference_key=None):
+        with self.lock:
+            self._encode(reference_key or reference)
+
+    def has_reference(self, reference_key):
+        return self.reference_embeds.contains(reference_key)
+
+    def has_story(self, story_id):
+        return story_id is not None and story_id in self.story_latents
+
+    def _encode(self, key):
+        if key not in self.reference_embeds.keys:
+            time.sleep(FAKE_REFERENCE_LATENCY_MS / 1000.0)
+            self.reference_embeds.keys.add(key)
+
+    @staticmethod
+    def _render(request):
+        """Colour bands derived from prompt and seed, so equal inputs give equal images"""
+        parts = f"{request.seed}|{request.style_lora}|{request.prompt}"
+        if request.continues:
+            parts += f"|{request.init_key}|{request.strength}"
+        digest = hashlib.sha256(parts.encode('utf-8')).digest()
+        image = Image.new('RGB', (FAKE_IMAGE_SIZE, FAKE_IMAGE_SIZE), tuple(digest[:3]))
+        draw = ImageDraw.Draw(image)
+        band = FAKE_IMAGE_SIZE // 8
+        for i in range(8):
+            draw.rectangle([0, i * band, FAKE_IMAGE_SIZE, i * band + band // 2], fill=tuple(digest[3 + i * 3:6 + i * 3]))
+        return image
+
+    def status(self):
+        return {
+            'loaded': True,
+            'backend': 'fake',
+            'device': self.device,
+            'model': self.model_id,
+            'step_latency_ms': self.step_latency * 1000.0,
+            'batches': self.batches,
+            'images': self.images,
+        }
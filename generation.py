@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Generation requests shared by every engine backend.
+
+Kept free of torch/diffusers so the server, job tracking and the fake
+benchmark backend can be imported on machines without the ML stack.
+"""
+
+import os
+import threading
+
+from style_registry import STYLE_LORA
+
+# Share of the denoising steps after which a request with on_preview gets a rough image
+PREVIEW_AT = float(os.getenv('PREVIEW_AT', '0.3'))
+# Longest side of preview images
+PREVIEW_SIZE = int(os.getenv('PREVIEW_SIZE', '256'))
+
+# Priority classes, most urgent first: chapter images a reader is waiting for, then
+# pictures fetched ahead of the reader, then offline work
+PRIORITIES = ('interactive', 'prefetch', 'batch')
+# Seconds from queueing to a finished image each class aims for (0 = no target)
+LATENCY_TARGETS = {
+    'interactive': float(os.getenv('LATENCY_TARGET_INTERACTIVE', '90')),
+    'prefetch': float(os.getenv('LATENCY_TARGET_PREFETCH', '300')),
+    'batch': float(os.getenv('LATENCY_TARGET_BATCH', '0')),
+}
+# Fewest denoising steps the scheduler may cut a request down to when it would miss its target
+MIN_STEPS = int(os.getenv('MIN_STEPS', '15'))
+
+
+def preview_step(total_steps):
+    """1-based step after which the preview is made"""
+    return max(1, int(total_steps * PREVIEW_AT))
+
+
+def continuation_steps(steps, strength):
+    """Denoising steps img2img actually runs at `strength`, as diffusers computes them"""
+    return min(int(steps * strength), steps)
+
+
+def build_story_prompts(story, character):
+    """Split a story into per-scene prompts the same way app.py does"""
+    return [f"{character}, {line.strip()}" for line in story.split(",")]
+
+
+class GenerationCancelled(Exception):
+    """Raised from the step callback when every request in a batch was cancelled"""
+
+
+class GenerationPreempted(GenerationCancelled):
+    """Raised from the step callback when the batch gave way to more urgent work; its requests
+    are queued again"""
+
+
+class GenerationRequest:
+    """Parameters for one image; requests with equal batch_key() can share a denoising call"""
+
+    def __init__(self, prompt, reference=None, seed=1234, steps=25, scale=7.5, style_lora=STYLE_LORA,
+                 on_step=None, reference_key=None, trace=None, story_id=None, output_key=None,
+                 init_image=None, init_key=None, strength=None, on_preview=None, priority='interactive',
+                 latency_target=None, min_steps=MIN_STEPS):
+        self.prompt = prompt
+        self.reference = reference
+        # sha256 of the reference image bytes, if the caller already knows it
+        self.reference_key = reference_key
+        self.seed = seed
+        self.steps = steps
+        # Steps asked for; the scheduler may lower `steps` (not below min_steps) to meet the target
+        self.requested_steps = steps
+        self.min_steps = min_steps
+        self.scale = scale
+        self.style_lora = style_lora
+        # Called as on_step(step, total_steps) after every denoising step
+        self.on_step = on_step
+        # Called as on_preview(image) once, part way through denoising
+        self.on_preview = on_preview
+        # metrics.Trace collecting this request's stage timings
+        self.trace = trace
+        # Continuation: start from the story's previous panel (init_image, published as init_key)
+        # instead of pure noise, re-noised to `strength` so only that share of the steps run
+        self.story_id = story_id
+        self.init_image = init_image
+        self.init_key = init_key
+        self.strength = strength
+        # Name this image will be published under, so the next panel can continue from it
+        self.output_key = output_key
+        # Name used instead when the scheduler cut the steps, for output_keys that promise the
+        # full step count (result cache entries)
+        self.degraded_output_key = None
+        # Peak memory (MB) of the batch this request ran in, set by the engine
+        self.peak_memory_mb = None
+        self.priority = priority if priority in PRIORITIES else 'interactive'
+        # Seconds from queueing to done this request aims for; None uses its class's, 0 = none
+        self.latency_target = LATENCY_TARGETS[self.priority] if latency_target is None else latency_target
+        # Called when a preempted request goes back into the queue
+        self.on_requeue = None
+        self.cancel_event = threading.Event()
+        self.preempt_event = threading.Event()
+
+    @property
+    def continues(self):
+        return self.init_image is not None and bool(self.strength)
+
+    @property
+    def rank(self):
+        """Priority class as a number, 0 most urgent"""
+        return PRIORITIES.index(self.priority)
+
+    @property
+    def degraded(self):
+        """Rendered with fewer steps than asked for"""
+        return self.steps < self.requested_steps
+
+    @property
+    def publish_key(self):
+        """Name the finished image is published under"""
+        if self.degraded and self.degraded_output_key:
+            return self.degraded_output_key
+        return self.output_key
+
+    def batch_key(self):
+        return (self.steps, self.scale, self.style_lora, self.reference is not None,
+                self.strength if self.continues else None)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def preempt(self):
+        self.preempt_event.set()
+
+    @property
+    def preempted(self):
+        return self.preempt_event.is_set()
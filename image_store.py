@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Served image store for the FAIryTale image server.
+
+Generated PNGs are the canonical copy. Smaller WebP variants (full size,
+medium and thumbnail) are encoded in a background thread pool so they never
+add to generation latency, and /images picks the best variant for the client
+and answers with strong ETags and long-lived immutable caching.
+
+The store also owns retention. An on-disk index records every image's size
+(variants included), last use and story, so a background compaction pass
+can keep the directory under IMAGE_STORE_MAX_MB / IMAGE_STORE_MAX_FILES and
+drop images unused for IMAGE_MAX_AGE_DAYS without listing it. Images made
+or served within STORY_RETENTION_HOURS, and every image of a story that was
+active in that window, are never evicted.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import metrics
+
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', '2'))
+IMAGE_STORE_MAX_MB = int(os.getenv('IMAGE_STORE_MAX_MB', '2048'))
+IMAGE_STORE_MAX_FILES = int(os.getenv('IMAGE_STORE_MAX_FILES', '5000'))
+# 0 keeps images until the size or file budget needs the space
+IMAGE_MAX_AGE_DAYS = float(os.getenv('IMAGE_MAX_AGE_DAYS', '30'))
+STORY_RETENTION_HOURS = float(os.getenv('STORY_RETENTION_HOURS', '72'))
+IMAGE_COMPACTION_SECONDS = int(os.getenv('IMAGE_COMPACTION_SECONDS', '300'))
+# Leftovers of older server versions and crashed app.py runs in the scratch output directory
+SCRATCH_LEFTOVER = re.compile(r'(character_ref_|reference_)\w+\.png|[0-9a-f]{32}')
+SCRATCH_MAX_AGE_HOURS = 24
+
+# name -> (longest side in px or None for full size, WebP quality)
+VARIANTS = {
+    'full': (None, 85),
+    'medium': (256, 80),
+    'thumb': (128, 70),
+}
+
+
+class ImageStore:
+    """Writes generated images and their WebP variants, resolves what to serve and
+    keeps the directory within its retention budget"""
+
+    def __init__(self, root, workers=IMAGE_VARIANT_WORKERS, index_path=None,
+                 max_bytes=IMAGE_STORE_MAX_MB * 1024 * 1024, max_files=IMAGE_STORE_MAX_FILES,
+                 max_age=IMAGE_MAX_AGE_DAYS * 86400, retention=STORY_RETENTION_HOURS * 3600,
+                 scratch_dir=None, on_evict=None):
+        self.root = os.path.abspath(root)
+        self.variant_dir = os.path.join(self.root, 'variants')
+        os.makedirs(self.variant_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-variants')
+        # path -> (mtime_ns, size, etag); files are immutable once written
+        self.etags = {}
+        self.lock = threading.Lock()
+
+        self.index_path = index_path or os.path.join(self.root, 'index.json')
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+        self.retention = retention
+        self.scratch_dir = scratch_dir
+        # on_evict(filename) lets the result cache forget images retention removed
+        self.on_evict = on_evict
+        # filename -> {'size', 'created', 'last_used', 'story'}, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # story id -> last time one of its images was made or served
+        self.stories = {}
+        self.evictions = 0
+        self.compactions = 0
+        self.dirty = False
+        self.wake = threading.Event()
+        self._load_index()
+
+    def path_for(self, filename):
+        return os.path.join(self.root, filename)
+
+    def variant_path(self, filename, variant):
+        stem = os.path.splitext(filename)[0]
+        return os.path.join(self.variant_dir, f"{stem}.{variant}.webp")
+
+    def save(self, image, filename, story=None):
+        """Write the canonical PNG now and queue its variants; returns the PNG path"""
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        data = buffer.getvalue()
+        path = self.path_for(filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._remember_etag(path, hashlib.sha256(data).hexdigest())
+        self._track(filename, len(data), story)
+        self.executor.submit(self._encode_variants, filename, image.copy())
+        return path
+
+    def add_existing(self, filename, story=None):
+        """Queue variants for a PNG that was written by someone else (e.g. app.py)"""
+        self._track(filename, os.path.getsize(self.path_for(filename)), story)
+        self.executor.submit(self._encode_variants, filename, None)
+
+    def _encode_variants(self, filename, image):
+        start = time.perf_counter()
+        written = 0
+        try:
+            if image is None:
+                image = Image.open(self.path_for(filename))
+                image.load()
+            image = image.convert('RGB')
+            for variant, (max_side, quality) in VARIANTS.items():
+                encoded = image
+                if max_side and max(image.size) > max_side:
+                    encoded = image.copy()
+                    encoded.thumbnail((max_side, max_side), Image.LANCZOS)
+                buffer = io.BytesIO()
+                encoded.save(buffer, format='WEBP', quality=quality, method=4)
+                data = buffer.getvalue()
+                path = self.variant_path(filename, variant)
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                # Only appears once complete, so readers never see a partial file
+                os.replace(tmp_path, path)
+                self._remember_etag(path, hashlib.sha256(data).hexdigest())
+                written += len(data)
+            metrics.observe('webp_variants', time.perf_counter() - start)
+        except Exception as e:
+            print(f"[image-store] Encoding variants of {filename} failed: {e}")
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None:
+                entry['size'] += written
+                self.total_bytes += written
+                self.dirty = True
+            over_budget = self._over_budget()
+        if over_budget:
+            self.wake.set()
+
+    def remove(self, filename):
+        """Delete an image and all of its variants"""
+        paths = [self.path_for(filename)] + [self.variant_path(filename, v) for v in VARIANTS]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            with self.lock:
+                self.etags.pop(path, None)
+        with self.lock:
+            if filename in self.entries:
+                self._drop(filename)
+
+    def touch(self, filename, story=None):
+        """Mark an image (and its story) as in use, e.g. a result cache hit"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return
+            entry['last_used'] = now
+            self.entries.move_to_end(filename)
+            story = story or entry.get('story')
+            if story:
+                entry['story'] = entry.get('story') or story
+                self.stories[story] = now
+            self.dirty = True
+
+    def latest_for_story(self, story):
+        """Filename of the most recently made image of a story, or None"""
+        with self.lock:
+            latest = max(((entry['created'], filename) for filename, entry in self.entries.items()
+                          if entry.get('story') == story), default=None)
+        return latest[1] if latest else None
+
+    def _track(self, filename, size, story):
+        now = time.time()
+        with self.lock:
+            if filename in self.entries:
+                self._drop(filename)
+            self.entries[filename] = {'size': size, 'created': now, 'last_used': now, 'story': story}
+            self.total_bytes += size
+            if story:
+                self.stories[story] = now
+            self.dirty = True
+            over_budget = self._over_budget()
+        if over_budget:
+            # Evict in the compaction thread, never on the request path
+            self.wake.set()
+
+    def _drop(self, filename):
+        entry = self.entries.pop(filename)
+        self.total_bytes -= entry['size']
+        self.dirty = True
+
+    def _over_budget(self):
+        return self.total_bytes > self.max_bytes or len(self.entries) > self.max_files
+
+    def start_compaction(self, interval=IMAGE_COMPACTION_SECONDS):
+        """Run compact() every `interval` seconds, and sooner when a save goes over budget"""
+        def loop():
+            while True:
+                self.wake.wait(interval)
+                self.wake.clear()
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"[image-store] Compaction failed: {e}")
+
+        threading.Thread(target=loop, name='image-compaction', daemon=True).start()
+        return self
+
+    def compact(self):
+        """Evict expired and least recently used images outside the retention window,
+        clear scratch leftovers and persist the index"""
+        now = time.time()
+        protect_after = now - self.retention
+        expire_before = now - self.max_age if self.max_age else None
+        evicted = []
+        with self.lock:
+            for story, last_active in list(self.stories.items()):
+                if last_active <= protect_after:
+                    del self.stories[story]
+
+            def protected(entry):
+                return entry['last_used'] > protect_after or entry.get('story') in self.stories
+
+            for filename, entry in list(self.entries.items()):
+                expired = expire_before is not None and entry['last_used'] < expire_before
+                if not expired and not self._over_budget():
+                    # Least recently used first, so nothing further on is expired either
+                    break
+                if not protected(entry):
+                    self._drop(filename)
+                    evicted.append(filename)
+            still_over = self._over_budget()
+            self.evictions += len(evicted)
+            self.compactions += 1
+
+        for filename in evicted:
+            self.remove(filename)
+            if self.on_evict is not None:
+                self.on_evict(filename)
+        if evicted:
+            print(f"[image-store] Evicted {len(evicted)} image(s) to stay within the retention budget")
+        if still_over:
+            print("[image-store] Still over budget: the remaining images belong to recent stories")
+        self._sweep_scratch(now)
+        self._save_index()
+
+    def _sweep_scratch(self, now):
+        """Remove server leftovers (old reference temp files, abandoned app.py run directories)"""
+        if not self.scratch_dir or not os.path.isdir(self.scratch_dir):
+            return
+        for item in os.scandir(self.scratch_dir):
+            if not SCRATCH_LEFTOVER.fullmatch(item.name):
+                continue
+            if now - item.stat().st_mtime < SCRATCH_MAX_AGE_HOURS * 3600:
+                continue
+            if item.is_dir():
+                shutil.rmtree(item.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(item.path)
+                except OSError:
+                    pass
+
+    def _load_index(self):
+        """Index from the last run, reconciled once with the directory (files written while
+        it wasn't saved, files deleted by hand)"""
+        stored = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    stored = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[image-store] Ignoring unreadable index {self.index_path}: {e}")
+        self.stories = stored.get('stories', {})
+        images = stored.get('images', {})
+        for item in os.scandir(self.root):
+            if not item.is_file() or not item.name.endswith('.png'):
+                continue
+            entry = images.get(item.name)
+            if entry is None:
+                mtime = item.stat().st_mtime
+                size = item.stat().st_size + sum(
+                    os.path.getsize(path) for path in (self.variant_path(item.name, v) for v in VARIANTS)
+                    if os.path.exists(path))
+                entry = {'size': size, 'created': mtime, 'last_used': mtime, 'story': None}
+            images[item.name] = entry
+        for filename, entry in sorted(images.items(), key=lambda item: item[1]['last_used']):
+            if os.path.exists(self.path_for(filename)):
+                self.entries[filename] = entry
+                self.total_bytes += entry['size']
+        self.dirty = True
+
+    def _save_index(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            payload = json.dumps({'images': self.entries, 'stories': self.stories})
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.index_path)
+
+    def resolve(self, filename, accepts_webp, size='full'):
+        """Pick the file to serve: (path, mimetype, etag, final), or None if the image doesn't exist
+
+        final is False when the PNG stands in for a WebP variant that is still being encoded,
+        so the same URL will soon answer with another file.
+        """
+        png_path = self.path_for(filename)
+        if not os.path.isfile(png_path):
+            return None
+        if size not in VARIANTS:
+            size = 'full'
+        self.touch(filename)
+
+        # Variants only exist as WebP; other clients (and everyone, until
+        # the background encode finishes) get the full-size PNG
+        if accepts_webp:
+            variant_path = self.variant_path(filename, size)
+            if os.path.isfile(variant_path):
+                return variant_path, 'image/webp', self.etag(variant_path), True
+        return png_path, 'image/png', self.etag(png_path), not accepts_webp
+
+    def etag(self, path):
+        """Strong ETag from the file content, computed once per file version"""
+        stat = os.stat(path)
+        with self.lock:
+            known = self.etags.get(path)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        with self.lock:
+            self.etags[path] = (stat.st_mtime_ns, stat.st_size, etag)
+        return etag
+
+    def _remember_etag(self, path, etag):
+        stat = os.stat(path)
+        with self.lock:
+            self.etags[path] = (stat.st_mtime_ns, stat.st_size, etag)
+
+    def stats(self):
+        """Retention budget usage for /health"""
+        with self.lock:
+            return {
+                'images': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'max_files': self.max_files,
+                'active_stories': len(self.stories),
+                'evictions': self.evictions,
+                'compactions': self.compactions,
+            }
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Asynchronous image generation jobs for the FAIryTale image server.
+
+A job wraps one GenerationRequest queued on the worker pool. Clients get a
+job id straight away and follow progress (queue position, denoising step,
+final image URL) by polling or over Server-Sent Events, and can cancel a job
+so abandoned reads stop using GPU time. With previews enabled a job first
+gets a rough preview_url part way through denoising, then its final image.
+A job preempted by more urgent work goes back to 'queued' until it runs again.
+"""
+
+import math
+import os
+import threading
+import time
+import uuid
+
+from generation import GenerationCancelled
+
+# Finished jobs are forgotten after this long
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', '3600'))
+
+TERMINAL_STATES = ('completed', 'failed', 'cancelled')
+# Longest ?wait=N long-poll on a job's status
+MAX_WAIT_SECONDS = 60
+
+
+def parse_wait(value):
+    """Seconds a ?wait= status poll may block, clamped to 0..MAX_WAIT_SECONDS; None when the
+    value is not a finite number (answered with a 400)"""
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(wait):
+        return None
+    return min(max(wait, 0.0), MAX_WAIT_SECONDS)
+
+
+class Job:
+    """State of one queued/running/finished generation"""
+
+    def __init__(self, request, meta=None):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.future = None
+        self.status = 'queued'
+        self.step = 0
+        self.total_steps = request.steps
+        self.image_url = None
+        self.local_path = None
+        # Rough image published part way through denoising, until the final one exists
+        self.preview_url = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Server-side details (external host, temp files to remove, ...)
+        self.meta = meta or {}
+        # Served straight from the result cache without generating
+        self.cached = False
+        # Identical concurrent submissions share this job
+        self.dedup_key = None
+        self.subscribers = 1
+        # Bumped on every state change so waiters can tell something happened
+        self.version = 0
+
+    @property
+    def done(self):
+        return self.status in TERMINAL_STATES
+
+
+class JobManager:
+    """Tracks jobs submitted to a WorkerPool (or a single MicroBatcher) and publishes their results"""
+
+    def __init__(self, batcher, publish, cleanup=None, publish_preview=None):
+        self.batcher = batcher
+        # publish(job, image) -> (image_url, local_path)
+        self.publish = publish
+        # publish_preview(job, image) -> preview_url; None disables previews
+        self.publish_preview = publish_preview
+        # cleanup(job) runs once a job is finished, whatever the outcome
+        self.cleanup = cleanup
+        self.jobs = {}
+        # dedup_key -> unfinished Job, so identical requests share one generation
+        self.inflight = {}
+        self.shared = 0
+        # listener(job) is called on every job change, e.g. to wake asyncio waiters
+        self.listeners = []
+        self.cond = threading.Condition()
+
+    def submit(self, request, meta=None, dedup_key=None):
+        """Queue a GenerationRequest and return its Job immediately
+
+        If an unfinished job with the same dedup_key exists, that job is
+        returned instead and no new generation is queued; it takes on this
+        request's priority and deadline when they are more urgent.
+        """
+        with self.cond:
+            existing = self.inflight.get(dedup_key) if dedup_key else None
+            if existing is not None and not existing.done:
+                existing.subscribers += 1
+                self.shared += 1
+                # The shared job now runs for its most urgent subscriber
+                self.batcher.escalate(existing.request, request.priority, request.latency_target)
+                return existing
+
+            job = Job(request, meta)
+            job.dedup_key = dedup_key
+            request.on_step = lambda step, total: self._on_step(job, step, total)
+            if self.publish_preview is not None:
+                request.on_preview = lambda image: self._on_preview(job, image)
+            request.on_requeue = lambda: self._on_requeue(job)
+            # May raise QueueFull; nothing is registered in that case
+            job.future = self.batcher.submit(request)
+            self._prune()
+            self.jobs[job.id] = job
+            if dedup_key:
+                self.inflight[dedup_key] = job
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        return job
+
+    def add_completed(self, request, image_url, local_path, meta=None):
+        """Register a job answered from the result cache"""
+        job = Job(request, meta)
+        job.status = 'completed'
+        job.cached = True
+        job.image_url = image_url
+        job.local_path = local_path
+        job.step = job.total_steps
+        job.finished_at = job.created_at
+        with self.cond:
+            self._prune()
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued job or stop a running one at its next step"""
+        job = self.get(job_id)
+        if job is None or job.done:
+            return job
+        with self.cond:
+            # A shared job keeps running while anyone else still wants it
+            job.subscribers -= 1
+            if job.subscribers > 0:
+                return job
+        job.request.cancel()
+        # Succeeds only while still queued; running batches stop at the next step
+        job.future.cancel()
+        return job
+
+    def cancel_all(self):
+        """Cancel every unfinished job, shared or not (server shutdown)"""
+        with self.cond:
+            pending = [job for job in self.jobs.values() if not job.done]
+        for job in pending:
+            job.request.cancel()
+            job.future.cancel()
+        return len(pending)
+
+    def add_listener(self, listener):
+        with self.cond:
+            if listener not in self.listeners:
+                self.listeners.append(listener)
+
+    def snapshot(self, job):
+        """JSON-ready view of a job"""
+        with self.cond:
+            data = {
+                'job_id': job.id,
+                'status': job.status,
+                'step': job.step,
+                'total_steps': job.total_steps,
+                'requested_steps': job.request.requested_steps,
+                'priority': job.request.priority,
+                'image_url': job.image_url,
+                'preview_url': job.preview_url,
+                'tier': 'final' if job.image_url else 'preview' if job.preview_url else None,
+                'cached': job.cached,
+                'peak_memory_mb': job.request.peak_memory_mb,
+                'error': job.error,
+                'created_at': job.created_at,
+                'started_at': job.started_at,
+                'finished_at': job.finished_at,
+            }
+        if job.status == 'queued':
+            data['queue_position'] = self.batcher.position(job.request)
+        return data
+
+    def wait(self, job, version, timeout):
+        """Block until the job changes past `version` or is finished; returns the new version"""
+        with self.cond:
+            self.cond.wait_for(lambda: job.version != version or job.done, timeout)
+            return job.version
+
+    def wait_until_done(self, job, timeout):
+        """Block until the job finishes or timeout seconds pass; True if it finished"""
+        with self.cond:
+            return self.cond.wait_for(lambda: job.done, timeout)
+
+    def wait_any(self, jobs, timeout):
+        """Block until at least one of `jobs` is finished; returns the finished ones"""
+        with self.cond:
+            self.cond.wait_for(lambda: any(job.done for job in jobs), timeout)
+            return [job for job in jobs if job.done]
+
+    def _on_step(self, job, step, total):
+        with self.cond:
+            if job.started_at is None:
+                job.started_at = time.time()
+            job.status = 'running'
+            job.step = step
+            job.total_steps = total
+            self._changed(job)
+
+    def _on_requeue(self, job):
+        with self.cond:
+            job.status = 'queued'
+            job.step = 0
+            self._changed(job)
+
+    def _on_preview(self, job, image):
+        try:
+            preview_url = self.publish_preview(job, image)
+        except Exception as e:
+            print(f"[jobs] Publishing the preview of job {job.id} failed: {e}")
+            return
+        with self.cond:
+            job.preview_url = preview_url
+            self._changed(job)
+
+    def _on_done(self, job, future):
+        status, error, image = 'completed', None, None
+        if future.cancelled():
+            status = 'cancelled'
+        else:
+            exc = future.exception()
+            if isinstance(exc, GenerationCancelled) or (exc is None and job.request.cancelled):
+                status = 'cancelled'
+            elif exc is not None:
+                status, error = 'failed', str(exc)
+            else:
+                image = future.result()
+
+        image_url = local_path = None
+        if image is not None:
+            try:
+                image_url, local_path = self.publish(job, image)
+            except Exception as e:
+                print(f"[jobs] Publishing job {job.id} failed: {e}")
+                status, error = 'failed', str(e)
+
+        with self.cond:
+            job.status = status
+            job.error = error
+            job.image_url = image_url
+            job.local_path = local_path
+            job.finished_at = time.time()
+            if job.dedup_key and self.inflight.get(job.dedup_key) is job:
+                del self.inflight[job.dedup_key]
+            self._changed(job)
+
+        if self.cleanup is not None:
+            self.cleanup(job)
+
+    def _changed(self, job):
+        job.version += 1
+        self.cond.notify_all()
+        for listener in self.listeners:
+            listener(job)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_TTL_SECONDS
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def status(self):
+        """Job counts by state for /health"""
+        with self.cond:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            counts['shared'] = self.shared
+        return counts
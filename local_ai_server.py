@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file
+from werkzeug.utils import secure_filename
 from flask_cors import CORS
 import subprocess
 import os
-import tempfile
 import time
-import base64
 import shutil
+import threading
+import re
+import json
+import hashlib
+import math
+import uuid
+import io
+import argparse
+import metrics
+from batching import QueueFull
+from jobs import parse_wait
+from reference_store import REFERENCE_DIR, InvalidReference
+from style_registry import style_for_genre
 
 app = Flask(__name__)
 CORS(app)
@@ -15,10 +27,34 @@ CORS(app)
 # Configuration for your specific setup
 VENV_PATH = r"C:\Users\Admin\Downloads\Story\fast_story_gen\venv"
 APP_PY_PATH = r"C:\Users\Admin\Downloads\Story\fast_story_gen\app.py"
-WORK_DIR = r"C:\Users\Admin\Downloads\Story\fast_story_gen"
+WORK_DIR = os.getenv('FAIRYTALE_WORK_DIR', r"C:\Users\Admin\Downloads\Story\fast_story_gen")
+
+# 'engine' keeps the pipeline resident in this process (default),
+# 'subprocess' runs app.py once per request like the original server
+GENERATION_MODE = os.getenv('GENERATION_MODE', 'engine')
+
+# 'serve' runs behind uvicorn with the asgi_frontend (production), 'dev' the Flask debug server
+SERVER_MODE = os.getenv('SERVER_MODE', 'serve')
+SERVER_HOST = os.getenv('HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('PORT', '5001'))
+
+# 'deterministic' derives the seed from the prompt so identical scenes can be
+# served from the result cache; 'timestamp' is the original timestamp % 10000
+SEED_MODE = os.getenv('SEED_MODE', 'deterministic')
+# Panels of a story (story_id) start from its previous panel via img2img at this strength,
+# running that share of the denoising steps; 0 (the default) always starts from noise unless a
+# request sends its own 'strength'. Opt-in because it changes how panels look
+CONTINUATION_STRENGTH = float(os.getenv('CONTINUATION_STRENGTH', '0'))
+# Longest latency_target a request may ask for, in seconds
+MAX_LATENCY_TARGET = float(os.getenv('MAX_LATENCY_TARGET', '86400'))
+# Publish a rough preview of every job part way through denoising (PREVIEW_AT)
+PROGRESSIVE_PREVIEW = os.getenv('PROGRESSIVE_PREVIEW', '1') == '1'
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE', '1') == '1'
+RESULT_CACHE_INDEX = os.path.join('cache', 'result_cache.json')
+IMAGE_INDEX = os.path.join('cache', 'image_index.json')
 
 # Ensure output directory exists
-OUTPUT_DIR = r"outputs\story_images"
+OUTPUT_DIR = os.path.join("outputs", "story_images")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 def get_python_executable():
@@ -27,160 +63,442 @@ def get_python_executable():
         return os.path.join(VENV_PATH, "Scripts", "python.exe")
     return "python"
 
+_pool = None
+_jobs = None
+_result_cache = None
+_image_store = None
+_reference_store = None
+_frontend = None
+_ollama = None
+# Held while the workers load and warm up, so nothing that must answer meanwhile may take it
+_engine_lock = threading.Lock()
+_image_store_lock = threading.Lock()
+_result_cache_lock = threading.Lock()
+_ollama_lock = threading.Lock()
+
+def get_pool():
+    """Load the resident pipeline workers (WORKER_DEVICES) on first use"""
+    global _pool
+    with _engine_lock:
+        if _pool is None:
+            start = time.time()
+            from worker_pool import WorkerPool
+            print(f"[startup] Imported the engine modules in {time.time() - start:.1f}s")
+            # Visible to /health while it loads and warms up
+            _pool = WorkerPool(WORK_DIR)
+            try:
+                _pool.start()
+            except Exception:
+                _pool = None
+                raise
+    return _pool
+
+def get_job_manager():
+    """Job tracker for the asynchronous /jobs API"""
+    global _jobs
+    pool = get_pool()
+    with _engine_lock:
+        if _jobs is None:
+            from jobs import JobManager
+            _jobs = JobManager(pool, publish=_publish_job_image, cleanup=_finish_job,
+                               publish_preview=_publish_preview if PROGRESSIVE_PREVIEW else None)
+    return _jobs
+
+def get_ollama_gateway():
+    """Pooled, cached connection to the Ollama next to this server, for /story"""
+    global _ollama
+    with _ollama_lock:
+        if _ollama is None:
+            from ollama_gateway import OllamaGateway
+            _ollama = OllamaGateway()
+    return _ollama
+
+def _finish_job(job):
+    """Runs once a job has finished, whatever the outcome"""
+    if job.meta.get('pinned_reference'):
+        get_reference_store().unpin(job.meta['pinned_reference'])
+    metrics.finish_trace(job.request.trace, job_id=job.id, status=job.status)
+
+def get_result_cache():
+    """Content-addressed cache of finished images, or None when disabled"""
+    global _result_cache
+    if not RESULT_CACHE_ENABLED:
+        return None
+    with _result_cache_lock:
+        if _result_cache is None:
+            from result_cache import ResultCache
+            # The image store's retention owns the files; the cache only indexes them
+            _result_cache = ResultCache('generated_images', RESULT_CACHE_INDEX, delete_files=False)
+    return _result_cache
+
+def get_image_store():
+    """Served images plus their background-encoded WebP variants"""
+    global _image_store
+    with _image_store_lock:
+        if _image_store is None:
+            from image_store import ImageStore
+            _image_store = ImageStore('generated_images', index_path=IMAGE_INDEX,
+                                      scratch_dir=os.path.join(WORK_DIR, OUTPUT_DIR),
+                                      on_evict=_forget_cached_result).start_compaction()
+    return _image_store
+
+def _forget_cached_result(filename):
+    if _result_cache is not None:
+        _result_cache.forget(filename)
+
+def get_reference_store():
+    """Character references by content hash, shared by every request"""
+    global _reference_store
+    with _image_store_lock:
+        if _reference_store is None:
+            from reference_store import ReferenceStore
+            _reference_store = ReferenceStore(REFERENCE_DIR)
+    return _reference_store
+
+def _image_url(external_host, web_filename):
+    return f"http://{external_host}/images/{web_filename}"
+
+def _publish_job_image(job, image):
+    """Save a finished job's image where /images serves it"""
+    cache_key = job.meta.get('cache_key')
+    web_filename = job.request.publish_key
+    with metrics.span('png_save', [job.request.trace]):
+        get_image_store().save(image, web_filename, story=job.meta.get('story_id'))
+        # An image cut short to meet its latency target isn't what the key's step count promises,
+        # so it went out under its own name (publish_key) and stays out of the cache
+        if cache_key and not job.request.degraded:
+            get_result_cache().record(cache_key)
+    web_path = os.path.join('generated_images', web_filename)
+    return _image_url(job.meta['external_host'], web_filename), web_path
+
+def _publish_preview(job, image):
+    """Keep a job's preview in memory as WebP; it is small and only lives as long as the job"""
+    buffer = io.BytesIO()
+    with metrics.span('preview_save', [job.request.trace]):
+        image.save(buffer, format='WEBP', quality=70)
+    data = buffer.getvalue()
+    job.meta['preview'] = (data, hashlib.sha256(data).hexdigest())
+    return f"http://{job.meta['external_host']}/jobs/{job.id}/preview"
+
+def _submit_generation(form, external_host, scene=None, reference_key=None):
+    """Queue a generation for a parsed form, reusing cached or in-flight results
+
+    With `scene`, one panel of a multi-scene story is queued instead of the
+    form's description.
+    """
+    from generation import GenerationRequest, build_story_prompts, continuation_steps
+    from result_cache import file_sha256
+
+    if scene is None:
+        story_prompt = form['story_prompt']
+        seed = form['seed']
+        trace = form['trace']
+    else:
+        story_prompt = scene
+        seed = _choose_seed(scene, form['character_name'], int(time.time()), form['requested_seed'])
+        trace = form['trace'].child()
+
+    if scene is None:
+        # Same image /generate returns: the first scene of the comma-separated story prompt
+        prompt = build_story_prompts(story_prompt, form['character_name'])[0]
+    else:
+        # An explicit scene is one panel, commas and all
+        prompt = f"{form['character_name']}, {scene.strip()}"
+    # The content hash keys both the result cache and the IP-Adapter embedding cache
+    reference_key = reference_key or form['reference_key']
+    if reference_key is None and form['reference_path']:
+        with metrics.span('reference_hash', [trace]):
+            reference_key = file_sha256(form['reference_path'])
+    generation = GenerationRequest(prompt, reference=form['reference_path'], seed=seed,
+                                   steps=25, scale=7.5, reference_key=reference_key,
+                                   style_lora=style_for_genre(form['genre'], WORK_DIR), trace=trace,
+                                   story_id=form['story_id'], output_key=f"job_{uuid.uuid4().hex}.png",
+                                   priority=form['priority'], latency_target=form['latency_target'])
+    continuation = {}
+    strength = form['strength']
+    continues = form['story_id'] and continuation_steps(generation.steps, strength) > 0
+    init_key = get_image_store().latest_for_story(form['story_id']) if continues else None
+    if init_key:
+        generation.init_image = get_image_store().path_for(init_key)
+        generation.init_key = init_key
+        generation.strength = strength
+        # The previous panel shapes the image, so it is part of the cache key
+        continuation = {'init': init_key, 'strength': strength}
+    meta = {
+        'external_host': external_host,
+        'story_id': form['story_id'],
+        # Stored references stay on disk until the job that reads them is done
+        'pinned_reference': form['reference_key'],
+    }
+    manager = get_job_manager()
+
+    cache = get_result_cache()
+    if cache is None:
+        return _submit_job(manager, generation, meta)
+
+    cache_key = cache.key_for(
+        prompt=story_prompt,
+        character=form['character_name'],
+        seed=generation.seed,
+        steps=generation.steps,
+        scale=generation.scale,
+        style_lora=generation.style_lora,
+        model=get_pool().model_id,
+        reference=reference_key,
+        **continuation
+    )
+    with metrics.span('cache_lookup', [trace]):
+        web_filename = cache.lookup(cache_key)
+    if web_filename:
+        get_image_store().touch(web_filename, form['story_id'])
+        job = manager.add_completed(generation, _image_url(external_host, web_filename),
+                                    os.path.join('generated_images', web_filename), meta)
+        metrics.finish_trace(trace, job_id=job.id, status='cached')
+        return job
+
+    meta['cache_key'] = cache_key
+    generation.degraded_output_key = generation.output_key
+    generation.output_key = cache.filename_for(cache_key)
+    job = _submit_job(manager, generation, meta, dedup_key=cache_key)
+    if job.meta is not meta:
+        # Joined an identical generation that is already running
+        metrics.finish_trace(trace, job_id=job.id, status='shared')
+    return job
+
+def _submit_job(manager, generation, meta, dedup_key=None):
+    """Queue on the pool, pinning the job's reference until it finishes"""
+    if meta['pinned_reference']:
+        get_reference_store().pin(meta['pinned_reference'])
+    try:
+        job = manager.submit(generation, meta=meta, dedup_key=dedup_key)
+    except QueueFull:
+        if meta['pinned_reference']:
+            get_reference_store().unpin(meta['pinned_reference'])
+        metrics.finish_trace(generation.trace, status='rejected')
+        raise
+    if job.meta is not meta and meta['pinned_reference']:
+        # Shared an existing job, whose own pin covers the reference
+        get_reference_store().unpin(meta['pinned_reference'])
+    return job
+
+@app.errorhandler(QueueFull)
+def queue_full(e):
+    """Admission control: tell clients when to come back instead of queueing unboundedly"""
+    response = jsonify({'error': 'Image server is busy', 'retry_after': e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
     python_exe = get_python_executable()
+    # Not ready until the workers are loaded and warmed up, so load balancers wait for us
+    ready = GENERATION_MODE == 'subprocess' or (_pool is not None and _pool.ready)
     return jsonify({
-        'status': 'ok', 
+        'status': 'ok' if ready else 'starting',
+        'ready': ready,
         'service': 'FAIryTale SD15+IP-Adapter Server',
         'python_path': python_exe,
         'working_directory': WORK_DIR,
-        'venv_active': os.path.exists(VENV_PATH)
-    })
+        'venv_active': os.path.exists(VENV_PATH),
+        'generation_mode': GENERATION_MODE,
+        'pool': _pool.status() if _pool else None,
+        'jobs': _jobs.status() if _jobs else None,
+        'result_cache': _result_cache.stats() if _result_cache else None,
+        'images': _image_store.stats() if _image_store else None,
+        'references': _reference_store.stats() if _reference_store else None,
+        'story': _ollama.stats() if _ollama else None,
+        'server': _frontend.status() if _frontend else {'mode': 'dev'}
+    }), 200 if ready else 503
+
+def _read_generation_form():
+    """Parse a /generate style multipart form into prompt, character and reference path"""
+    description = request.form.get('description', '')
+    genre = request.form.get('genre', 'fantasy')
+    character_name = request.form.get('character_name', 'hero')
+    character_image = request.form.get('character_image')
+    # Images of recently active stories are kept by the image store's retention
+    story_id = request.form.get('story_id', '').strip()[:64] or None
+
+    # Unique per request so outputs never collide, even within the same second
+    request_id = uuid.uuid4().hex
+    trace = metrics.Trace()
+
+    # Character reference: an upload or data URL goes into the content-addressed store
+    # (written once per distinct image), a reference_id names one stored earlier
+    reference_path = None
+    reference_key = None
+    missing_reference = None
+    # Message of a field that can't be used, answered with a 400
+    invalid = None
+    character_image_file = request.files.get('character_image')
+    reference_id = request.form.get('reference_id', '').strip().lower()
+    try:
+        if character_image_file:
+            with metrics.span('reference_save', [trace]):
+                reference_key = get_reference_store().put_stream(character_image_file.stream)
+        elif character_image and character_image.startswith('data:image'):
+            with metrics.span('reference_save', [trace]):
+                reference_key = get_reference_store().put_base64(character_image)
+        elif reference_id:
+            reference_key = reference_id if get_reference_store().get(reference_id) else None
+            missing_reference = None if reference_key else reference_id
+        elif character_image and os.path.exists(character_image):
+            # Direct file path
+            reference_path = character_image
+    except InvalidReference as e:
+        invalid = f"character_image is not a usable image: {e}"
+    except Exception as e:
+        print(f"Error processing reference image: {e}")
+    if reference_key:
+        reference_path = get_reference_store().path_for(reference_key)
+        print(f"Using reference image: {reference_path}")
+
+    story_prompt = _clean_prompt(description)
+
+    timestamp = int(time.time())
+    requested_seed = request.form.get('seed', '')
+    # Scheduling: interactive (a reader is waiting), prefetch or batch, and an optional
+    # latency target in seconds overriding the class's LATENCY_TARGET_*
+    priority = request.form.get('priority', 'interactive').strip().lower()
+    latency_target = None
+    if request.form.get('latency_target', '').strip():
+        try:
+            latency_target = float(request.form['latency_target'])
+        except ValueError:
+            latency_target = math.nan
+        if math.isfinite(latency_target):
+            latency_target = min(max(latency_target, 0.0), MAX_LATENCY_TARGET)
+        else:
+            invalid = 'latency_target must be a number of seconds'
+            latency_target = None
+
+    return {
+        'description': description,
+        'genre': genre,
+        'story_prompt': story_prompt,
+        'character_name': character_name,
+        'reference_path': reference_path,
+        'reference_key': reference_key,
+        'story_id': story_id,
+        'missing_reference': missing_reference,
+        'invalid': invalid,
+        'seed': _choose_seed(story_prompt, character_name, timestamp, requested_seed),
+        # Kept so panels queued after the request has been read (/generate_story, /chapter) can use them
+        'requested_seed': requested_seed,
+        'strength': _continuation_strength(),
+        'priority': priority,
+        'latency_target': latency_target,
+        'request_id': request_id,
+        'trace': trace,
+    }
+
+def _clean_prompt(text):
+    """ASCII-only prompt text, as app.py expects"""
+    # Create story prompt optimized for your app
+    # Your app.py expects comma-separated story segments, so we'll create one segment
+    # Also avoid Unicode characters to prevent Windows encoding issues
+    story_prompt = text.encode('ascii', 'ignore').decode('ascii')
+
+    # Clean up the prompt to avoid special characters that cause encoding issues
+    return re.sub(r'[^\x00-\x7F]+', ' ', story_prompt)
+
+def _choose_seed(story_prompt, character_name, timestamp, requested=''):
+    """The form's explicit seed, else one derived from SEED_MODE"""
+    if requested.isdigit():
+        return int(requested)
+    if SEED_MODE == 'deterministic':
+        digest = hashlib.sha256(f"{character_name}|{story_prompt}".encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) % 10000
+    return timestamp % 10000
+
+def _continuation_strength():
+    """img2img strength for story panels: the form's 'strength' (0-1) or CONTINUATION_STRENGTH"""
+    try:
+        strength = float(request.form.get('strength', CONTINUATION_STRENGTH))
+    except ValueError:
+        strength = CONTINUATION_STRENGTH
+    return min(max(strength, 0.0), 1.0)
+
+def _form_error_response(form):
+    """400 for an unusable field, or 410 telling the client to upload the image again when its
+    reference_id has expired; None if the form is fine"""
+    if form['invalid']:
+        return jsonify({'error': form['invalid']}), 400
+    if not form['missing_reference']:
+        return None
+    return jsonify({'error': 'Unknown reference_id, send character_image instead',
+                    'reference_id': form['missing_reference']}), 410
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
     """Generate image using your custom SD15+IP-Adapter setup"""
     try:
-        description = request.form.get('description', '')
-        genre = request.form.get('genre', 'fantasy')
-        character_name = request.form.get('character_name', 'hero')
-        character_image = request.form.get('character_image')
-
-        # Handle uploaded character reference image file
-        character_image_file = request.files.get('character_image')
-        if character_image_file:
-            # Save uploaded image temporarily for processing
-            timestamp = int(time.time())
-            filename = f"character_ref_{timestamp}.png"
-            temp_upload_path = os.path.join(WORK_DIR, OUTPUT_DIR, filename)
-            character_image_file.save(temp_upload_path)
-            character_image = temp_upload_path
-            print(f"Saved uploaded character reference image: {temp_upload_path}")
-
-        if not description:
+        form = _read_generation_form()
+        if not form['description']:
             return jsonify({'error': 'Description is required'}), 400
+        error = _form_error_response(form)
+        if error:
+            return error
 
-        # Create story prompt optimized for your app
-        # Your app.py expects comma-separated story segments, so we'll create one segment
-        # Also avoid Unicode characters to prevent Windows encoding issues
-        story_prompt = description.encode('ascii', 'ignore').decode('ascii')
-
-        # Clean up the prompt to avoid special characters that cause encoding issues
-        import re
-        story_prompt = re.sub(r'[^\x00-\x7F]+', ' ', story_prompt)
-
-        # Generate unique timestamp
-        timestamp = int(time.time())
-
-        # Prepare command
-        python_exe = get_python_executable()
-        cmd = [
-            python_exe, APP_PY_PATH,
-            '--story', story_prompt,
-            '--character', character_name,
-            '--output_dir', OUTPUT_DIR,
-            '--seed', str(timestamp % 10000),
-            '--steps', '25',  # Balanced quality/speed
-            '--scale', '7.5'
-        ]
-
-        # Handle reference image for IP-Adapter
-        temp_image_path = None
-        if character_image:
-            try:
-                if character_image.startswith('data:image'):
-                    # Decode base64 image
-                    header, encoded = character_image.split(',', 1)
-                    image_data = base64.b64decode(encoded)
-                    temp_image_path = os.path.join(WORK_DIR, OUTPUT_DIR, f'reference_{timestamp}.png')
-                    with open(temp_image_path, 'wb') as f:
-                        f.write(image_data)
-                    cmd.extend(['--reference', temp_image_path])
-                    print(f"Using reference image: {temp_image_path}")
-                else:
-                    # Direct file path
-                    if os.path.exists(character_image):
-                        cmd.extend(['--reference', character_image])
-            except Exception as e:
-                print(f"Error processing reference image: {e}")
-
-        print(f"Running command: {' '.join(cmd)}")
-        print(f"Working directory: {WORK_DIR}")
-
-        # Run the generation in your app's directory
-        result = subprocess.run(
-            cmd, 
-            cwd=WORK_DIR,
-            capture_output=True, 
-            text=True, 
-            timeout=180  # 3 minutes timeout
-        )
-
-        # Clean up temp files
-        if temp_image_path and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
-
-        print(f"Return code: {result.returncode}")
-        print(f"STDOUT: {result.stdout}")
-        if result.stderr:
-            print(f"STDERR: {result.stderr}")
-
-        if result.returncode == 0:
-            # Your app generates images as 00.png, 01.png, etc.
-            full_output_path = os.path.join(WORK_DIR, OUTPUT_DIR)
-            generated_files = []
-
-            # Look for generated images (your app creates 00.png, 01.png, etc.)
-            if os.path.exists(full_output_path):
-                for filename in os.listdir(full_output_path):
-                    if filename.endswith('.png') and filename[0].isdigit():
-                        generated_files.append(filename)
-            else:
-                return jsonify({
-                    'error': f'Output directory not found: {full_output_path}',
-                    'working_dir': WORK_DIR,
-                    'output_dir': OUTPUT_DIR
-                }), 500
+        if GENERATION_MODE != 'subprocess':
+            return _generate_with_engine(form)
 
-            if generated_files:
-                # Use the first generated image
-                generated_files.sort()
-                source_file = generated_files[0]
-                source_path = os.path.join(full_output_path, source_file)
+        story_prompt = form['story_prompt']
+        character_name = form['character_name']
+        reference_path = form['reference_path']
+        seed = form['seed']
+        request_id = form['request_id']
 
-                # Copy to our served directory with a web-friendly name
-                web_filename = f"story_{timestamp}.png"
-                web_path = os.path.join('generated_images', web_filename)
-                os.makedirs('generated_images', exist_ok=True)
-                shutil.copy2(source_path, web_path)
-
-                # Get external URL
-                external_host = os.getenv('EXTERNAL_HOST', request.host)
-                print(external_host)
-                image_url = f"http://{external_host}/images/{web_filename}"
+        # app.py gets a private output directory so concurrent runs can't overwrite each other
+        job_output_dir = os.path.join(OUTPUT_DIR, request_id)
+        if form['reference_key']:
+            get_reference_store().pin(form['reference_key'])
+        try:
+            style_lora = style_for_genre(form['genre'], WORK_DIR)
+            with metrics.span('app_py', [form['trace']]):
+                result = _run_app_py(story_prompt, character_name, seed, reference_path, job_output_dir, style_lora)
+            full_output_path = os.path.join(WORK_DIR, job_output_dir)
 
+            if result.returncode != 0:
                 return jsonify({
-                    'success': True,
-                    'image_url': image_url,
-                    'local_path': web_path,
-                    'generated_files': len(generated_files)
-                })
-            else:
+                    'error': 'Image generation failed',
+                    'return_code': result.returncode,
+                    'stdout': result.stdout,
+                    'stderr': result.stderr
+                }), 500
+
+            # Your app writes the first scene as 00.png, so there is nothing to search for
+            source_path = os.path.join(full_output_path, '00.png')
+            if not os.path.exists(source_path):
                 return jsonify({
                     'error': 'No images found in output directory',
                     'output_dir': full_output_path,
                     'stdout': result.stdout,
                     'stderr': result.stderr
                 }), 500
-        else:
+
+            # Move (not copy) into our served directory under a name unique to this request
+            web_filename = f"story_{request_id}.png"
+            web_path = os.path.join('generated_images', web_filename)
+            os.makedirs('generated_images', exist_ok=True)
+            with metrics.span('copy', [form['trace']]):
+                shutil.move(source_path, web_path)
+                get_image_store().add_existing(web_filename, story=form['story_id'])
+            metrics.finish_trace(form['trace'], request_id=request_id, status='completed')
+
             return jsonify({
-                'error': 'Image generation failed',
-                'return_code': result.returncode,
-                'stdout': result.stdout,
-                'stderr': result.stderr
-            }), 500
+                'success': True,
+                'image_url': _image_url(os.getenv('EXTERNAL_HOST', request.host), web_filename),
+                'local_path': web_path,
+                'generated_files': len(story_prompt.split(','))
+            })
+        finally:
+            # Clean up this request's output directory
+            if form['reference_key']:
+                get_reference_store().unpin(form['reference_key'])
+            shutil.rmtree(os.path.join(WORK_DIR, job_output_dir), ignore_errors=True)
 
     except subprocess.TimeoutExpired:
         return jsonify({'error': 'Image generation timed out (3 minutes)'}), 500
@@ -188,10 +506,593 @@ def generate_image():
         print(f"Unexpected error: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _run_app_py(story_prompt, character_name, seed, reference_path, output_dir, style_lora=None):
+    """Legacy mode: run app.py in a fresh interpreter for this request"""
+    python_exe = get_python_executable()
+    cmd = [
+        python_exe, APP_PY_PATH,
+        '--story', story_prompt,
+        '--character', character_name,
+        '--output_dir', output_dir,
+        '--seed', str(seed),
+        '--steps', '25',  # Balanced quality/speed
+        '--scale', '7.5'
+    ]
+    if reference_path:
+        cmd.extend(['--reference', reference_path])
+    if style_lora:
+        cmd.extend(['--style_lora', style_lora])
+
+    print(f"Running command: {' '.join(cmd)}")
+    print(f"Working directory: {WORK_DIR}")
+
+    # Run the generation in your app's directory
+    result = subprocess.run(
+        cmd,
+        cwd=WORK_DIR,
+        capture_output=True,
+        text=True,
+        timeout=180  # 3 minutes timeout
+    )
+
+    print(f"Return code: {result.returncode}")
+    print(f"STDOUT: {result.stdout}")
+    if result.stderr:
+        print(f"STDERR: {result.stderr}")
+    return result
+
+def _generate_with_engine(form):
+    """Resident mode: queue on the warm pipeline and wait for the result"""
+    manager = get_job_manager()
+    job = _submit_generation(form, os.getenv('EXTERNAL_HOST', request.host))
+    if request.form.get('progressive') == '1':
+        return Response(_progressive_stream(manager, job), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if not manager.wait_until_done(job, 180):
+        manager.cancel(job.id)
+        return jsonify({'error': 'Image generation timed out (3 minutes)'}), 500
+
+    if job.status != 'completed':
+        return jsonify({
+            'error': 'Image generation failed',
+            'status': job.status,
+            'stderr': job.error
+        }), 500
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'image_url': job.image_url,
+        'local_path': job.local_path,
+        'generated_files': 1,
+        'cached': job.cached
+    })
+
+def _progressive_stream(manager, job):
+    """NDJSON for /generate?progressive=1: a 'preview' line as soon as there is one, then 'final'"""
+    deadline = time.time() + 180
+    sent_preview = False
+    try:
+        while not job.done and time.time() < deadline:
+            if job.preview_url and not sent_preview:
+                sent_preview = True
+                yield json.dumps({'event': 'preview', 'job_id': job.id, 'preview_url': job.preview_url}) + '\n'
+            manager.wait(job, job.version, 15)
+        if not job.done:
+            yield json.dumps({'event': 'failed', 'job_id': job.id,
+                              'error': 'Image generation timed out (3 minutes)'}) + '\n'
+        elif job.status != 'completed':
+            yield json.dumps({'event': 'failed', 'job_id': job.id, 'status': job.status,
+                              'stderr': job.error}) + '\n'
+        else:
+            yield json.dumps({'event': 'final', 'success': True, 'job_id': job.id, 'image_url': job.image_url,
+                              'local_path': job.local_path, 'generated_files': 1, 'cached': job.cached}) + '\n'
+    finally:
+        # Timed out, or the client went away
+        if not job.done:
+            manager.cancel(job.id)
+
+def _read_story_scenes():
+    """(scenes, error): the scene list from repeated 'scenes' fields, a JSON array of strings or
+    a comma-separated 'story'; error is a message for a 400 when 'scenes' is unusable JSON"""
+    scenes = request.form.getlist('scenes')
+    if len(scenes) == 1 and scenes[0].lstrip()[:1] in ('[', '{'):
+        try:
+            scenes = json.loads(scenes[0])
+        except ValueError:
+            return [], 'scenes is not valid JSON'
+        if not isinstance(scenes, list) or not all(isinstance(scene, str) and scene.strip() for scene in scenes):
+            return [], 'scenes must be a JSON array of non-empty strings'
+    if not scenes and request.form.get('story'):
+        scenes = request.form['story'].split(',')
+    return [s for s in (_clean_prompt(scene).strip() for scene in scenes) if s], None
+
+@app.route('/generate_story', methods=['POST'])
+def generate_story():
+    """Render every scene of a story for one character, streaming panels as NDJSON as they finish"""
+    if GENERATION_MODE == 'subprocess':
+        return jsonify({'error': 'Story generation needs GENERATION_MODE=engine'}), 501
+
+    from result_cache import file_sha256
+
+    form = _read_generation_form()
+    scenes, error = _read_story_scenes()
+    if error:
+        return jsonify({'error': error}), 400
+    if not scenes:
+        return jsonify({'error': 'At least one scene is required'}), 400
+    error = _form_error_response(form)
+    if error:
+        return error
+
+    # Panels share one reference hash, so its IP-Adapter embedding is computed once;
+    # the batcher groups the panels into batched denoising passes
+    external_host = os.getenv('EXTERNAL_HOST', request.host)
+    reference_key = form['reference_key']
+    if reference_key is None and form['reference_path']:
+        reference_key = file_sha256(form['reference_path'])
+    manager = get_job_manager()
+    jobs = []
+    try:
+        for scene in scenes:
+            jobs.append(_submit_generation(form, external_host, scene=scene, reference_key=reference_key))
+    except QueueFull:
+        # All panels or none: don't leave half a story rendering
+        for job in jobs:
+            manager.cancel(job.id)
+        raise
+    index_of = {id(job): i for i, job in enumerate(jobs)}
+
+    def stream():
+        pending = list(jobs)
+        try:
+            yield json.dumps({'event': 'accepted', 'panels': len(jobs),
+                              'job_ids': [job.id for job in jobs]}) + '\n'
+            deadline = time.time() + 180 * len(jobs)
+            while pending and time.time() < deadline:
+                for job in manager.wait_any(pending, 15):
+                    pending.remove(job)
+                    panel = manager.snapshot(job)
+                    panel.update({'event': 'panel', 'index': index_of[id(job)],
+                                  'scene': scenes[index_of[id(job)]]})
+                    yield json.dumps(panel) + '\n'
+            yield json.dumps({'event': 'done', 'timed_out': len(pending)}) + '\n'
+        finally:
+            # Client went away (or we timed out): stop rendering panels nobody will see
+            for job in pending:
+                manager.cancel(job.id)
+
+    return Response(stream(), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue an image generation and return its job id immediately"""
+    if GENERATION_MODE == 'subprocess':
+        return jsonify({'error': 'The job API needs GENERATION_MODE=engine'}), 501
+
+    form = _read_generation_form()
+    if not form['description']:
+        return jsonify({'error': 'Description is required'}), 400
+    error = _form_error_response(form)
+    if error:
+        return error
+
+    job = _submit_generation(form, os.getenv('EXTERNAL_HOST', request.host))
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'cached': job.cached,
+        'status_url': f"/jobs/{job.id}",
+        'events_url': f"/jobs/{job.id}/events",
+        # Serves the preview until the final image exists, then the final image
+        'live_image_url': f"/jobs/{job.id}/image"
+    }), 202
+
+def _lookup_job(job_id):
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    return manager, job
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Job status and result; ?wait=N long-polls up to N seconds for a change"""
+    manager, job = _lookup_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    wait = parse_wait(request.args.get('wait', 0))
+    if wait is None:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    if wait > 0 and not job.done:
+        manager.wait(job, job.version, wait)
+    data = manager.snapshot(job)
+    if request.args.get('trace') == '1' and job.request.trace is not None:
+        data['trace'] = job.request.trace.to_dict()
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running job"""
+    manager = get_job_manager()
+    job = manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(manager.snapshot(job))
+
+@app.route('/jobs/<job_id>/preview')
+def job_preview(job_id):
+    """A job's rough preview image"""
+    _, job = _lookup_job(job_id)
+    if job is None or 'preview' not in job.meta:
+        return jsonify({'error': 'No preview'}), 404
+    data, etag = job.meta['preview']
+    response = Response(data, mimetype='image/webp')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route('/jobs/<job_id>/image')
+def job_image(job_id):
+    """The job's best image so far: the final one once it exists, else the preview"""
+    _, job = _lookup_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.local_path:
+        response = _image_response(os.path.basename(job.local_path))
+        if response is None:
+            # Retention removed the file after the job finished
+            return jsonify({'error': 'Image no longer available', 'status': job.status}), 404
+    elif 'preview' in job.meta:
+        response = job_preview(job_id)
+    else:
+        return jsonify({'error': 'No image yet', 'status': job.status}), 404
+    # Content changes from preview to final, so clients must revalidate
+    response.cache_control.immutable = False
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = None
+    response.expires = None
+    return response
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of queue position, denoising steps and completion"""
+    manager, job = _lookup_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    def stream():
+        last_sent = None
+        last_write = time.time()
+        version = job.version
+        while True:
+            snapshot = manager.snapshot(job)
+            if snapshot != last_sent:
+                event = 'progress' if snapshot['status'] == 'running' else snapshot['status']
+                yield f"event: {event}\ndata: {json.dumps(snapshot)}\n\n"
+                last_sent = snapshot
+                last_write = time.time()
+            elif time.time() - last_write >= 15:
+                yield ": keep-alive\n\n"
+                last_write = time.time()
+            if snapshot['status'] in ('completed', 'failed', 'cancelled'):
+                return
+            # Queue position moves without the job itself changing, so re-check while queued
+            version = manager.wait(job, version, 1 if job.status == 'queued' else 15)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _truthy(value):
+    return value is True or str(value).lower() in ('1', 'true', 'yes')
+
+@app.route('/story', methods=['POST'])
+def story():
+    """Story text from the local Ollama over a pooled connection, cached by (model, prompt);
+    stream=true answers with Ollama-style NDJSON as the tokens arrive"""
+    from ollama_gateway import OllamaError
+
+    data = request.get_json(silent=True) or request.form
+    prompt = data.get('prompt', '')
+    if not prompt:
+        return jsonify({'error': 'Prompt is required'}), 400
+    options = data.get('options') if isinstance(data.get('options'), dict) else None
+    gateway = get_ollama_gateway()
+    health = gateway.health()
+    if not health['available']:
+        return jsonify({'error': 'Ollama is not available', 'health': health}), 503
+
+    args = (prompt, data.get('model') or None, options, _truthy(data.get('refresh', False)))
+    if _truthy(data.get('stream', False)):
+        return Response(_story_stream(gateway.stream(*args)), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    try:
+        with metrics.span('story'):
+            return jsonify(gateway.generate(*args))
+    except OllamaError as e:
+        return jsonify({'error': str(e)}), e.status
+
+def _story_stream(events):
+    """NDJSON lines; an Ollama failure mid-stream ends it with an error line"""
+    from ollama_gateway import OllamaError
+
+    try:
+        for event in events:
+            yield json.dumps(event) + '\n'
+    except OllamaError as e:
+        yield json.dumps({'error': str(e), 'done': True}) + '\n'
+
+@app.route('/story/health')
+def story_health():
+    """Ollama's cached health status (re-probed at most every OLLAMA_HEALTH_TTL seconds)"""
+    health = get_ollama_gateway().health(force=request.args.get('force') == '1')
+    return jsonify(health), 200 if health['available'] else 503
+
+@app.route('/chapter', methods=['POST'])
+def chapter():
+    """Story text and its illustration in one NDJSON stream: the image job is queued as soon as
+    the model has written sceneDescription, while the rest of the chapter is still streaming"""
+    if GENERATION_MODE == 'subprocess':
+        return jsonify({'error': 'Chapter generation needs GENERATION_MODE=engine'}), 501
+
+    prompt = request.form.get('prompt', '')
+    if not prompt:
+        return jsonify({'error': 'Prompt is required'}), 400
+    form = _read_generation_form()
+    error = _form_error_response(form)
+    if error:
+        return error
+    gateway = get_ollama_gateway()
+    health = gateway.health()
+    if not health['available']:
+        return jsonify({'error': 'Ollama is not available', 'health': health}), 503
+
+    events = gateway.stream(prompt, request.form.get('model') or None, None,
+                            _truthy(request.form.get('refresh', False)))
+    return Response(_chapter_stream(events, form, os.getenv('EXTERNAL_HOST', request.host)),
+                    mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _chapter_stream(events, form, external_host):
+    """NDJSON for /chapter: 'text' chunks, 'scene' once the image is queued, 'chapter' when the text
+    is complete, 'preview' and 'image' as the illustration progresses, in whichever order they happen"""
+    from chapter_stream import JsonFieldScanner, first_sentence, parse_chapter
+    from ollama_gateway import OllamaError
+
+    manager = get_job_manager()
+    scanner = JsonFieldScanner(['sceneDescription'])
+    start = time.time()
+    job = None
+    sent = set()
+    timings = {}
+
+    def queue_image(scene):
+        nonlocal job
+        scene = _clean_prompt(scene).strip()
+        try:
+            job = _submit_generation(form, external_host, scene=scene)
+        except QueueFull as e:
+            sent.add('image')
+            return {'event': 'image', 'success': False, 'error': str(e)}
+        timings['image_queued_s'] = round(time.time() - start, 3)
+        print(f"[chapter] Image queued after {timings['image_queued_s']}s: {scene[:60]}")
+        return {'event': 'scene', 'sceneDescription': scene, 'job_id': job.id, 'status_url': f"/jobs/{job.id}",
+                'live_image_url': f"/jobs/{job.id}/image"}
+
+    def image_events():
+        # Whatever the job has reached that the client hasn't been told yet
+        if job is None or 'image' in sent:
+            return
+        if job.preview_url and 'preview' not in sent and not job.done:
+            sent.add('preview')
+            yield {'event': 'preview', 'job_id': job.id, 'preview_url': job.preview_url}
+        if job.done:
+            sent.add('image')
+            timings['image_s'] = round(time.time() - start, 3)
+            if job.status == 'completed':
+                yield {'event': 'image', 'success': True, 'job_id': job.id, 'image_url': job.image_url,
+                       'cached': job.cached}
+            else:
+                yield {'event': 'image', 'success': False, 'job_id': job.id, 'status': job.status,
+                       'error': job.error}
+
+    text = []
+    try:
+        try:
+            for event in events:
+                if event.get('done'):
+                    timings['text_cached'] = event.get('cached', False)
+                    break
+                text.append(event['response'])
+                yield json.dumps({'event': 'text', 'response': event['response']}) + '\n'
+                for field, value in scanner.feed(event['response']):
+                    if job is None and value.strip():
+                        yield json.dumps(queue_image(value)) + '\n'
+                for update in image_events():
+                    yield json.dumps(update) + '\n'
+        except OllamaError as e:
+            yield json.dumps({'event': 'error', 'error': str(e)}) + '\n'
+            return
+        timings['text_s'] = round(time.time() - start, 3)
+
+        full_text = ''.join(text)
+        parsed = parse_chapter(full_text)
+        chapter = parsed or {'content': full_text.strip()}
+        if job is None and 'image' not in sent:
+            # The model never wrote a scene: illustrate the opening sentence, as ollama.ts does
+            scene = chapter.get('sceneDescription') or ''
+            if not scene.strip() and chapter.get('content'):
+                scene = f"{form['character_name']} {first_sentence(chapter['content'])}"
+            yield json.dumps(queue_image(scene or form['description'] or
+                                         f"{form['character_name']} in a magical adventure scene")) + '\n'
+        yield json.dumps({'event': 'chapter', 'chapter': chapter, 'parsed': parsed is not None,
+                          'cached': timings.get('text_cached', False)}) + '\n'
+
+        deadline = time.time() + 180
+        while job is not None and 'image' not in sent and time.time() < deadline:
+            for update in image_events():
+                yield json.dumps(update) + '\n'
+            if 'image' not in sent:
+                manager.wait(job, job.version, 15)
+        if job is not None and 'image' not in sent:
+            yield json.dumps({'event': 'image', 'success': False, 'job_id': job.id,
+                              'error': 'Image generation timed out (3 minutes)'}) + '\n'
+        total = time.time() - start
+        metrics.observe('chapter', total)
+        yield json.dumps(dict(timings, event='done', total_s=round(total, 3))) + '\n'
+    finally:
+        # Timed out, the text failed, or the client went away
+        if job is not None and not job.done:
+            manager.cancel(job.id)
+
+@app.route('/references', methods=['POST'])
+def register_reference():
+    """Store a character reference and, in engine mode, pre-compute its IP-Adapter embeddings
+    so they are ready before chapter 1"""
+    upload = request.files.get('character_image')
+    data_url = request.form.get('character_image', '')
+    store = get_reference_store()
+    try:
+        with metrics.span('reference_save'):
+            if upload:
+                reference_id = store.put_stream(upload.stream)
+            elif data_url.startswith('data:image'):
+                reference_id = store.put_base64(data_url)
+            else:
+                return jsonify({'error': 'character_image file or data URL is required'}), 400
+    except InvalidReference as e:
+        return jsonify({'error': f"character_image is not a usable image: {e}"}), 400
+
+    if GENERATION_MODE == 'subprocess':
+        return jsonify({'reference_id': reference_id, 'cached': False})
+    pool = get_pool()
+    already_cached = pool.has_reference(reference_id)
+    # Pinned so TTL or size eviction can't remove the file while the workers read it
+    store.pin(reference_id)
+    try:
+        pool.encode_reference(store.path_for(reference_id), reference_id)
+    except (OSError, SyntaxError, ValueError) as e:
+        # PIL's errors for an image it can open but not decode
+        print(f"[references] Could not encode {reference_id}: {e}")
+        return jsonify({'error': 'character_image could not be decoded', 'reference_id': reference_id}), 400
+    finally:
+        store.unpin(reference_id)
+    return jsonify({'reference_id': reference_id, 'cached': already_cached})
+
+@app.route('/references/<reference_id>', methods=['GET'])
+def reference_info(reference_id):
+    """Whether a reference is still stored; HEAD lets clients check before uploading the bytes"""
+    path = get_reference_store().get(reference_id)
+    if path is None:
+        return jsonify({'error': 'Unknown reference', 'reference_id': reference_id}), 404
+    return jsonify({
+        'reference_id': reference_id,
+        'size': os.path.getsize(path),
+        'embedded': bool(_pool and _pool.ready and _pool.has_reference(reference_id)),
+    })
+
+# Image names are unique per generation, so a URL's content never changes
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
 @app.route('/images/<filename>')
 def serve_image(filename):
-    """Serve generated images"""
-    return send_from_directory('generated_images', filename)
+    """Serve generated images (WebP when accepted, ?size=medium|thumb) with ETags, and immutable
+    caching once the file served is the one the URL will keep answering with"""
+    response = _image_response(filename)
+    if response is None:
+        return jsonify({'error': 'Image not found'}), 404
+    return response
+
+def _image_response(filename):
+    """The response for a stored image, or None if it doesn't exist (any more)"""
+    accepts_webp = request.accept_mimetypes['image/webp'] > 0
+    with metrics.span('serve'):
+        resolved = get_image_store().resolve(secure_filename(filename), accepts_webp,
+                                             request.args.get('size', 'full'))
+        if resolved is None:
+            return None
+
+        path, mimetype, etag, final = resolved
+        response = send_file(path, mimetype=mimetype, etag=etag, conditional=True,
+                             max_age=IMAGE_MAX_AGE if final else None)
+    response.cache_control.public = True
+    if final:
+        response.cache_control.immutable = True
+    else:
+        # PNG stand-in until the WebP variant is encoded: revalidate so caches pick it up
+        response.cache_control.no_cache = True
+    response.vary.add('Accept')
+    return response
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _count_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if 'request_started' in g:
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+def _collect_jobs():
+    counts = _jobs.status() if _jobs else {}
+    return {(state,): counts.get(state, 0) for state in ('queued', 'running')}
+
+def _collect_cache_stats():
+    """(cache,) -> stats dict for the result cache and the per-worker embedding caches"""
+    caches = {}
+    if _result_cache:
+        caches['result'] = _result_cache.stats()
+    for worker in (_pool.workers if _pool else []):
+        for name in ('reference_embeds', 'prompt_embeds'):
+            cache = getattr(worker.engine, name, None)
+            if hasattr(cache, 'stats'):
+                stats = caches.setdefault(name, {'hits': 0, 'misses': 0})
+                worker_stats = cache.stats()
+                stats['hits'] += worker_stats['hits']
+                stats['misses'] += worker_stats['misses']
+    if _ollama:
+        caches['story'] = _ollama.stats()['cache']
+    return caches
+
+def _cache_counter(field):
+    return lambda: {(name,): stats[field] for name, stats in _collect_cache_stats().items()}
+
+def _cache_hit_ratio():
+    return {(name,): round(stats['hits'] / (stats['hits'] + stats['misses']), 4)
+            for name, stats in _collect_cache_stats().items() if stats['hits'] + stats['misses']}
+
+metrics.Collected('fairytale_ready', 'Whether the workers are loaded and warmed up',
+                  lambda: {(): int(GENERATION_MODE == 'subprocess' or bool(_pool and _pool.ready))})
+metrics.Collected('fairytale_jobs_in_flight', 'Unfinished generation jobs by state', _collect_jobs, ('state',))
+metrics.Collected('fairytale_queue_depth', 'Images waiting for a worker',
+                  lambda: {(): _pool.queued()} if _pool else {})
+metrics.Collected('fairytale_worker_running', 'Images being denoised per worker',
+                  lambda: {(str(w.index), w.device): w.batcher.running for w in _pool.workers} if _pool else {},
+                  ('worker', 'device'))
+metrics.Collected('fairytale_queue_rejected_total', 'Requests refused with 429 because the queue was full',
+                  lambda: {(): _pool.rejected} if _pool else {}, kind='counter')
+metrics.Collected('fairytale_cache_hits_total', 'Cache hits', _cache_counter('hits'), ('cache',), kind='counter')
+metrics.Collected('fairytale_cache_misses_total', 'Cache misses', _cache_counter('misses'), ('cache',),
+                  kind='counter')
+metrics.Collected('fairytale_cache_hit_ratio', 'Cache hit ratio since start', _cache_hit_ratio, ('cache',))
+metrics.Collected('fairytale_image_store_bytes', 'Disk used by served images and their variants',
+                  lambda: {(): _image_store.stats()['bytes']} if _image_store else {})
+metrics.Collected('fairytale_image_evictions_total', 'Images removed by retention',
+                  lambda: {(): _image_store.evictions} if _image_store else {}, kind='counter')
+metrics.Collected('fairytale_reference_store_bytes', 'Disk used by stored character references',
+                  lambda: {(): _reference_store.stats()['bytes']} if _reference_store else {})
+metrics.Collected('fairytale_reference_uploads_total', 'Reference uploads, new or already stored',
+                  lambda: ({('stored',): _reference_store.stored, ('deduplicated',): _reference_store.deduplicated}
+                           if _reference_store else {}), ('outcome',), kind='counter')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage latency histograms, request counters, queue gauges and cache hit rates"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/test')
 def test():
@@ -211,15 +1112,64 @@ def test():
         'venv_path': VENV_PATH,
         'working_directory': WORK_DIR,
         'output_directory': OUTPUT_DIR,
+        'generation_mode': GENERATION_MODE,
         'endpoints': {
             'health': '/health',
             'generate': '/generate (POST)',
-            'images': '/images/<filename>',
+            'jobs': '/jobs (POST), /jobs/<id> (GET, DELETE), /jobs/<id>/events (SSE), '
+                    '/jobs/<id>/preview, /jobs/<id>/image',
+            'references': '/references (POST), /references/<id> (GET, HEAD)',
+            'generate_story': '/generate_story (POST, NDJSON stream)',
+            'story': '/story (POST, stream=true for NDJSON), /story/health',
+            'chapter': '/chapter (POST, NDJSON stream of story text and its illustration)',
+            'images': '/images/<filename>?size=full|medium|thumb',
+            'metrics': '/metrics (Prometheus text)',
             'test': '/test'
         }
     })
 
+def _parse_args():
+    parser = argparse.ArgumentParser(description='FAIryTale SD15+IP-Adapter image server')
+    parser.add_argument('--mode', choices=['serve', 'dev'], default=SERVER_MODE,
+                        help='serve: uvicorn with bounded queues and graceful drain; dev: Flask debug server')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--threads', type=int, help='HTTP handler threads (SERVER_THREADS)')
+    parser.add_argument('--max-pending', type=int, help='requests waiting for a thread before 503 (MAX_PENDING_REQUESTS)')
+    parser.add_argument('--drain-seconds', type=float, help='time running jobs get on shutdown (DRAIN_SECONDS)')
+    parser.add_argument('--worker-devices', help='pipeline workers, e.g. cuda:0,cuda:1 (WORKER_DEVICES)')
+    parser.add_argument('--max-queue', type=int, help='queued images before 429 (MAX_QUEUE)')
+    return parser.parse_args()
+
+def _serve(args):
+    """Production mode; False when uvicorn isn't installed"""
+    global _frontend
+    try:
+        import uvicorn  # noqa: F401
+    except ImportError:
+        print("WARNING: uvicorn is not installed (pip install -r python_requirements.txt); "
+              "falling back to the Flask dev server, which uses a thread per request")
+        return False
+    import asgi_frontend
+
+    options = {name: value for name, value in (('threads', args.threads), ('max_pending', args.max_pending),
+                                               ('drain_seconds', args.drain_seconds)) if value is not None}
+    on_startup = None
+    if GENERATION_MODE != 'subprocess':
+        # Load and warm up the models in the background; /health answers 503 until they are ready
+        on_startup = lambda: threading.Thread(target=get_pool, name='engine-startup', daemon=True).start()
+    _frontend = asgi_frontend.FrontEnd(app.wsgi_app, lambda: _jobs, on_startup=on_startup, **options)
+    asgi_frontend.serve(_frontend, args.host, args.port)
+    return True
+
 if __name__ == '__main__':
+    args = _parse_args()
+    # Read when the worker pool is first imported
+    if args.worker_devices:
+        os.environ['WORKER_DEVICES'] = args.worker_devices
+    if args.max_queue is not None:
+        os.environ['MAX_QUEUE'] = str(args.max_queue)
+
     print("="*60)
     print("FAIryTale SD15+IP-Adapter Image Server")
     print("="*60)
@@ -227,14 +1177,24 @@ if __name__ == '__main__':
     print(f"Virtual env: {VENV_PATH}")
     print(f"Working dir: {WORK_DIR}")
     print(f"Python exe: {get_python_executable()}")
+    print(f"Generation mode: {GENERATION_MODE}")
+    print(f"Server mode: {args.mode}")
     print("="*60)
-    print("Starting server on http://0.0.0.0:5001")
-    print("Test endpoint: http://localhost:5001/test")
+    print(f"Starting server on http://{args.host}:{args.port}")
+    print(f"Test endpoint: http://localhost:{args.port}/test")
     print()
     print("To expose to Replit:")
     print("1. Install ngrok: https://ngrok.com/download")
-    print("2. Run: ngrok http 5001")
+    print(f"2. Run: ngrok http {args.port}")
     print("3. Copy the HTTPS URL to Replit secrets as REMOTE_IMAGE_URL")
     print("="*60)
 
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    if args.mode == 'serve' and _serve(args):
+        raise SystemExit(0)
+
+    if GENERATION_MODE != 'subprocess':
+        threading.Thread(target=get_pool, name='engine-startup', daemon=True).start()
+
+    # The reloader would start a second process and load the model twice
+    app.run(host=args.host, port=args.port, debug=True, use_reloader=GENERATION_MODE == 'subprocess',
+            threaded=True)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Memory budget for the diffusion pipeline.
+
+MEMORY_BUDGET_MB caps what one engine may use on its device (VRAM on a GPU,
+RAM on the CPU). The engine runs in one of these modes, least intrusive first:
+
+  full                everything resident on the device
+  sliced              attention and VAE decode one slice / image at a time
+  tiled               sliced, plus the VAE decodes in tiles
+  model_offload       GPU only: each model moves to the GPU while it runs
+  sequential_offload  GPU only: weights are streamed in layer by layer
+
+With MEMORY_MODE=auto the engine starts in the first mode whose estimate
+fits the budget and moves to the next one whenever a batch's measured peak
+goes over it (or a CUDA allocation fails). Peaks are the CUDA allocator peak
+on a GPU and the process peak RSS on the CPU, so workers sharing a device or
+a process see each other's memory.
+
+Torch is imported lazily so the server can import this without it.
+"""
+
+import os
+
+MEMORY_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', '0'))
+# auto, or one of MODES to pin it
+MEMORY_MODE = os.getenv('MEMORY_MODE', 'auto')
+
+MODES = ('full', 'sliced', 'tiled', 'model_offload', 'sequential_offload')
+OFFLOAD_MODES = ('model_offload', 'sequential_offload')
+
+# Rough working memory per 512x512 image in 16-bit weights (doubled for 32-bit), in MB
+ATTENTION_MB = 600
+SLICED_ATTENTION_MB = 200
+VAE_DECODE_MB = 1200
+TILED_VAE_DECODE_MB = 300
+# Largest layer group resident at once with sequential offload
+SEQUENTIAL_RESIDENT_MB = 300
+
+
+def modes_for(device):
+    """Modes that make sense on a device; offloading moves weights to the CPU, so not on the CPU"""
+    return MODES if not device.startswith('cpu') else MODES[:3]
+
+
+def estimate_mb(mode, weights_mb, largest_mb, batch_size, bytes_per_param=2):
+    """Expected peak of one batch in `mode`, weights included"""
+    scale = bytes_per_param / 2
+    if mode == 'full':
+        return weights_mb + batch_size * (ATTENTION_MB + VAE_DECODE_MB) * scale
+    if mode == 'sliced':
+        return weights_mb + (batch_size * SLICED_ATTENTION_MB + VAE_DECODE_MB) * scale
+    if mode == 'tiled':
+        return weights_mb + (batch_size * SLICED_ATTENTION_MB + TILED_VAE_DECODE_MB) * scale
+    if mode == 'model_offload':
+        return largest_mb + (batch_size * SLICED_ATTENTION_MB + TILED_VAE_DECODE_MB) * scale
+    return (SEQUENTIAL_RESIDENT_MB + batch_size * SLICED_ATTENTION_MB + TILED_VAE_DECODE_MB) * scale
+
+
+def choose_mode(device, budget_mb, weights_mb, largest_mb, batch_size, bytes_per_param=2, requested=MEMORY_MODE):
+    """MEMORY_MODE if pinned, else the least intrusive mode whose estimate fits the budget"""
+    modes = modes_for(device)
+    if requested != 'auto':
+        return requested if requested in modes else modes[-1]
+    if not budget_mb:
+        return 'full'
+    for mode in modes:
+        if estimate_mb(mode, weights_mb, largest_mb, batch_size, bytes_per_param) <= budget_mb:
+            return mode
+    return modes[-1]
+
+
+def next_mode(device, mode):
+    """The next more frugal mode, or None when already at the last one"""
+    modes = modes_for(device)
+    index = modes.index(mode) if mode in modes else len(modes) - 1
+    return modes[index + 1] if index + 1 < len(modes) else None
+
+
+def module_mb(module):
+    """Parameter and buffer memory of a torch module in MB"""
+    if module is None:
+        return 0.0
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.element_size() * t.nelement() for t in tensors) / 2 ** 20
+
+
+class PeakMemory:
+    """Measures the peak memory (MB) while the block runs; `mb` stays None where that can't be done"""
+
+    def __init__(self, device):
+        self.device = device
+        self.mb = None
+        self.measurable = True
+
+    def __enter__(self):
+        if self.device.startswith('cuda'):
+            import torch
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            # Without a reset the peak would be the whole process lifetime's
+            self.measurable = self.reset_rss_peak()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.device.startswith('cuda'):
+            import torch
+            self.mb = round(torch.cuda.max_memory_allocated(self.device) / 2 ** 20, 1)
+        elif self.measurable:
+            self.mb = self.rss_peak_mb()
+        return False
+
+    @staticmethod
+    def reset_rss_peak():
+        """Reset the process's peak RSS (Linux: writing 5 to clear_refs); False if not possible"""
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def rss_peak_mb():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Latency instrumentation for the FAIryTale image server.
+
+Every stage of a request (upload decode, reference save, queue wait, text and
+IP-Adapter encoding, denoising, VAE decode, PNG save, serving) is timed into
+the fairytale_stage_seconds histogram, exported with the other counters and
+gauges in Prometheus text format on /metrics. Each generation also carries a
+Trace of its own spans; with TRACE_REQUESTS=1 finished traces are appended as
+JSON lines to TRACE_LOG for offline digging.
+
+Standard library only, so it can be imported by every module including the
+fake benchmark backend.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACE_REQUESTS = os.getenv('TRACE_REQUESTS', '0') == '1'
+TRACE_LOG = os.getenv('TRACE_LOG', os.path.join('cache', 'traces.jsonl'))
+
+# Seconds; covers cached lookups (ms) up to slow CPU generations (minutes)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_trace_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, _format_labels(self.labelnames, key), value)
+                    for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[len(self.buckets)] += 1
+            data[-1] += value
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, data in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, data):
+                    lines.append((self.name + '_bucket', _format_labels(self.labelnames, key, [('le', bound)]), count))
+                lines.append((self.name + '_bucket', _format_labels(self.labelnames, key, [('le', '+Inf')]),
+                              data[len(self.buckets)]))
+                lines.append((self.name + '_sum', _format_labels(self.labelnames, key), round(data[-1], 6)))
+                lines.append((self.name + '_count', _format_labels(self.labelnames, key), data[len(self.buckets)]))
+        return lines
+
+
+class Collected:
+    """Values read from `collect()` -> {label values tuple: value} at scrape time; a gauge,
+    or a counter whose count lives elsewhere (e.g. cache hit counters)"""
+
+    def __init__(self, name, help_text, collect, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.kind = kind
+        _registry.append(self)
+
+    def samples(self):
+        try:
+            values = self.collect() or {}
+        except Exception as e:
+            print(f"[metrics] Collecting {self.name} failed: {e}")
+            return []
+        return [(self.name, _format_labels(self.labelnames, key), value)
+                for key, value in sorted(values.items())]
+
+
+def render():
+    """All registered metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('fairytale_stage_seconds', 'Time spent in each stage of image generation', ('stage',))
+HTTP_REQUESTS = Counter('fairytale_http_requests_total', 'HTTP requests by route, method and status',
+                        ('endpoint', 'method', 'status'))
+HTTP_SECONDS = Histogram('fairytale_http_request_seconds', 'Time to build the HTTP response', ('endpoint',))
+PEAK_MEMORY = Histogram('fairytale_batch_peak_memory_mb', 'Peak device memory (RSS on the CPU) per batch',
+                        ('device',), buckets=(256, 512, 1024, 2048, 3072, 4096, 6144, 8192, 12288, 16384, 24576))
+BATCH_SIZE = Histogram('fairytale_batch_size', 'Images per denoising batch', buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+SCHEDULER_EVENTS = Counter('fairytale_scheduler_events_total',
+                           'Batches preempted or run with fewer steps, and images that missed their latency target',
+                           ('event',))
+
+
+class Trace:
+    """Spans recorded for one generation request"""
+
+    def __init__(self, spans=None):
+        self.id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.spans = list(spans or [])
+        self.meta = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, started_at, **details):
+        span = {'stage': stage, 'start_ms': round((started_at - self.created_at) * 1000, 1),
+                'duration_ms': round(seconds * 1000, 1)}
+        span.update(details)
+        with self.lock:
+            self.spans.append(span)
+
+    def child(self):
+        """New trace sharing the spans recorded so far (e.g. one per panel of a story form)"""
+        with self.lock:
+            child = Trace(self.spans)
+        child.created_at = self.created_at
+        return child
+
+    def to_dict(self):
+        with self.lock:
+            return {'trace_id': self.id, 'created_at': self.created_at, 'meta': dict(self.meta),
+                    'spans': sorted(self.spans, key=lambda span: span['start_ms'])}
+
+
+def observe(stage, seconds, traces=(), started_at=None, **details):
+    """Record one stage duration in the histogram and on every given trace"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    started_at = started_at if started_at is not None else time.time() - seconds
+    for trace in traces:
+        if trace is not None:
+            trace.add(stage, seconds, started_at, **details)
+
+
+@contextmanager
+def span(stage, traces=(), **details):
+    """Time the enclosed block as `stage`"""
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, traces, started_at, **details)
+
+
+def finish_trace(trace, **meta):
+    """Close a request's trace; appended to TRACE_LOG when TRACE_REQUESTS=1"""
+    if trace is None:
+        return
+    trace.meta.update(meta)
+    trace.meta['total_ms'] = round((time.time() - trace.created_at) * 1000, 1)
+    if not TRACE_REQUESTS:
+        return
+    line = json.dumps(trace.to_dict())
+    with _trace_lock:
+        os.makedirs(os.path.dirname(TRACE_LOG) or '.', exist_ok=True)
+        with open(TRACE_LOG, 'a') as f:
+            f.write(line + '\n')
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Gateway from the FAIryTale image server to the Ollama running on the same box.
+
+The Node server used to probe /api/tags before every chapter and then make a
+fresh, non-streaming /api/generate call over the tunnel. /story on the image
+server does that work next to Ollama instead:
+
+- a small pool of keep-alive HTTP connections to Ollama (stale ones are
+  retried once on a fresh connection)
+- Ollama's health (/api/tags) cached for OLLAMA_HEALTH_TTL seconds, and
+  updated by real traffic in between
+- streaming: tokens are passed on as Ollama produces them
+- finished responses cached by (model, prompt, options), so regenerating a
+  chapter with the same prompt is instant
+
+Standard library only; ollama_stub.py is a stand-in Ollama for trying it out.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import metrics
+
+# Not OLLAMA_HOST: that is Ollama's listen address (0.0.0.0:11434), not somewhere to connect to
+OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'mistral')
+# Idle keep-alive connections kept open to Ollama
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', '4'))
+OLLAMA_TIMEOUT = float(os.getenv('OLLAMA_TIMEOUT', '300'))
+OLLAMA_HEALTH_TTL = float(os.getenv('OLLAMA_HEALTH_TTL', '30'))
+STORY_CACHE_SIZE = int(os.getenv('STORY_CACHE_SIZE', '512'))
+STORY_CACHE_TTL_HOURS = float(os.getenv('STORY_CACHE_TTL_HOURS', '24'))
+
+# Errors that mean a pooled keep-alive connection was closed by the other side
+_STALE_CONNECTION = (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError,
+                     ConnectionResetError, ConnectionAbortedError)
+
+
+class OllamaError(Exception):
+    """Ollama could not be reached or refused the request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections to one host, reused LIFO"""
+
+    def __init__(self, url, size=OLLAMA_POOL_SIZE, timeout=OLLAMA_TIMEOUT):
+        parsed = urlparse(url if '://' in url else f"http://{url}")
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or (443 if self.https else 80)
+        self.prefix = parsed.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        with self.lock:
+            self.created += 1
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    @contextmanager
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and yield the response; the connection goes back to the pool only if
+        the response was read to the end"""
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = dict(headers or {}, **({'Content-Type': 'application/json'} if payload else {}))
+        for attempt in range(2):
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+                if connection is not None:
+                    self.reused += 1
+            reused = connection is not None
+            connection = connection or self._connect()
+            try:
+                connection.request(method, self.prefix + path, body=payload, headers=headers)
+                response = connection.getresponse()
+            except _STALE_CONNECTION:
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            break
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        with self.lock:
+            return {'idle': len(self.idle), 'created': self.created, 'reused': self.reused}
+
+
+class OllamaGateway:
+    """Pooled, cached and streaming access to Ollama's /api/generate"""
+
+    def __init__(self, url=OLLAMA_URL, model=OLLAMA_MODEL, pool_size=OLLAMA_POOL_SIZE, timeout=OLLAMA_TIMEOUT,
+                 health_ttl=OLLAMA_HEALTH_TTL, cache_size=STORY_CACHE_SIZE, cache_ttl=STORY_CACHE_TTL_HOURS * 3600):
+        self.url = url
+        self.model = model
+        self.pool = ConnectionPool(url, pool_size, timeout)
+        self.health_ttl = health_ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # key -> (created, response text, final Ollama stats), least recently used first
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generations = 0
+        self.errors = 0
+        self.health_status = None
+        self.health_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+    def health(self, force=False):
+        """Whether Ollama answers and which models it has, re-probed at most every health_ttl seconds"""
+        with self.health_lock:
+            status = self.health_status
+            if not force and status and time.time() - status['checked_at'] < self.health_ttl:
+                return status
+            start = time.perf_counter()
+            try:
+                with self.pool.request('GET', '/api/tags') as response:
+                    body = json.loads(response.read() or b'{}')
+                if response.status != 200:
+                    raise OllamaError(f"Ollama answered {response.status}")
+                models = [model.get('name') for model in body.get('models', [])]
+                self._set_health(True, models=models)
+            except (OSError, ValueError, http.client.HTTPException, OllamaError) as e:
+                self._set_health(False, error=str(e))
+            self.health_status['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            return self.health_status
+
+    def _set_health(self, available, error=None, models=None):
+        previous = self.health_status or {}
+        self.health_status = {
+            'available': available,
+            'url': self.url,
+            'models': models if models is not None else previous.get('models', []),
+            'error': error,
+            'checked_at': time.time(),
+        }
+
+    def _note_result(self, error=None):
+        """Real traffic is fresher than the last probe"""
+        with self.health_lock:
+            if error is None:
+                if not (self.health_status and self.health_status['available']):
+                    self._set_health(True)
+            else:
+                self._set_health(False, error=error)
+
+    def cache_key(self, model, prompt, options=None):
+        data = json.dumps([model, prompt, options or {}], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and time.time() - entry[0] > self.cache_ttl:
+                del self.cache[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _remember(self, key, text, final):
+        with self.lock:
+            self.cache[key] = (time.time(), text, final)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def generate(self, prompt, model=None, options=None, refresh=False):
+        """Whole response as Ollama's non-streaming /api/generate returns it, plus 'cached'"""
+        text = []
+        final = {}
+        for event in self.stream(prompt, model, options, refresh):
+            if event.get('done'):
+                final = event
+            else:
+                text.append(event['response'])
+        return dict(final, response=''.join(text) + final.get('response', ''))
+
+    def stream(self, prompt, model=None, options=None, refresh=False):
+        """Yield Ollama-style events ({'response': text, 'done': False} ..., then a 'done' one);
+        refresh=True skips the cache lookup (the new answer is still cached)"""
+        model = model or self.model
+        key = self.cache_key(model, prompt, options)
+        entry = None if refresh else self._cached(key)
+        if entry is not None:
+            _, text, final = entry
+            yield {'model': model, 'response': text, 'done': False}
+            yield dict(final, model=model, response='', done=True, cached=True)
+            return
+
+        body = {'model': model, 'prompt': prompt, 'stream': True}
+        if options:
+            body['options'] = options
+        start = time.perf_counter()
+        first_token = None
+        parts = []
+        try:
+            with self.pool.request('POST', '/api/generate', body) as response:
+                if response.status != 200:
+                    raise OllamaError(self._error_message(response), 404 if response.status == 404 else 502)
+                final = {}
+                for line in iter(response.readline, b''):
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event.get('error'):
+                        raise OllamaError(event['error'])
+                    if event.get('response'):
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                            metrics.observe('ollama_first_token', first_token)
+                        parts.append(event['response'])
+                        yield {'model': model, 'response': event['response'], 'done': False}
+                    if event.get('done'):
+                        final = {k: v for k, v in event.items() if k not in ('response', 'context')}
+                        # Leave the body fully read so the connection can be reused
+                        response.read()
+                        break
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            self.errors += 1
+            self._note_result(error=str(e))
+            raise OllamaError(f"Ollama is not reachable at {self.url}: {e}", 503)
+        except OllamaError:
+            self.errors += 1
+            raise
+        self._note_result()
+        metrics.observe('ollama_generate', time.perf_counter() - start)
+        self.generations += 1
+        self._remember(key, ''.join(parts), final)
+        yield dict(final, model=model, response='', done=True, cached=False)
+
+    @staticmethod
+    def _error_message(response):
+        body = response.read()
+        try:
+            return json.loads(body).get('error') or f"Ollama answered {response.status}"
+        except ValueError:
+            return body.decode('utf-8', 'replace')[:200] or f"Ollama answered {response.status}"
+
+    def stats(self):
+        """Cache, pool and health summary for /health"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            cache = {'entries': len(self.cache), 'max_entries': self.cache_size, 'hits': self.hits,
+                     'misses': self.misses, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0}
+        return {
+            'url': self.url,
+            'model': self.model,
+            'health': self.health_status,
+            'generations': self.generations,
+            'errors': self.errors,
+            'cache': cache,
+            'pool': self.pool.stats(),
+        }
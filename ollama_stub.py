@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Stand-in for Ollama, for trying /story (and benchmarks) without a language model.
+
+Answers /api/tags and /api/generate (streaming NDJSON or not) with a
+deterministic chapter in the JSON shape ollama.ts asks for, one word per
+token every --token-ms milliseconds. Keeps connections alive like Ollama
+and counts requests and connections on /stub/stats.
+
+  python ollama_stub.py --port 11435 --token-ms 20
+  OLLAMA_URL=http://localhost:11435 python local_ai_server.py
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCENES = [
+    "exploring a glowing forest path under tall silver trees",
+    "sailing a tiny boat across a calm moonlit lake",
+    "climbing a spiral staircase inside an old stone tower",
+    "talking with a friendly fox beside a sparkling river",
+]
+
+stats = {'requests': 0, 'generate': 0, 'connections': 0}
+_stats_lock = threading.Lock()
+
+
+def chapter_for(prompt):
+    """Deterministic chapter JSON text for a prompt"""
+    digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+    scene = SCENES[digest[0] % len(SCENES)]
+    chapter = {
+        'sceneDescription': f"hero {scene}",
+        'content': f"Once upon a time our hero set out {scene}. Every step brought a new surprise, "
+                   f"and by sunset they had made a brave new friend (story {digest[:4].hex()}).",
+        'choices': {
+            'optionA': {'text': "Follow the glowing path", 'statChanges': {'courage': 5}},
+            'optionB': {'text': "Help the lost creature", 'statChanges': {'kindness': 5}},
+        },
+    }
+    return json.dumps(chapter, indent=2)
+
+
+def tokens(text):
+    """Split text into word-ish tokens that concatenate back to it"""
+    out = []
+    current = ''
+    for char in text:
+        current += char
+        if char in ' \n':
+            out.append(current)
+            current = ''
+    if current:
+        out.append(current)
+    return out
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    token_seconds = 0.02
+
+    def setup(self):
+        super().setup()
+        with _stats_lock:
+            stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with _stats_lock:
+            stats['requests'] += 1
+        if self.path == '/api/tags':
+            self._json(200, {'models': [{'name': 'mistral:latest'}]})
+        elif self.path == '/stub/stats':
+            with _stats_lock:
+                self._json(200, dict(stats))
+        else:
+            self._json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        with _stats_lock:
+            stats['requests'] += 1
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._json(400, {'error': 'invalid JSON'})
+        if self.path != '/api/generate':
+            return self._json(404, {'error': 'not found'})
+        if not str(body.get('model', '')).startswith('mistral'):
+            return self._json(404, {'error': f"model '{body.get('model')}' not found"})
+        with _stats_lock:
+            stats['generate'] += 1
+
+        started = time.time()
+        parts = tokens(chapter_for(body.get('prompt', '')))
+        model = body['model']
+        if not body.get('stream', True):
+            time.sleep(self.token_seconds * len(parts))
+            return self._json(200, {'model': model, 'response': ''.join(parts), 'done': True,
+                                    'eval_count': len(parts)})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for part in parts:
+                time.sleep(self.token_seconds)
+                self._chunk({'model': model, 'response': part, 'done': False})
+            self._chunk({'model': model, 'response': '', 'done': True, 'eval_count': len(parts),
+                         'total_duration': int((time.time() - started) * 1e9)})
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, as Ollama sees when a reader closes the page
+            self.close_connection = True
+
+    def _chunk(self, event):
+        data = (json.dumps(event) + '\n').encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--token-ms', type=float, default=20.0, help="delay per streamed token")
+    args = parser.parse_args()
+    StubHandler.token_seconds = args.token_ms / 1000.0
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"[stub] Fake Ollama on http://{args.host}:{args.port} ({args.token_ms}ms/token)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Content-addressed store of character reference images.
+
+Uploads (multipart files or base64 data URLs) are streamed in chunks to a temp
+file while being hashed, then renamed to <sha256>.png, so every distinct
+picture is written once however many chapters send it. Clients that already
+know the hash can send it as `reference_id` (HEAD /references/<id> tells them
+whether the server still has it) instead of re-uploading the bytes.
+
+References unused for REFERENCE_TTL_HOURS are removed, and the least recently
+used ones go first when the store exceeds REFERENCE_STORE_MAX_MB. References
+pinned by queued or running jobs are never evicted.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+REFERENCE_DIR = os.path.join('cache', 'references')
+REFERENCE_STORE_MAX_MB = int(os.getenv('REFERENCE_STORE_MAX_MB', '256'))
+REFERENCE_TTL_HOURS = float(os.getenv('REFERENCE_TTL_HOURS', '168'))
+# Bytes read (or base64 characters decoded) at a time; a multiple of 4 for base64
+CHUNK_SIZE = 256 * 1024
+# Expired references are also swept on lookups, at most this often
+SWEEP_INTERVAL = 60
+
+_REFERENCE_ID = re.compile(r'[0-9a-f]{64}')
+
+
+class InvalidReference(ValueError):
+    """Raised when an upload is empty, not valid base64 or not an image"""
+
+
+def is_reference_id(value):
+    """Whether value looks like a reference id (lowercase hex sha256)"""
+    return bool(value) and _REFERENCE_ID.fullmatch(value) is not None
+
+
+class ReferenceStore:
+    """Deduplicated, size- and age-bounded directory of reference images"""
+
+    def __init__(self, root=REFERENCE_DIR, max_bytes=REFERENCE_STORE_MAX_MB * 1024 * 1024,
+                 ttl=REFERENCE_TTL_HOURS * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # id -> {'size': bytes, 'last_used': unix time}, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # id -> number of jobs still using the file
+        self.pins = {}
+        self.stored = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        self.last_sweep = time.time()
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def path_for(self, reference_id):
+        return os.path.join(self.root, f"{reference_id}.png")
+
+    def put_stream(self, stream):
+        """Store a file-like upload without holding it in memory; returns its reference id"""
+        digest = hashlib.sha256()
+        tmp_path = self._tmp_path()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._check_image(tmp_path, size)
+        return self._commit(tmp_path, digest.hexdigest(), size)
+
+    def put_base64(self, data):
+        """Store a base64 string or data URL, decoding it a chunk at a time"""
+        encoded = data.split(',', 1)[1] if data.startswith('data:') else data
+        if any(c in encoded for c in ' \r\n\t'):
+            encoded = ''.join(encoded.split())
+        digest = hashlib.sha256()
+        tmp_path = self._tmp_path()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for start in range(0, len(encoded), CHUNK_SIZE):
+                    try:
+                        chunk = base64.b64decode(encoded[start:start + CHUNK_SIZE], validate=True)
+                    except binascii.Error as e:
+                        raise InvalidReference(f"not valid base64 ({e})")
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._check_image(tmp_path, size)
+        return self._commit(tmp_path, digest.hexdigest(), size)
+
+    def _check_image(self, tmp_path, size):
+        """Refuse (and delete) an upload that is empty or that PIL can't read as an image"""
+        from PIL import Image
+
+        try:
+            if not size:
+                raise InvalidReference("empty upload")
+            try:
+                with Image.open(tmp_path) as image:
+                    image.verify()
+            except Exception:
+                raise InvalidReference("not a readable image")
+        except InvalidReference:
+            self._remove(tmp_path)
+            raise
+
+    def get(self, reference_id):
+        """Path of a stored reference (marking it as used), or None"""
+        if not is_reference_id(reference_id):
+            return None
+        with self.lock:
+            if time.time() - self.last_sweep > SWEEP_INTERVAL:
+                self._evict()
+            entry = self.entries.get(reference_id)
+            if entry is None:
+                return None
+            path = self.path_for(reference_id)
+            if not os.path.exists(path):
+                # Removed behind our back
+                self._drop(reference_id)
+                return None
+            self._touch(reference_id)
+            return path
+
+    def pin(self, reference_id):
+        """Keep a reference on disk while a job needs it"""
+        with self.lock:
+            self.pins[reference_id] = self.pins.get(reference_id, 0) + 1
+
+    def unpin(self, reference_id):
+        with self.lock:
+            count = self.pins.get(reference_id, 0) - 1
+            if count > 0:
+                self.pins[reference_id] = count
+            else:
+                self.pins.pop(reference_id, None)
+
+    def _commit(self, tmp_path, reference_id, size):
+        path = self.path_for(reference_id)
+        with self.lock:
+            if reference_id in self.entries and os.path.exists(path):
+                self._remove(tmp_path)
+                self.deduplicated += 1
+            else:
+                if reference_id in self.entries:
+                    self._drop(reference_id)
+                os.replace(tmp_path, path)
+                self.entries[reference_id] = {'size': size, 'last_used': time.time()}
+                self.total_bytes += size
+                self.stored += 1
+            self._touch(reference_id)
+            self._evict(keep=reference_id)
+        return reference_id
+
+    def _touch(self, reference_id):
+        now = time.time()
+        self.entries[reference_id]['last_used'] = now
+        self.entries.move_to_end(reference_id)
+        try:
+            # mtime is the last-used time that survives a restart
+            os.utime(self.path_for(reference_id), (now, now))
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        """Drop expired references, then least recently used ones until under budget"""
+        now = time.time()
+        self.last_sweep = now
+        for reference_id, entry in list(self.entries.items()):
+            if now - entry['last_used'] <= self.ttl:
+                # Entries are in last-used order, so the rest are fresher
+                break
+            if reference_id not in self.pins and reference_id != keep:
+                self._evict_one(reference_id)
+        for reference_id in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if reference_id not in self.pins and reference_id != keep:
+                self._evict_one(reference_id)
+
+    def _evict_one(self, reference_id):
+        self._drop(reference_id)
+        self._remove(self.path_for(reference_id))
+        self.evictions += 1
+
+    def _drop(self, reference_id):
+        entry = self.entries.pop(reference_id)
+        self.total_bytes -= entry['size']
+
+    def _scan(self):
+        """Rebuild the index from the directory, oldest first; leftover temp files are removed"""
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.tmp'):
+                self._remove(path)
+                continue
+            reference_id, ext = os.path.splitext(name)
+            if ext == '.png' and is_reference_id(reference_id):
+                stat = os.stat(path)
+                found.append((stat.st_mtime, reference_id, stat.st_size))
+        for last_used, reference_id, size in sorted(found):
+            self.entries[reference_id] = {'size': size, 'last_used': last_used}
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    def _tmp_path(self):
+        return os.path.join(self.root, f"upload_{uuid.uuid4().hex}.tmp")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        """Size and dedup counters for /health"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_hours': round(self.ttl / 3600, 2),
+                'pinned': len(self.pins),
+                'stored': self.stored,
+                'deduplicated': self.deduplicated,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Offline batch renderer for whole storybooks (gallery seeding, curated stories).
+
+Reads a JSONL manifest with one story per line and renders every panel on one
+warm engine. Panels of all stories are sorted by style, character reference
+and sampler settings and cut into batches of --batch-size, so LoRA switches
+are rare, a character's IP-Adapter embedding is computed once, and the UNet
+denoises several panels per pass.
+
+Manifest line (only "scenes" or "story" is required):
+  {"id": "pip-forest", "character": "Pip the fox", "reference": "refs/pip.png",
+   "scenes": ["walks into the forest", "finds a glowing map"],
+   "seed": 42, "style": "fantasy", "steps": 25, "scale": 7.5}
+"story" is a comma-separated scene list like app.py's --story, "style" a genre
+from the style registry and "lora" an explicit LoRA file (or "none").
+Reference paths are relative to the manifest.
+
+Panels are written to OUTPUT_DIR/<id>/00.png, 01.png, ... and recorded in
+OUTPUT_DIR/checkpoint.json after every batch; running the same command again
+skips the panels already there, so an interrupted run resumes where it
+stopped. A panel whose prompt, seed or settings changed is rendered again.
+
+Examples:
+  python render_storybook.py stories.jsonl --output-dir renders
+  python render_storybook.py stories.jsonl --backend fake --batch-size 4
+  python render_storybook.py stories.jsonl --model ./tiny-sd --device cpu --steps 15
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+class Panel:
+    """One image of a story, with everything that decides what it looks like"""
+
+    def __init__(self, story_id, index, prompt, reference, reference_key, seed, steps, scale, style_lora):
+        self.story_id = story_id
+        self.index = index
+        self.prompt = prompt
+        self.reference = reference
+        self.reference_key = reference_key
+        self.seed = seed
+        self.steps = steps
+        self.scale = scale
+        self.style_lora = style_lora
+
+    @property
+    def key(self):
+        return f"{self.story_id}/{self.index:02}"
+
+    @property
+    def filename(self):
+        return os.path.join(self.story_id, f"{self.index:02}.png")
+
+    def digest(self, model_id):
+        parts = [model_id, self.prompt, self.reference_key, self.seed, self.steps, self.scale, self.style_lora]
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def group_key(self):
+        """Sort order: panels that can share a batch, and then a reference, end up next to each other"""
+        return (self.style_lora or '', self.steps, self.scale, self.reference is not None,
+                self.reference_key or '', self.story_id, self.index)
+
+
+def read_manifest(path, work_dir, defaults):
+    """Panels of every story in a JSONL manifest, in manifest order"""
+    from result_cache import file_sha256
+    from style_registry import style_for_genre
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    panels = []
+    story_ids = set()
+    reference_keys = {}
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                story = json.loads(line)
+            except ValueError as e:
+                raise SystemExit(f"{path}:{line_number}: not valid JSON ({e})")
+            story_id = _safe_id(str(story.get('id') or f"story-{line_number:04}"))
+            if story_id in story_ids:
+                raise SystemExit(f"{path}:{line_number}: duplicate story id '{story_id}'")
+            story_ids.add(story_id)
+
+            character = story.get('character', 'hero')
+            # Same prompts as app.py's build_story_prompts, one per scene
+            scenes = story.get('scenes') or story.get('story', '').split(',')
+            prompts = [f"{character}, {scene.strip()}" for scene in scenes if scene.strip()]
+            if not prompts:
+                raise SystemExit(f"{path}:{line_number}: story '{story_id}' has no scenes")
+
+            reference = story.get('reference')
+            if reference:
+                reference = os.path.join(base_dir, reference)
+                if not os.path.exists(reference):
+                    raise SystemExit(f"{path}:{line_number}: reference image not found: {reference}")
+                if reference not in reference_keys:
+                    reference_keys[reference] = file_sha256(reference)
+
+            if 'lora' in story:
+                style_lora = None if str(story['lora']).lower() in ('', 'none') else story['lora']
+            else:
+                style_lora = style_for_genre(story.get('style'), work_dir)
+
+            seed = int(story.get('seed', defaults.seed))
+            steps = int(story.get('steps', defaults.steps))
+            scale = float(story.get('scale', defaults.scale))
+            for index, prompt in enumerate(prompts):
+                panels.append(Panel(story_id, index, prompt, reference, reference_keys.get(reference),
+                                    seed, steps, scale, style_lora))
+    return panels
+
+
+def _safe_id(story_id):
+    """Story ids become directory names"""
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in story_id).strip('.') or 'story'
+
+
+def plan_batches(panels, batch_size):
+    """Cut the sorted panels into batches the engine can run in one call (equal batch_key)"""
+    from generation import GenerationRequest
+
+    batches = []
+    current = []
+    current_key = None
+    for panel in sorted(panels, key=Panel.group_key):
+        key = GenerationRequest(panel.prompt, reference=panel.reference, steps=panel.steps, scale=panel.scale,
+                                style_lora=panel.style_lora).batch_key()
+        if current and (key != current_key or len(current) >= batch_size):
+            batches.append(current)
+            current = []
+        current.append(panel)
+        current_key = key
+    if current:
+        batches.append(current)
+    return batches
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {'done': {}, 'runs': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically, so an interrupt never leaves half a file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def make_engine(args):
+    from worker_pool import detect_device, engine_class
+
+    device = args.device
+    if device == 'auto':
+        device = 'cpu' if args.backend == 'fake' else detect_device()
+    engine = engine_class(args.backend)(args.work_dir, device=device, num_threads=args.threads)
+    engine.bind_thread()
+    start = time.perf_counter()
+    engine.load()
+    engine.warmup()
+    print(f"[render] {args.backend} engine ready on {engine.device} in {time.perf_counter() - start:.1f}s")
+    return engine
+
+
+def render(args):
+    from generation import GenerationRequest
+
+    panels = read_manifest(args.manifest, args.work_dir, args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(args.output_dir, CHECKPOINT_FILE)
+    checkpoint = load_checkpoint(checkpoint_path)
+    engine = make_engine(args)
+
+    done = checkpoint['done']
+    todo = [p for p in panels
+            if done.get(p.key, {}).get('digest') != p.digest(engine.model_id)
+            or not os.path.exists(os.path.join(args.output_dir, p.filename))]
+    batches = plan_batches(todo, args.batch_size)
+    print(f"[render] {len(panels)} panels in {len({p.story_id for p in panels})} stories: "
+          f"{len(panels) - len(todo)} already rendered, {len(todo)} to go in {len(batches)} batches")
+
+    rendered = 0
+    interrupted = False
+    start = time.perf_counter()
+    try:
+        for number, batch in enumerate(batches, 1):
+            requests = [GenerationRequest(p.prompt, reference=p.reference, reference_key=p.reference_key,
+                                          seed=p.seed, steps=p.steps, scale=p.scale, style_lora=p.style_lora)
+                        for p in batch]
+            batch_start = time.perf_counter()
+            images = engine.generate_batch(requests)
+            seconds = time.perf_counter() - batch_start
+            for panel, image in zip(batch, images):
+                path = os.path.join(args.output_dir, panel.filename)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                image.save(path)
+                done[panel.key] = {'file': panel.filename, 'prompt': panel.prompt, 'seed': panel.seed,
+                                   'steps': panel.steps, 'style_lora': panel.style_lora,
+                                   'digest': panel.digest(engine.model_id),
+                                   'seconds': round(seconds / len(batch), 3)}
+            rendered += len(batch)
+            save_checkpoint(checkpoint_path, checkpoint)
+            elapsed = time.perf_counter() - start
+            print(f"[render] Batch {number}/{len(batches)}: {len(batch)} panels in {seconds:.2f}s "
+                  f"({rendered}/{len(todo)}, {rendered / elapsed:.2f} images/s)")
+    except KeyboardInterrupt:
+        interrupted = True
+        print("[render] Interrupted; run the same command again to resume")
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        'finished_at': time.time(),
+        'backend': args.backend,
+        'device': engine.device,
+        'model': engine.model_id,
+        'batch_size': args.batch_size,
+        'rendered': rendered,
+        'skipped': len(panels) - len(todo),
+        'remaining': len(todo) - rendered,
+        'seconds': round(elapsed, 2),
+        'images_per_second': round(rendered / elapsed, 3) if elapsed and rendered else 0.0,
+    }
+    checkpoint['runs'].append(summary)
+    save_checkpoint(checkpoint_path, checkpoint)
+    print(f"[render] {rendered} images in {elapsed:.1f}s: {summary['images_per_second']} images/s "
+          f"({summary['skipped']} skipped, {summary['remaining']} remaining)")
+    return 130 if interrupted else 0
+
+
+def parse_args():
+    from worker_pool import DEVICE, ENGINE_BACKEND
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help="JSONL file, one story per line")
+    parser.add_argument('--output-dir', default='storybooks')
+    parser.add_argument('--backend', choices=['diffusers', 'fake'], default=ENGINE_BACKEND,
+                        help="fake renders placeholder images without weights (ENGINE_BACKEND)")
+    parser.add_argument('--model', help="model path or id (SD_MODEL_ID)")
+    parser.add_argument('--device', default=DEVICE, help="cuda, cuda:1, cpu or auto (SD_DEVICE)")
+    parser.add_argument('--threads', type=int, help="torch threads on the CPU (default: all cores)")
+    parser.add_argument('--batch-size', type=int, default=4, help="panels per denoising pass")
+    parser.add_argument('--seed', type=int, default=1234, help="seed for stories without one")
+    parser.add_argument('--steps', type=int, default=25, help="steps for stories without 'steps'")
+    parser.add_argument('--scale', type=float, default=7.5, help="guidance for stories without 'scale'")
+    parser.add_argument('--work-dir', default='.', help="directory holding loras/ (default: here)")
+    return parser.parse_args()
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    args = parse_args()
+    if args.batch_size < 1:
+        raise SystemExit("--batch-size must be at least 1")
+    if args.model:
+        # Read when story_engine is imported, which happens only once the engine is made
+        os.environ['SD_MODEL_ID'] = args.model
+    sys.exit(render(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of generated story images.
+
+Images are keyed on everything that determines the output (prompt, character,
+seed, steps, guidance scale, LoRA style, model and a hash of the reference
+image), so re-reading a story or regenerating a chapter with the same scene
+is answered from disk instead of re-running the diffusion.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RESULT_CACHE_MAX_MB = int(os.getenv('RESULT_CACHE_MAX_MB', '512'))
+
+
+def file_sha256(path):
+    """Hash a file's bytes in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU of result images stored in the served image directory"""
+
+    def __init__(self, image_dir, index_path, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024, delete_files=True):
+        self.image_dir = image_dir
+        # False when another owner (the image store) decides how long the files live: eviction
+        # then only forgets the entry, so a story still showing the image keeps its file
+        self.delete_files = delete_files
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        # key -> {'size': bytes, 'last_used': unix time}, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(image_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def key_for(**parts):
+        """Stable key from the generation inputs"""
+        payload = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def filename_for(key):
+        return f"result_{key}.png"
+
+    def path_for(self, key):
+        return os.path.join(self.image_dir, self.filename_for(key))
+
+    def lookup(self, key):
+        """Filename of a cached result, or None; counts as a hit or a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and os.path.exists(self.path_for(key)):
+                entry['last_used'] = time.time()
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.filename_for(key)
+            if entry is not None:
+                # File was removed behind our back
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def record(self, key):
+        """Register a result just written to path_for(key) and evict down to the budget"""
+        size = os.path.getsize(self.path_for(key))
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = {'size': size, 'last_used': time.time()}
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                self._drop(oldest)
+                if self.delete_files:
+                    self._remove_file(oldest)
+                self.evictions += 1
+            self._save_index()
+
+    def forget(self, filename):
+        """Drop the entry of an image the image store's retention deleted"""
+        key = filename[len('result_'):-len('.png')] if filename.startswith('result_') else None
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+                self._save_index()
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            pass
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[result-cache] Ignoring unreadable index {self.index_path}: {e}")
+            return
+        for key, entry in sorted(stored.items(), key=lambda item: item[1]['last_used']):
+            if os.path.exists(self.path_for(key)):
+                self.entries[key] = entry
+                self.total_bytes += entry['size']
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def stats(self):
+        """Hit/miss counters and size for /health"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+            }
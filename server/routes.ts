@@ -6,7 +6,7 @@ import {
   insertStorySchema,
   insertStoryChapterSchema 
 } from "@shared/schema";
-import { generateStoryChapter, generateStoryImage } from "./services/ollama";
+import { generateChapterWithImage, generateStoryChapter, generateStoryImage } from "./services/ollama";
 import { z } from "zod";
 
 export async function registerRoutes(app: Express): Promise<Server> {
@@ -165,30 +165,45 @@ export async function registerRoutes(app: Express): Promise<Server> {
         .map(ch => ch.content)
         .join('\n\n');
       
-      // Generate new chapter with context
-      const storyChapter = await generateStoryChapter({
-        ...request,
-        previousContent,
-      });
-      
+      // Always get character data to ensure image reference is available
+      const character = await storage.getCharacter(story.characterId);
+      const characterImageUrl = character?.imageUrl || request.characterImageUrl;
+      console.log('Generating image with character reference:', characterImageUrl);
+      console.log('Character data:', character ? `${character.name} (${character.type})` : 'No character found');
+
       // Determine if this chapter should have choices (every 2-3 chapters)
       const hasChoices = request.chapterNumber % 3 === 0 && request.chapterNumber < 8;
-      
-      // Generate image for the chapter with character reference
+
+      // Text and image together when the image server can overlap them
+      const pipelined = await generateChapterWithImage({ ...request, previousContent }, characterImageUrl, storyId);
+      let storyChapter;
       let imageUrl = null;
-      try {
-        // Always get character data to ensure image reference is available
-        const character = await storage.getCharacter(story.characterId);
-        const characterImageUrl = character?.imageUrl || request.characterImageUrl;
-        
-        console.log('Generating image with character reference:', characterImageUrl);
-        console.log('Character data:', character ? `${character.name} (${character.type})` : 'No character found');
-        
-        // Use scene description if available, otherwise use story content
-        const imageDescription = storyChapter.sceneDescription || storyChapter.content;
-        imageUrl = await generateStoryImage(imageDescription, characterImageUrl, request.genre, request.characterName, request.characterType);
-      } catch (imageError) {
-        console.error('Failed to generate image:', imageError);
+      if (pipelined) {
+        storyChapter = pipelined.chapter;
+        imageUrl = pipelined.imageUrl || null;
+        if (!imageUrl) {
+          // The text came through but the image didn't: only the image is made again
+          try {
+            imageUrl = await generateStoryImage(storyChapter.sceneDescription || storyChapter.content, characterImageUrl, request.genre, request.characterName, request.characterType, storyId);
+          } catch (imageError) {
+            console.error('Failed to generate image:', imageError);
+          }
+        }
+      } else {
+        // Generate new chapter with context
+        storyChapter = await generateStoryChapter({
+          ...request,
+          previousContent,
+        });
+
+        // Generate image for the chapter with character reference
+        try {
+          // Use scene description if available, otherwise use story content
+          const imageDescription = storyChapter.sceneDescription || storyChapter.content;
+          imageUrl = await generateStoryImage(imageDescription, characterImageUrl, request.genre, request.characterName, request.characterType, storyId);
+        } catch (imageError) {
+          console.error('Failed to generate image:', imageError);
+        }
       }
       
       // Save chapter to database
@@ -2,6 +2,7 @@ import { exec } from 'child_process';
 import { promisify } from 'util';
 import * as fs from 'fs';
 import * as path from 'path';
+import { createHash } from 'crypto';
 
 const execAsync = promisify(exec);
 
@@ -133,23 +134,102 @@ function generateFallbackStory(request: StoryGenerationRequest): StoryChapterRes
   };
 }
 
-export async function generateStoryChapter(request: StoryGenerationRequest): Promise<StoryChapterResponse> {
+// Parse the model's text into a chapter, filling in a scene description and choices when missing
+function parseChapterResponse(content: string, request: StoryGenerationRequest, shouldIncludeChoices: boolean): StoryChapterResponse {
+  const jsonMatch = content.match(/\{[\s\S]*\}/);
+  let parsedResult: any = null;
+  if (jsonMatch) {
+    try {
+      parsedResult = JSON.parse(jsonMatch[0]);
+    } catch (error) {
+      console.log('Chapter is not valid JSON, keeping its text:', (error as Error).message);
+    }
+  }
+  if (parsedResult) {
+
+    // Ensure scene description exists
+    if (!parsedResult.sceneDescription && parsedResult.content) {
+      const sentences = parsedResult.content.split(/[.!?]+/).filter((s: string) => s.trim().length > 0);
+      const firstSentence = sentences[0] || parsedResult.content;
+      parsedResult.sceneDescription = `${request.characterName} the ${request.characterType} ${firstSentence.toLowerCase().substring(0, 100).replace(/[^\w\s]/g, ' ').trim()}`;
+    }
+
+    return parsedResult as StoryChapterResponse;
+  }
+
+  // Fallback if no usable JSON: the content field if it can be picked out, else the whole text
+  const contentMatch = content.match(/"content"\s*:\s*("(?:[^"\\]|\\.)*")/);
+  let text = content.trim();
+  if (contentMatch) {
+    try {
+      text = JSON.parse(contentMatch[1]);
+    } catch (error) {
+      // Keep the raw text
+    }
+  }
+  const fallbackSceneDesc = `${request.characterName} the ${request.characterType} in a magical adventure scene`;
+  return {
+    content: text || "The adventure continues...",
+    sceneDescription: fallbackSceneDesc,
+    ...(shouldIncludeChoices && {
+      choices: {
+        optionA: {
+          text: "Continue the adventure"
+        },
+        optionB: {
+          text: "Try something different"
+        }
+      }
+    })
+  };
+}
+
+// Story text through the image server's /story gateway, which sits next to Ollama and keeps
+// pooled connections, a cached health check and a response cache. Null when the gateway
+// can't help (not configured, Ollama down), so the caller falls back.
+async function generateViaGateway(prompt: string): Promise<string | null> {
+  const gatewayUrl = process.env.STORY_GATEWAY_URL;
+  if (!gatewayUrl) {
+    return null;
+  }
   try {
-    // Check if Ollama is available
-    const ollamaAvailable = await isOllamaAvailable();
-    
-    if (!ollamaAvailable) {
-      console.log('Ollama not available, using fallback story generation');
-      return generateFallbackStory(request);
+    const response = await fetch(`${gatewayUrl}/story`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'ngrok-skip-browser-warning': 'true'
+      },
+      body: JSON.stringify({
+        model: 'mistral',
+        prompt: prompt,
+        stream: false
+      })
+    });
+    if (!response.ok) {
+      console.log('Story gateway unavailable:', response.status);
+      return null;
+    }
+    const result = await response.json();
+    if (result.cached) {
+      console.log('Story gateway answered from its cache');
     }
+    return result.response;
+  } catch (error: any) {
+    console.log('Story gateway not accessible:', error?.message || error);
+    return null;
+  }
+}
 
-    // Only add choices every 2-3 chapters, not every chapter
-    const shouldIncludeChoices = request.chapterNumber % 3 === 0 || request.chapterNumber === 1;
-    
-    const statsText = request.characterStats ? 
-      `Character stats: Courage ${request.characterStats.courage}/100, Kindness ${request.characterStats.kindness}/100, Wisdom ${request.characterStats.wisdom}/100, Creativity ${request.characterStats.creativity}/100, Strength ${request.characterStats.strength}/100, Friendship ${request.characterStats.friendship}/100.` : '';
+// The chapter prompt. sceneDescription comes first in the JSON so /chapter can start the
+// illustration while the model is still writing the chapter text.
+function buildChapterPrompt(request: StoryGenerationRequest): { prompt: string; shouldIncludeChoices: boolean } {
+  // Only add choices every 2-3 chapters, not every chapter
+  const shouldIncludeChoices = request.chapterNumber % 3 === 0 || request.chapterNumber === 1;
+  
+  const statsText = request.characterStats ? 
+    `Character stats: Courage ${request.characterStats.courage}/100, Kindness ${request.characterStats.kindness}/100, Wisdom ${request.characterStats.wisdom}/100, Creativity ${request.characterStats.creativity}/100, Strength ${request.characterStats.strength}/100, Friendship ${request.characterStats.friendship}/100.` : '';
 
-    const prompt = `You are a children's story writer creating engaging, age-appropriate stories for kids aged 6-12. 
+  const prompt = `You are a children's story writer creating engaging, age-appropriate stories for kids aged 6-12. 
 Create chapter ${request.chapterNumber} of a ${request.genre} story featuring ${request.characterName}, a ${request.characterType} with the personality: ${request.personality}.
 ${statsText}
 ${request.previousChoice ? `Previous choice made: ${request.previousChoice}` : ''}
@@ -162,8 +242,8 @@ IMPORTANT: Also generate a short scene description (20-30 words, no commas) desc
 
 Format your response as JSON with this structure:
 {
-  "content": "story content here",
-  "sceneDescription": "character action and location in 20-30 words without commas"${shouldIncludeChoices ? `,
+  "sceneDescription": "character action and location in 20-30 words without commas",
+  "content": "story content here"${shouldIncludeChoices ? `,
   "choices": {
     "optionA": {
       "text": "One sentence what character will do",
@@ -190,6 +270,27 @@ Format your response as JSON with this structure:
   }` : ''}
 }`;
 
+  return { prompt, shouldIncludeChoices };
+}
+
+export async function generateStoryChapter(request: StoryGenerationRequest): Promise<StoryChapterResponse> {
+  try {
+    const { prompt, shouldIncludeChoices } = buildChapterPrompt(request);
+
+    // The gateway checks Ollama's health itself, so there is no separate probe round trip
+    const gatewayContent = await generateViaGateway(prompt);
+    if (gatewayContent !== null) {
+      return parseChapterResponse(gatewayContent, request, shouldIncludeChoices);
+    }
+
+    // Check if Ollama is available
+    const ollamaAvailable = await isOllamaAvailable();
+
+    if (!ollamaAvailable) {
+      console.log('Ollama not available, using fallback story generation');
+      return generateFallbackStory(request);
+    }
+
     // Check for remote Ollama endpoint
     const remoteOllamaUrl = process.env.OLLAMA_HOST || process.env.REMOTE_OLLAMA_URL;
     
@@ -210,75 +311,13 @@ Format your response as JSON with this structure:
       
       if (response.ok) {
         const result = await response.json();
-        const content = result.response;
-        
-        // Try to parse JSON from the response
-        const jsonMatch = content.match(/\{[\s\S]*\}/);
-        if (jsonMatch) {
-          const parsedResult = JSON.parse(jsonMatch[0]);
-          
-          // Ensure scene description exists
-          if (!parsedResult.sceneDescription && parsedResult.content) {
-            const sentences = parsedResult.content.split(/[.!?]+/).filter(s => s.trim().length > 0);
-            const firstSentence = sentences[0] || parsedResult.content;
-            parsedResult.sceneDescription = `${request.characterName} the ${request.characterType} ${firstSentence.toLowerCase().substring(0, 100).replace(/[^\w\s]/g, ' ').trim()}`;
-          }
-          
-          return parsedResult as StoryChapterResponse;
-        }
-        
-        // Fallback if no JSON found
-        const fallbackSceneDesc = `${request.characterName} the ${request.characterType} in a magical adventure scene`;
-        return {
-          content: content.trim() || "The adventure continues...",
-          sceneDescription: fallbackSceneDesc,
-          ...(shouldIncludeChoices && {
-            choices: {
-              optionA: {
-                text: "Continue the adventure"
-              },
-              optionB: {
-                text: "Try something different"
-              }
-            }
-          })
-        };
+        return parseChapterResponse(result.response, request, shouldIncludeChoices);
       }
     } else {
       // Use local Ollama with CLI
       const { stdout } = await execAsync(`ollama run mistral "${prompt.replace(/"/g, '\\"')}"`);
       
-      // Try to parse the JSON response
-      const jsonMatch = stdout.match(/\{[\s\S]*\}/);
-      if (jsonMatch) {
-        const result = JSON.parse(jsonMatch[0]);
-        
-        // Ensure scene description exists
-        if (!result.sceneDescription && result.content) {
-          const sentences = result.content.split(/[.!?]+/).filter(s => s.trim().length > 0);
-          const firstSentence = sentences[0] || result.content;
-          result.sceneDescription = `${request.characterName} the ${request.characterType} ${firstSentence.toLowerCase().substring(0, 100).replace(/[^\w\s]/g, ' ').trim()}`;
-        }
-        
-        return result as StoryChapterResponse;
-      }
-      
-      // Fallback if JSON parsing fails
-      const fallbackSceneDesc = `${request.characterName} the ${request.characterType} in a magical adventure scene`;
-      return {
-        content: stdout.trim() || "The adventure continues...",
-        sceneDescription: fallbackSceneDesc,
-        ...(shouldIncludeChoices && {
-          choices: {
-            optionA: {
-              text: "Continue the adventure"
-            },
-            optionB: {
-              text: "Try something different"
-            }
-          }
-        })
-      };
+      return parseChapterResponse(stdout, request, shouldIncludeChoices);
     }
   } catch (error: any) {
     console.error('Error generating story with Ollama:', error);
@@ -331,7 +370,105 @@ async function isPythonAvailable(): Promise<boolean> {
   }
 }
 
-export async function generateStoryImage(description: string, characterImageUrl?: string, genre: string = "cartoon", characterName?: string, characterType?: string): Promise<string> {
+// Send a character reference by content hash when the image server already stores it,
+// so the same picture isn't uploaded over the tunnel for every chapter.
+async function appendCharacterImage(remoteImageUrl: string, formData: FormData, image: Blob, filename: string): Promise<void> {
+  const hash = createHash('sha256').update(Buffer.from(await image.arrayBuffer())).digest('hex');
+  try {
+    const known = await fetch(`${remoteImageUrl}/references/${hash}`, { method: 'HEAD' });
+    if (known.ok) {
+      formData.append('reference_id', hash);
+      return;
+    }
+  } catch (error) {
+    console.log('Could not check stored character reference:', error);
+  }
+  formData.append('character_image', image, filename);
+}
+
+// Submit to the image server's /jobs API and long-poll until the job finishes.
+// Returns null when the server has no job API so the caller can fall back to /generate.
+async function generateViaJobApi(remoteImageUrl: string, formData: FormData): Promise<string | null> {
+  const submit = await fetch(`${remoteImageUrl}/jobs`, {
+    method: 'POST',
+    body: formData
+  });
+  if (submit.status === 404 || submit.status === 501) {
+    return null;
+  }
+  if (!submit.ok) {
+    console.error('Remote image job submission failed:', submit.status, await submit.text());
+    return "";
+  }
+
+  const { job_id: jobId } = await submit.json();
+  const deadline = Date.now() + 5 * 60 * 1000;
+  while (Date.now() < deadline) {
+    const statusResponse = await fetch(`${remoteImageUrl}/jobs/${jobId}?wait=25`);
+    if (!statusResponse.ok) {
+      console.error('Remote image job status failed:', statusResponse.status);
+      return "";
+    }
+    const job = await statusResponse.json();
+    if (job.status === 'completed') {
+      console.log('Remote image job completed:', job);
+      return job.image_url || "";
+    }
+    if (job.status === 'failed' || job.status === 'cancelled') {
+      console.error('Remote image job did not complete:', job.status, job.error);
+      return "";
+    }
+  }
+
+  // Nobody is waiting for it any more, so free the GPU for other readers
+  await fetch(`${remoteImageUrl}/jobs/${jobId}`, { method: 'DELETE' }).catch(() => undefined);
+  console.error('Remote image job timed out:', jobId);
+  return "";
+}
+
+// Genre, character and story fields of an image request, with the character reference
+// sent by content hash when the image server already has it
+async function appendImageFields(remoteImageUrl: string, formData: FormData, characterImageUrl?: string, genre: string = "cartoon", characterName?: string, characterType?: string, storyId?: number | string): Promise<void> {
+  formData.append('genre', genre);
+  if (characterName) formData.append('character_name', `${characterName} the ${characterType || 'character'}`); // Include character type
+  // Lets the image server keep every picture of a story that is still being read
+  if (storyId !== undefined) formData.append('story_id', String(storyId));
+  
+  // Handle character reference image for IP-Adapter
+  if (characterImageUrl) {
+    if (characterImageUrl.startsWith('data:')) {
+      // Handle base64 data URL
+      const base64Data = characterImageUrl.split(',')[1];
+      const mimeType = characterImageUrl.match(/data:([^;]+)/)?.[1] || 'image/png';
+      const extension = mimeType.split('/')[1];
+      
+      // Convert base64 to blob
+      const byteCharacters = atob(base64Data);
+      const byteNumbers = new Array(byteCharacters.length);
+      for (let i = 0; i < byteCharacters.length; i++) {
+        byteNumbers[i] = byteCharacters.charCodeAt(i);
+      }
+      const byteArray = new Uint8Array(byteNumbers);
+      const blob = new Blob([byteArray], { type: mimeType });
+      
+      await appendCharacterImage(remoteImageUrl, formData, blob, `character.${extension}`);
+    } else if (characterImageUrl.startsWith('http')) {
+      // Handle URL - fetch and convert to blob
+      try {
+        const imageResponse = await fetch(characterImageUrl);
+        const imageBlob = await imageResponse.blob();
+        await appendCharacterImage(remoteImageUrl, formData, imageBlob, 'character.png');
+      } catch (error) {
+        console.log('Could not fetch character image from URL:', error);
+      }
+    } else {
+      // Handle local file path or asset path
+      formData.append('character_image_url', characterImageUrl);
+    }
+  }
+}
+
+export async function generateStoryImage(description: string, characterImageUrl?: string, genre: string = "cartoon", characterName?: string, characterType?: string, storyId?: number | string): Promise<string> {
   // Check for remote image generation endpoint first
   const remoteImageUrl = process.env.REMOTE_IMAGE_URL;
   
@@ -352,42 +489,14 @@ export async function generateStoryImage(description: string, characterImageUrl?
       
       const formData = new FormData();
       formData.append('description', imagePrompt);
-      formData.append('genre', genre);
-      if (characterName) formData.append('character_name', `${characterName} the ${characterType || 'character'}`); // Include character type
-      
-      // Handle character reference image for IP-Adapter
-      if (characterImageUrl) {
-        if (characterImageUrl.startsWith('data:')) {
-          // Handle base64 data URL
-          const base64Data = characterImageUrl.split(',')[1];
-          const mimeType = characterImageUrl.match(/data:([^;]+)/)?.[1] || 'image/png';
-          const extension = mimeType.split('/')[1];
-          
-          // Convert base64 to blob
-          const byteCharacters = atob(base64Data);
-          const byteNumbers = new Array(byteCharacters.length);
-          for (let i = 0; i < byteCharacters.length; i++) {
-            byteNumbers[i] = byteCharacters.charCodeAt(i);
-          }
-          const byteArray = new Uint8Array(byteNumbers);
-          const blob = new Blob([byteArray], { type: mimeType });
-          
-          formData.append('character_image', blob, `character.${extension}`);
-        } else if (characterImageUrl.startsWith('http')) {
-          // Handle URL - fetch and convert to blob
-          try {
-            const imageResponse = await fetch(characterImageUrl);
-            const imageBlob = await imageResponse.blob();
-            formData.append('character_image', imageBlob, 'character.png');
-          } catch (error) {
-            console.log('Could not fetch character image from URL:', error);
-          }
-        } else {
-          // Handle local file path or asset path
-          formData.append('character_image_url', characterImageUrl);
-        }
+      await appendImageFields(remoteImageUrl, formData, characterImageUrl, genre, characterName, characterType, storyId);
+
+      // Prefer the job API so a slow generation never holds one HTTP request open for minutes
+      const jobImageUrl = await generateViaJobApi(remoteImageUrl, formData);
+      if (jobImageUrl !== null) {
+        return jobImageUrl;
       }
-      
+
       const response = await fetch(`${remoteImageUrl}/generate`, {
         method: 'POST',
         body: formData
@@ -411,4 +520,80 @@ export async function generateStoryImage(description: string, characterImageUrl?
   // If remote image generation failed, return empty string instead of trying local
   console.log('Remote image generation not available, skipping image generation');
   return "";
-}
\ No newline at end of file
+}
+
+// Chapter text and illustration in one request to the image server's /chapter, which starts the
+// image as soon as the model has written sceneDescription, so the chapter takes as long as the
+// slower of the two instead of both added up. Null when that isn't available (no
+// STORY_GATEWAY_URL, Ollama down, or the text broke off before the 'chapter' event), so the
+// caller generates them one after the other. Once the whole text has arrived it is kept even if
+// the stream then drops; imageUrl is '' if the image didn't finish.
+export async function generateChapterWithImage(request: StoryGenerationRequest, characterImageUrl?: string, storyId?: number | string): Promise<{ chapter: StoryChapterResponse; imageUrl: string } | null> {
+  const gatewayUrl = process.env.STORY_GATEWAY_URL;
+  if (!gatewayUrl) {
+    return null;
+  }
+  const { prompt, shouldIncludeChoices } = buildChapterPrompt(request);
+  let text = '';
+  let imageUrl = '';
+  // Set by the 'chapter' event, sent once the model has finished the text
+  let complete = false;
+  try {
+    const formData = new FormData();
+    formData.append('prompt', prompt);
+    formData.append('model', 'mistral');
+    await appendImageFields(gatewayUrl, formData, characterImageUrl, request.genre, request.characterName, request.characterType, storyId);
+
+    const response = await fetch(`${gatewayUrl}/chapter`, {
+      method: 'POST',
+      headers: { 'ngrok-skip-browser-warning': 'true' },
+      body: formData
+    });
+    if (!response.ok || !response.body) {
+      console.log('Chapter pipeline unavailable:', response.status);
+      return null;
+    }
+
+    // NDJSON events: text chunks, scene (image queued), chapter, preview, image, done
+    let buffered = '';
+    let failed = false;
+    const decoder = new TextDecoder();
+    for await (const chunk of response.body as any) {
+      buffered += decoder.decode(chunk, { stream: true });
+      const lines = buffered.split('\n');
+      buffered = lines.pop() || '';
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        const event = JSON.parse(line);
+        if (event.event === 'text') {
+          text += event.response;
+        } else if (event.event === 'chapter') {
+          complete = true;
+        } else if (event.event === 'image') {
+          imageUrl = event.success ? event.image_url : '';
+          if (!event.success) console.error('Chapter image did not complete:', event.status, event.error);
+        } else if (event.event === 'error') {
+          console.log('Chapter pipeline failed:', event.error);
+          failed = true;
+          break;
+        } else if (event.event === 'done') {
+          console.log('Chapter pipeline timings:', event);
+        }
+      }
+      if (failed) break;
+    }
+    if (!complete || !text.trim()) {
+      return null;
+    }
+    // parseChapterResponse copes with a finished text that isn't valid JSON, so it isn't
+    // thrown away and written again
+    return { chapter: parseChapterResponse(text, request, shouldIncludeChoices), imageUrl };
+  } catch (error: any) {
+    console.log('Chapter pipeline not accessible:', error?.message || error);
+    if (!complete || !text.trim()) {
+      return null;
+    }
+    // The connection dropped while waiting for the image: keep the finished text
+    return { chapter: parseChapterResponse(text, request, shouldIncludeChoices), imageUrl };
+  }
+}
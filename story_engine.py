@@ -0,0 +1,873 @@
+#!/usr/bin/env python3
+"""
+Resident SD15 + IP-Adapter Plus generation engine for the FAIryTale image server.
+
+This is the logic of fast_story_gen/app.py turned into a long-lived object:
+the pipeline, LoRA styles and IP-Adapter are loaded once and every request
+only pays for the denoising loop instead of a fresh interpreter + model load.
+
+Startup imports diffusers only when the pipeline is loaded and the IP-Adapter
+(CLIP image encoder) only when the first reference image arrives. Weights are
+read from safetensors with low_cpu_mem_usage, so they are memory-mapped rather
+than copied, and PIPELINE_SNAPSHOT=1 saves the assembled pipeline (base,
+fused LoRA, DDIM scheduler) for faster restarts.
+
+Requests with an on_preview callback get a rough image part way through
+denoising: the scheduler's predicted clean latents decoded with TAESD when it
+is available, else with a linear latent-to-RGB approximation that costs
+nothing.
+
+CPU workers run with their own execution profile (CPU_* settings): bfloat16
+on CPUs with native bf16 (else float32), channels_last UNet/VAE, optional
+attention slicing, torch.compile of the UNet and a multistep scheduler that
+gets away with fewer steps. benchmark_cpu.py compares profiles in seconds per
+image.
+
+Memory is kept within MEMORY_BUDGET_MB by the modes in memory_budget.py
+(slicing, VAE tiling, model or sequential CPU offload), and every batch's
+peak memory is measured and reported on its requests. The IP-Adapter layers
+and the CLIP image encoder are only loaded while references are in use.
+"""
+
+import gc
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import torch
+from PIL import Image
+
+import metrics
+from batching import BATCH_MAX_SIZE
+from generation import (PREVIEW_SIZE, GenerationCancelled, GenerationPreempted, GenerationRequest,
+                        continuation_steps, preview_step)
+from memory_budget import (MEMORY_BUDGET_MB, MEMORY_MODE, OFFLOAD_MODES, PeakMemory, choose_mode, module_mb,
+                           next_mode)
+from style_registry import LORA_FUSE_SINGLE, LoraRegistry, load_style_map
+
+# Model configuration (mirrors the defaults of app.py)
+MODEL_ID = os.getenv('SD_MODEL_ID', 'runwayml/stable-diffusion-v1-5')
+IP_ADAPTER_CKPT = os.getenv('IP_ADAPTER_CKPT', 'ip-adapter-plus_sd15.bin')
+IP_ADAPTER_REPO = os.getenv('IP_ADAPTER_REPO', 'h94/IP-Adapter')
+IP_ADAPTER_SCALE = float(os.getenv('IP_ADAPTER_SCALE', '1.0'))
+# 'auto' = the GPU when torch sees one, else the CPU
+DEVICE = os.getenv('SD_DEVICE', 'auto')
+
+# Save/reload the assembled pipeline as a local safetensors snapshot
+PIPELINE_SNAPSHOT = os.getenv('PIPELINE_SNAPSHOT', '0') == '1'
+PIPELINE_SNAPSHOT_DIR = os.getenv('PIPELINE_SNAPSHOT_DIR', os.path.join('cache', 'pipeline_snapshots'))
+# Denoising steps of the warmup generation run before the engine reports ready (0 = skip)
+WARMUP_STEPS = int(os.getenv('WARMUP_STEPS', '2'))
+
+# IP-Adapter image embeddings per character reference
+IP_EMBED_CACHE_SIZE = int(os.getenv('IP_EMBED_CACHE_SIZE', '64'))
+IP_EMBED_CACHE_DIR = os.getenv('IP_EMBED_CACHE_DIR', os.path.join('cache', 'ip_embeds'))
+IP_EMBED_CACHE_PERSIST = os.getenv('IP_EMBED_CACHE_PERSIST', '1') == '1'
+
+# Seconds without a new reference before the CLIP image encoder is freed (0 = right after use,
+# -1 = never); cached embeddings don't need it
+IP_ENCODER_IDLE_SECONDS = float(os.getenv('IP_ENCODER_IDLE_SECONDS', '300'))
+# Seconds without a reference request before the UNet's IP-Adapter layers are removed again,
+# so text-only batches stop paying for them (-1 = never)
+IP_ADAPTER_IDLE_SECONDS = float(os.getenv('IP_ADAPTER_IDLE_SECONDS', '900'))
+
+# CLIP text-encoder outputs per prompt (and one per negative prompt)
+PROMPT_EMBED_CACHE_SIZE = int(os.getenv('PROMPT_EMBED_CACHE_SIZE', '512'))
+
+# Final latents of each story's latest panel, where its next continuation starts (~32 KB each)
+STORY_LATENT_CACHE_SIZE = int(os.getenv('STORY_LATENT_CACHE_SIZE', '256'))
+
+# Preview decoder: 'auto' uses TAESD if it is already downloaded, 'taesd' fetches it, 'approx' never does
+PREVIEW_DECODER = os.getenv('PREVIEW_DECODER', 'auto')
+PREVIEW_TAESD_ID = os.getenv('PREVIEW_TAESD_ID', 'madebyollin/taesd')
+# SD1.5 latent channels -> RGB, a cheap stand-in for the VAE decoder
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+# CPU execution profile, used by engines on device 'cpu'
+# 'auto' picks bfloat16 when the CPU has native bf16 (AVX512-BF16 / AMX), else float32
+CPU_DTYPE = os.getenv('CPU_DTYPE', 'auto')
+CPU_CHANNELS_LAST = os.getenv('CPU_CHANNELS_LAST', '1') == '1'
+# Saves memory on big batches, but is usually slower than torch's fused attention
+CPU_ATTENTION_SLICING = os.getenv('CPU_ATTENTION_SLICING', '0') == '1'
+# torch.compile the UNet; compiling happens during warmup (needs a C++ compiler)
+CPU_COMPILE = os.getenv('CPU_COMPILE', '0') == '1'
+# ddim (as app.py), dpm (DPM-Solver++) or unipc; the multistep ones look done in ~15-20 steps
+CPU_SCHEDULER = os.getenv('CPU_SCHEDULER', 'ddim')
+# Upper bound on denoising steps for CPU workers (0 = as requested)
+CPU_MAX_STEPS = int(os.getenv('CPU_MAX_STEPS', '0'))
+# Torch inter-op threads for the whole process (0 = torch default); intra-op threads are per worker
+CPU_INTEROP_THREADS = int(os.getenv('CPU_INTEROP_THREADS', '0'))
+
+SCHEDULERS = {
+    'ddim': 'DDIMScheduler',
+    'dpm': 'DPMSolverMultistepScheduler',
+    'unipc': 'UniPCMultistepScheduler',
+}
+
+# app.py leaves the negative prompt disabled
+NEGATIVE_PROMPT = None  # "blurry, low quality, deformed, watermark"
+
+
+def _nbytes(value):
+    """Memory held by a tensor or a tuple/list of tensors"""
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    if hasattr(value, 'element_size'):
+        return value.element_size() * value.nelement()
+    return 0
+
+
+def cpu_profile(**overrides):
+    """CPU execution settings from the environment, with overrides (used by benchmark_cpu.py)"""
+    profile = {
+        'dtype': CPU_DTYPE,
+        'channels_last': CPU_CHANNELS_LAST,
+        'attention_slicing': CPU_ATTENTION_SLICING,
+        'compile': CPU_COMPILE,
+        'scheduler': CPU_SCHEDULER,
+        'max_steps': CPU_MAX_STEPS,
+    }
+    profile.update(overrides)
+    return profile
+
+
+def cpu_has_bf16():
+    """Whether the CPU computes bfloat16 natively; emulated bf16 is slower than float32"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def _cpu_dtype(name):
+    if name == 'auto':
+        return torch.bfloat16 if cpu_has_bf16() else torch.float32
+    return {'bfloat16': torch.bfloat16, 'bf16': torch.bfloat16}.get(name, torch.float32)
+
+
+_interop_threads_set = False
+
+
+def _set_interop_threads():
+    """Process-wide, and only possible before torch starts any parallel work"""
+    global _interop_threads_set
+    if CPU_INTEROP_THREADS and not _interop_threads_set:
+        _interop_threads_set = True
+        try:
+            torch.set_num_interop_threads(CPU_INTEROP_THREADS)
+        except RuntimeError as e:
+            print(f"[engine] Keeping {torch.get_num_interop_threads()} inter-op threads: {e}")
+
+
+class EmbeddingCache:
+    """LRU of encoder outputs keyed by content hash, optionally mirrored to disk
+
+    Tensors read back from disk are cast to `dtype` (when given), so a file written by an
+    engine with another precision can't reach the UNet in the wrong dtype.
+    """
+
+    def __init__(self, max_entries, persist_dir=None, dtype=None):
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self.dtype = dtype
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.pt")
+
+    def get(self, key, device=None):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.persist_dir and os.path.exists(self._disk_path(key)):
+            value = torch.load(self._disk_path(key), map_location=device)
+            if self.dtype is not None:
+                value = tuple(t.to(self.dtype) for t in value)
+            self._remember(key, value)
+            with self.lock:
+                self.hits += 1
+            return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def contains(self, key):
+        """Whether key is cached in memory or on disk, without counting a lookup"""
+        with self.lock:
+            if key in self.entries:
+                return True
+        return bool(self.persist_dir) and os.path.exists(self._disk_path(key))
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.persist_dir:
+            tmp_path = self._disk_path(key) + '.tmp'
+            torch.save(value, tmp_path)
+            os.replace(tmp_path, self._disk_path(key))
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': sum(_nbytes(v) for v in self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class StoryEngine:
+    """Keeps one warm StableDiffusionPipeline and renders story scenes on demand"""
+
+    def __init__(self, work_dir, device=DEVICE, num_threads=None, profile=None, memory_budget_mb=None):
+        if device == 'auto':
+            from worker_pool import detect_device
+            device = detect_device()
+        self.work_dir = work_dir
+        self.device = device
+        self.model_id = MODEL_ID
+        # CPU thread budget for this engine's worker thread (None = torch default)
+        self.num_threads = num_threads
+        # Execution profile: the CPU one (cpu_profile()) on the CPU, app.py's float16 + DDIM elsewhere
+        if device == 'cpu':
+            self.profile = profile or cpu_profile()
+            self.dtype = _cpu_dtype(self.profile['dtype'])
+            _set_interop_threads()
+        else:
+            self.profile = profile or {}
+            self.dtype = torch.float16 if device.startswith('cuda') else torch.float32
+        self.compiled = False
+        # MB this engine may use on its device (0 = no limit), and the memory_budget mode in use
+        self.memory_budget_mb = MEMORY_BUDGET_MB if memory_budget_mb is None else memory_budget_mb
+        self.memory_mode = None
+        self.memory_mode_changes = 0
+        self.over_budget_batches = 0
+        self.last_peak_mb = None
+        self.max_peak_mb = None
+        self.pipe = None
+        self.loras = None
+        self.ip_adapter_loaded = False
+        self.reference_used_at = 0.0
+        self.encoder_used_at = 0.0
+        self.reference_embeds = EmbeddingCache(
+            IP_EMBED_CACHE_SIZE, IP_EMBED_CACHE_DIR if IP_EMBED_CACHE_PERSIST else None, dtype=self.dtype)
+        self.blank_embeds = None
+        self.prompt_embeds = EmbeddingCache(PROMPT_EMBED_CACHE_SIZE)
+        # story id -> (output_key, latents on the CPU), least recently used first
+        self.story_latents = OrderedDict()
+        self.story_latent_hits = 0
+        self.story_latent_misses = 0
+        self.img2img = None
+        # AutoencoderTiny for previews; False once we know it isn't available
+        self.preview_vae = None
+        self.previews = 0
+        self.loaded_at = None
+        # Startup phase -> seconds, for /health and the startup log
+        self.startup = {}
+        # The pipeline is not thread safe, so generations are serialized
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load the base model, scheduler and LoRA styles once"""
+        if self.pipe is not None:
+            return self
+        start = phase = time.time()
+        import diffusers
+        from diffusers import StableDiffusionPipeline
+        phase = self._phase('import_diffusers', phase)
+
+        # Only one style configured: fuse it like app.py; otherwise adapters are switched per batch
+        style_map = load_style_map(self.work_dir)
+        styles = set(style_map.values()) - {None}
+        fuse_style = styles.pop() if LORA_FUSE_SINGLE and len(styles) == 1 else None
+
+        # A snapshot has the fused style baked in, so only use one when no genre needs another style
+        snapshot_dir = None
+        if PIPELINE_SNAPSHOT and fuse_style and None not in style_map.values():
+            snapshot_dir = self._snapshot_dir(fuse_style)
+        from_snapshot = snapshot_dir is not None and os.path.isdir(snapshot_dir)
+        source = snapshot_dir if from_snapshot else MODEL_ID
+
+        # DDIM (or the profile's scheduler) straight from the stored config instead of
+        # building the default scheduler first
+        scheduler_class = getattr(diffusers, SCHEDULERS[self.profile.get('scheduler', 'ddim')])
+        scheduler = scheduler_class.from_pretrained(source, subfolder="scheduler")
+        pipe = StableDiffusionPipeline.from_pretrained(
+            source, scheduler=scheduler, torch_dtype=self.dtype,
+            low_cpu_mem_usage=True, use_safetensors=True if from_snapshot else None)
+        phase = self._phase('load_snapshot' if from_snapshot else 'load_weights', phase)
+        if self.profile.get('channels_last'):
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.vae.to(memory_format=torch.channels_last)
+        memory_mode = self._choose_memory_mode(pipe)
+        if memory_mode not in OFFLOAD_MODES:
+            self._apply_memory_mode(pipe, memory_mode)
+            phase = self._phase('to_device', phase)
+
+        lora_dir = os.path.join(self.work_dir, "loras")
+        if from_snapshot:
+            self.loras = LoraRegistry(pipe, lora_dir, baked_style=fuse_style)
+        else:
+            self.loras = LoraRegistry(pipe, lora_dir, fuse_style=fuse_style)
+            phase = self._phase('lora', phase)
+            if snapshot_dir:
+                self.loras.bake()
+                self._save_snapshot(pipe, snapshot_dir)
+                phase = self._phase('save_snapshot', phase)
+        if memory_mode in OFFLOAD_MODES:
+            # Offload hooks go on after the LoRAs are loaded and the snapshot is written
+            self._apply_memory_mode(pipe, memory_mode)
+            phase = self._phase('offload', phase)
+        if self.profile.get('compile'):
+            # After the LoRAs, so fusing doesn't invalidate the compiled graph
+            pipe.unet = torch.compile(pipe.unet)
+            self.compiled = True
+
+        self.pipe = pipe
+        self.loaded_at = time.time()
+        metrics.observe('model_load', self.loaded_at - start)
+        print(f"[engine] Pipeline ready on {self.device} ({str(self.dtype).replace('torch.', '')}, "
+              f"memory mode {self.memory_mode}) in {self.loaded_at - start:.1f}s")
+        return self
+
+    def warmup(self):
+        """Run a tiny generation so the first real request doesn't pay for kernel
+        selection and allocator growth"""
+        self.load()
+        if WARMUP_STEPS <= 0:
+            return self
+        phase = time.time()
+        request = GenerationRequest("warmup", seed=0, steps=WARMUP_STEPS, style_lora=self.loras.active)
+        try:
+            self.generate_batch([request])
+        except Exception as e:
+            # torch.compile only fails once it first runs, e.g. without a working C++ compiler
+            if not self.compiled:
+                raise
+            print(f"[engine] torch.compile failed, running the UNet eagerly: {e}")
+            self.pipe.unet = self.pipe.unet._orig_mod
+            self.compiled = False
+            self.generate_batch([request])
+        self._phase('warmup', phase)
+        return self
+
+    def _phase(self, name, started):
+        """Record and log how long a startup phase took; returns the time it ended"""
+        now = time.time()
+        self.startup[name] = round(now - started, 2)
+        print(f"[engine] {self.device} {name}: {now - started:.2f}s")
+        return now
+
+    def _snapshot_dir(self, style_lora):
+        """Snapshot location keyed on everything baked into it"""
+        lora_path = os.path.join(self.work_dir, "loras", style_lora)
+        stat = os.stat(lora_path)
+        parts = {
+            'model': MODEL_ID,
+            'style_lora': style_lora,
+            'lora_file': [stat.st_size, stat.st_mtime_ns],
+            'dtype': str(self.dtype),
+        }
+        key = hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(PIPELINE_SNAPSHOT_DIR, key)
+
+    @staticmethod
+    def _save_snapshot(pipe, snapshot_dir):
+        """Write the pipeline as safetensors, appearing under snapshot_dir only once complete"""
+        tmp_dir = f"{snapshot_dir}.{uuid.uuid4().hex}.tmp"
+        try:
+            pipe.save_pretrained(tmp_dir, safe_serialization=True)
+            os.replace(tmp_dir, snapshot_dir)
+            print(f"[engine] Saved pipeline snapshot to {snapshot_dir}")
+        except OSError as e:
+            # Another worker finished the same snapshot first, or the disk is full
+            print(f"[engine] Not saving pipeline snapshot: {e}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def bind_thread(self):
+        """Apply this engine's CPU thread budget to the calling (worker) thread"""
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+    def _choose_memory_mode(self, pipe):
+        """Memory mode for the configured budget, from the pipeline's weight sizes"""
+        sizes = [module_mb(getattr(pipe, name, None))
+                 for name in ('unet', 'vae', 'text_encoder', 'image_encoder', 'safety_checker')]
+        return choose_mode(self.device, self.memory_budget_mb, sum(sizes), max(sizes), BATCH_MAX_SIZE,
+                           torch.finfo(self.dtype).bits // 8)
+
+    def _apply_memory_mode(self, pipe, mode):
+        """Place the pipeline for `mode` (on the device, or behind accelerate's offload hooks) and
+        set VAE slicing/tiling and attention slicing to match; re-run whenever modules change"""
+        if mode == 'model_offload':
+            pipe.enable_model_cpu_offload(device=self.device)
+        elif mode == 'sequential_offload':
+            pipe.enable_sequential_cpu_offload(device=self.device)
+        else:
+            if self.memory_mode in OFFLOAD_MODES:
+                pipe.remove_all_hooks()
+            pipe.to(self.device)
+        if mode == 'full':
+            pipe.vae.disable_slicing()
+        else:
+            pipe.vae.enable_slicing()
+        if mode in ('full', 'sliced'):
+            pipe.vae.disable_tiling()
+        else:
+            pipe.vae.enable_tiling()
+        self.memory_mode = mode
+        self._apply_attention_slicing(pipe)
+
+    def _apply_attention_slicing(self, pipe):
+        """Attention slicing for the CPU profile or any memory mode past 'full'. Not while the
+        IP-Adapter is attached: slicing would replace its attention processors"""
+        if self.ip_adapter_loaded:
+            return
+        if self.profile.get('attention_slicing') or self.memory_mode != 'full':
+            pipe.enable_attention_slicing()
+        else:
+            pipe.disable_attention_slicing()
+
+    def _next_memory_mode(self, reason):
+        """Move to the next more frugal mode (MEMORY_MODE=auto only); False if there is none"""
+        mode = next_mode(self.device, self.memory_mode) if MEMORY_MODE == 'auto' else None
+        if mode is None:
+            return False
+        print(f"[engine] {self.device}: {reason}, switching memory mode {self.memory_mode} -> {mode}")
+        self._free_memory()
+        self._apply_memory_mode(self.pipe, mode)
+        self.memory_mode_changes += 1
+        return True
+
+    def _record_peak_memory(self, requests, peak_mb):
+        """Report a batch's peak on its requests and step down a mode when it broke the budget"""
+        if peak_mb is None:
+            return
+        self.last_peak_mb = peak_mb
+        self.max_peak_mb = max(self.max_peak_mb or 0, peak_mb)
+        metrics.PEAK_MEMORY.observe(peak_mb, device=self.device)
+        for r in requests:
+            r.peak_memory_mb = peak_mb
+            if r.trace is not None:
+                r.trace.meta['peak_memory_mb'] = peak_mb
+        if self.memory_budget_mb and peak_mb > self.memory_budget_mb:
+            self.over_budget_batches += 1
+            self._next_memory_mode(f"peak {peak_mb:.0f} MB over the {self.memory_budget_mb} MB budget")
+
+    def _free_memory(self):
+        gc.collect()
+        if self.device.startswith('cuda'):
+            torch.cuda.empty_cache()
+
+    def _ensure_ip_adapter(self):
+        """Attach the IP-Adapter Plus layers to the UNet the first time a reference is used"""
+        if self.ip_adapter_loaded:
+            return
+        start = time.time()
+        # Prefer the checkpoint sitting next to app.py, like IPAdapterPlus did
+        if os.path.exists(os.path.join(self.work_dir, IP_ADAPTER_CKPT)):
+            self.pipe.load_ip_adapter(self.work_dir, subfolder="", weight_name=IP_ADAPTER_CKPT,
+                                      image_encoder_folder=None)
+        else:
+            self.pipe.load_ip_adapter(IP_ADAPTER_REPO, subfolder="models", weight_name=IP_ADAPTER_CKPT,
+                                      image_encoder_folder=None)
+        self.ip_adapter_loaded = True
+        # The new layers have to be placed (or hooked) like the rest of the pipeline
+        self._apply_memory_mode(self.pipe, self.memory_mode)
+        metrics.observe('ip_adapter_load', time.time() - start)
+        print(f"[engine] IP-Adapter Plus loaded in {time.time() - start:.1f}s")
+
+    def _ensure_image_encoder(self):
+        """Load the CLIP image encoder, which is only needed to encode a new reference"""
+        if getattr(self.pipe, 'image_encoder', None) is not None:
+            return
+        from transformers import CLIPVisionModelWithProjection
+
+        start = time.time()
+        image_encoder = CLIPVisionModelWithProjection.from_pretrained(
+            IP_ADAPTER_REPO, subfolder="models/image_encoder", torch_dtype=self.dtype)
+        self.pipe.register_modules(image_encoder=image_encoder)
+        self._apply_memory_mode(self.pipe, self.memory_mode)
+        metrics.observe('ip_encoder_load', time.time() - start)
+        print(f"[engine] IP-Adapter image encoder loaded in {time.time() - start:.1f}s")
+
+    def _release_image_encoder(self):
+        if getattr(self.pipe, 'image_encoder', None) is None:
+            return
+        self.pipe.register_modules(image_encoder=None)
+        self._apply_memory_mode(self.pipe, self.memory_mode)
+        self._free_memory()
+        print(f"[engine] {self.device}: released the IP-Adapter image encoder")
+
+    def _release_idle_ip_adapter(self, first):
+        """Free the image encoder, and before a text-only batch the UNet's IP-Adapter layers,
+        once they have been unused for their idle time"""
+        now = time.time()
+        if IP_ENCODER_IDLE_SECONDS >= 0 and now - self.encoder_used_at > IP_ENCODER_IDLE_SECONDS:
+            self._release_image_encoder()
+        # Unloading assigns to UNet attributes, which a torch.compile wrapper would swallow
+        if (first.reference is None and self.ip_adapter_loaded and not self.compiled
+                and IP_ADAPTER_IDLE_SECONDS >= 0 and now - self.reference_used_at > IP_ADAPTER_IDLE_SECONDS):
+            self.pipe.unload_ip_adapter()
+            self.ip_adapter_loaded = False
+            self._apply_memory_mode(self.pipe, self.memory_mode)
+            self._free_memory()
+            print(f"[engine] {self.device}: removed the idle IP-Adapter layers")
+
+    def generate_batch(self, requests):
+        """Render compatible requests (same batch_key) in one batched denoising call"""
+        first = requests[0]
+        if any(r.batch_key() != first.batch_key() for r in requests):
+            raise ValueError("generate_batch needs requests with the same batch_key")
+
+        self.load()
+        traces = [r.trace for r in requests]
+        with self.lock:
+            self._release_idle_ip_adapter(first)
+            with PeakMemory(self.device) as peak:
+                try:
+                    images = self._run_batch(requests, traces)
+                except torch.cuda.OutOfMemoryError:
+                    if not self._next_memory_mode('out of memory'):
+                        raise
+                    images = self._run_batch(requests, traces)
+            self._record_peak_memory(requests, peak.mb)
+            return images
+
+    def _run_batch(self, requests, traces):
+        """One batched generation; the caller holds the engine lock"""
+        first = requests[0]
+        # Before encoding prompts: the LoRA may patch the text encoder too
+        with metrics.span('lora_switch', traces):
+            self.loras.activate(first.style_lora)
+        kwargs = {}
+        if first.reference is not None:
+            self.reference_used_at = time.time()
+            with metrics.span('ip_adapter_encode', traces):
+                embeds = [self._reference_embeds(r.reference, r.reference_key) for r in requests]
+                # Embeddings cached on disk skip the encoder, but the UNet still needs the adapter
+                self._ensure_ip_adapter()
+            self.pipe.set_ip_adapter_scale(IP_ADAPTER_SCALE)
+            kwargs['ip_adapter_image_embeds'] = self._stack_image_embeds(embeds, first.scale)
+        elif self.ip_adapter_loaded:
+            # Once the adapter is attached the UNet expects image embeds,
+            # so text-only requests get a blank image with zero influence
+            self.pipe.set_ip_adapter_scale(0.0)
+            embeds = [self._blank_embeds()] * len(requests)
+            kwargs['ip_adapter_image_embeds'] = self._stack_image_embeds(embeds, first.scale)
+
+        # One generator per prompt keeps each image identical to an unbatched run
+        generators = [torch.Generator(device=self.device).manual_seed(r.seed) for r in requests]
+        with metrics.span('text_encode', traces):
+            prompt_embeds = torch.cat([self._prompt_embeds(r.prompt, r.style_lora) for r in requests])
+            negative_embeds = self._prompt_embeds(NEGATIVE_PROMPT or "", first.style_lora)
+
+        pipe = self.pipe
+        steps = self.steps_for(first.steps)
+        if first.continues:
+            # img2img from the previous panel: only the last `strength` share of the steps run
+            with metrics.span('init_latents', traces):
+                kwargs['image'] = torch.cat([self._init_latents(r) for r in requests])
+            kwargs['strength'] = first.strength
+            pipe = self._img2img_pipe()
+            steps = continuation_steps(self.steps_for(first.steps), first.strength)
+        wants_preview = any(r.on_preview is not None for r in requests)
+        with metrics.span('denoise', traces, batch_size=len(requests), steps=steps), \
+                _CleanLatentsTap(pipe.scheduler, wants_preview) as tap:
+            latents = pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds.expand(len(requests), -1, -1),
+                num_inference_steps=self.steps_for(first.steps),
+                guidance_scale=first.scale,
+                generator=generators,
+                callback_on_step_end=self._step_callback(requests, tap if wants_preview else None),
+                output_type="latent",
+                **kwargs
+            ).images
+        self._remember_story_latents(requests, latents)
+        with metrics.span('vae_decode', traces, batch_size=len(requests)):
+            return self._decode_latents(latents, generators, prompt_embeds.dtype)
+
+    def steps_for(self, requested):
+        """Denoising steps actually run for a request, capped by the profile's max_steps"""
+        max_steps = self.profile.get('max_steps')
+        return min(requested, max_steps) if max_steps else requested
+
+    def _img2img_pipe(self):
+        """img2img view of the warm pipeline, sharing its modules (UNet, LoRAs, IP-Adapter)"""
+        if self.img2img is None:
+            from diffusers import StableDiffusionImg2ImgPipeline
+            # Image embeddings are always passed in, and a reference to the encoder here would
+            # keep it in memory after _release_image_encoder
+            components = dict(self.pipe.components, image_encoder=None)
+            self.img2img = StableDiffusionImg2ImgPipeline(
+                **components, requires_safety_checker=self.pipe.config.requires_safety_checker)
+        return self.img2img
+
+    @torch.no_grad()
+    def _init_latents(self, request):
+        """Starting latents of a continuation: the story's cached final latents when they belong
+        to the image being continued, else that image encoded with the VAE"""
+        entry = self.story_latents.get(request.story_id)
+        if entry is not None and entry[0] == request.init_key:
+            self.story_latents.move_to_end(request.story_id)
+            self.story_latent_hits += 1
+            return entry[1].to(self.device)
+        self.story_latent_misses += 1
+        vae = self.pipe.vae
+        image = Image.open(request.init_image).convert("RGB")
+        pixels = self.pipe.image_processor.preprocess(image).to(self.device, vae.dtype)
+        return vae.encode(pixels).latent_dist.mode() * vae.config.scaling_factor
+
+    def _remember_story_latents(self, requests, latents):
+        for request, latent in zip(requests, latents):
+            if request.story_id and request.publish_key:
+                self.story_latents[request.story_id] = (request.publish_key, latent.unsqueeze(0).to('cpu'))
+                self.story_latents.move_to_end(request.story_id)
+        while len(self.story_latents) > STORY_LATENT_CACHE_SIZE:
+            self.story_latents.popitem(last=False)
+
+    def has_story(self, story_id):
+        """Whether this engine holds the latents a story's next continuation starts from"""
+        return story_id is not None and story_id in self.story_latents
+
+    @torch.no_grad()
+    def _decode_latents(self, latents, generators, dtype):
+        """VAE decode + safety check + PIL conversion, exactly as the pipeline does after its
+        denoising loop; run separately so the two stages can be timed apart"""
+        pipe = self.pipe
+        image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False,
+                                generator=generators)[0]
+        image, has_nsfw_concept = pipe.run_safety_checker(image, self.device, dtype)
+        if has_nsfw_concept is None:
+            do_denormalize = [True] * image.shape[0]
+        else:
+            do_denormalize = [not has_nsfw for has_nsfw in has_nsfw_concept]
+        return pipe.image_processor.postprocess(image, output_type="pil", do_denormalize=do_denormalize)
+
+    def _prompt_embeds(self, prompt, style_lora):
+        """Text-encoder output for one prompt; the LoRA style is part of the key
+        because a LoRA can change the text encoder weights"""
+        key = f"{style_lora}|{prompt}"
+        embeds = self.prompt_embeds.get(key)
+        if embeds is None:
+            embeds = self.pipe.encode_prompt(prompt, self.device, 1, False)[0]
+            self.prompt_embeds.put(key, embeds)
+        return embeds
+
+    def encode_reference(self, reference, reference_key=None):
+        """Precompute and cache the IP-Adapter embeddings of a reference image"""
+        self.load()
+        with self.lock:
+            return self._reference_embeds(reference, reference_key)
+
+    def has_reference(self, reference_key):
+        """Whether a reference's embeddings are cached for this engine's model and dtype"""
+        return self.reference_embeds.contains(self._reference_cache_key(reference_key))
+
+    def _reference_cache_key(self, reference_key):
+        """Cache key of a reference: its content hash plus everything that shapes the embedding,
+        so files in IP_EMBED_CACHE_DIR from another model, adapter or dtype are never reused"""
+        parts = [reference_key, self.model_id, IP_ADAPTER_REPO, IP_ADAPTER_CKPT, str(self.dtype)]
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def _reference_embeds(self, reference, reference_key=None):
+        """(negative, positive) image-prompt embeddings, cached by image content hash,
+        model, adapter checkpoint and dtype"""
+        from result_cache import file_sha256
+
+        key = self._reference_cache_key(reference_key or file_sha256(reference))
+        embeds = self.reference_embeds.get(key, device=self.device)
+        if embeds is None:
+            image = Image.open(reference).convert("RGB").resize((224, 224))
+            embeds = self._encode_image(image)
+            self.reference_embeds.put(key, embeds)
+        if self.blank_embeds is None:
+            self.blank_embeds = tuple(torch.zeros_like(t) for t in embeds)
+        return embeds
+
+    def _blank_embeds(self):
+        """Zero embeddings shaped like a reference's, used while the adapter scale is 0
+
+        The adapter is only attached for a reference, so one has been seen by now and the
+        image encoder doesn't have to be loaded again for text-only batches.
+        """
+        if self.blank_embeds is None:
+            embeds = self._encode_image(Image.new("RGB", (224, 224)))
+            self.blank_embeds = tuple(torch.zeros_like(t) for t in embeds)
+        return self.blank_embeds
+
+    def _encode_image(self, image):
+        """Run the IP-Adapter image encoder once and split CFG halves"""
+        self._ensure_ip_adapter()
+        self._ensure_image_encoder()
+        self.encoder_used_at = time.time()
+        embeds = self.pipe.prepare_ip_adapter_image_embeds(
+            ip_adapter_image=[image],
+            ip_adapter_image_embeds=None,
+            device=self.device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+        )[0]
+        if IP_ENCODER_IDLE_SECONDS == 0:
+            self._release_image_encoder()
+        negative, positive = embeds.chunk(2)
+        return negative, positive
+
+    @staticmethod
+    def _stack_image_embeds(embeds, scale):
+        """Batch per-request embeddings in the [negatives..., positives...] layout diffusers expects"""
+        positives = torch.cat([positive for _, positive in embeds])
+        if scale <= 1:
+            return [positives]
+        negatives = torch.cat([negative for negative, _ in embeds])
+        return [torch.cat([negatives, positives])]
+
+    @torch.no_grad()
+    def _preview_images(self, latents):
+        """Rough PIL images from (predicted clean) latents, at most PREVIEW_SIZE px"""
+        vae = self._preview_vae()
+        if vae:
+            pixels = vae.decode(latents.to(vae.dtype), return_dict=False)[0]
+        else:
+            factors = torch.tensor(LATENT_RGB_FACTORS, device=latents.device, dtype=torch.float32)
+            pixels = torch.einsum('bchw,cr->brhw', latents.float(), factors)
+        pixels = ((pixels.float().clamp(-1, 1) + 1) * 127.5).round().to(torch.uint8).permute(0, 2, 3, 1).cpu()
+        images = []
+        for array in pixels.numpy():
+            image = Image.fromarray(array)
+            scale = PREVIEW_SIZE / max(image.size)
+            if scale != 1:
+                image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+            images.append(image)
+        return images
+
+    def _preview_vae(self):
+        """TAESD decoder per PREVIEW_DECODER, loaded on first use; None for the linear approximation"""
+        if self.preview_vae is None:
+            self.preview_vae = False
+            if PREVIEW_DECODER != 'approx':
+                from diffusers import AutoencoderTiny
+                try:
+                    self.preview_vae = AutoencoderTiny.from_pretrained(
+                        PREVIEW_TAESD_ID, torch_dtype=self.dtype,
+                        local_files_only=PREVIEW_DECODER == 'auto').to(self.device)
+                    print(f"[engine] Previews decoded with {PREVIEW_TAESD_ID}")
+                except (OSError, ValueError) as e:
+                    print(f"[engine] TAESD not available, using approximate previews: {e}")
+        return self.preview_vae or None
+
+    def _publish_previews(self, requests, latents, traces):
+        with metrics.span('preview_decode', traces, batch_size=len(requests)):
+            images = self._preview_images(latents)
+        self.previews += 1
+        for request, image in zip(requests, images):
+            if request.on_preview is not None:
+                request.on_preview(image)
+
+    def _step_callback(self, requests, tap=None):
+        """Report per-step progress, make previews and stop early once nobody wants the batch
+        or more urgent work preempts it"""
+        traces = [r.trace for r in requests]
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            # Steps actually run, which img2img trims by its strength
+            total = pipe.num_timesteps
+            if tap is not None and step + 1 == preview_step(total) and step + 1 < total:
+                clean = tap.clean if tap.clean is not None else callback_kwargs['latents']
+                self._publish_previews(requests, clean, traces)
+            for r in requests:
+                if r.on_step is not None:
+                    r.on_step(step + 1, total)
+            if all(r.cancelled for r in requests):
+                raise GenerationCancelled()
+            if any(r.preempted for r in requests):
+                raise GenerationPreempted()
+            return callback_kwargs
+        return on_step_end
+
+    def status(self):
+        """Summary used by the /health endpoint"""
+        return {
+            'loaded': self.pipe is not None,
+            'device': self.device,
+            'num_threads': self.num_threads,
+            'dtype': str(self.dtype).replace('torch.', ''),
+            'profile': self.profile,
+            'compiled': self.compiled,
+            'model': MODEL_ID,
+            'startup': self.startup,
+            'styles': self.loras.status() if self.loras else None,
+            'ip_adapter_loaded': self.ip_adapter_loaded,
+            'image_encoder_loaded': getattr(self.pipe, 'image_encoder', None) is not None,
+            'memory': {'budget_mb': self.memory_budget_mb, 'mode': self.memory_mode,
+                       'mode_changes': self.memory_mode_changes, 'over_budget_batches': self.over_budget_batches,
+                       'last_peak_mb': self.last_peak_mb,
+                       'max_peak_mb': self.max_peak_mb},
+            'reference_embeddings': self.reference_embeds.stats(),
+            'prompt_embeddings': self.prompt_embeds.stats(),
+            'previews': self.previews,
+            'story_latents': {'stories': len(self.story_latents), 'hits': self.story_latent_hits,
+                              'misses': self.story_latent_misses},
+        }
+
+
+class _CleanLatentsTap:
+    """Records the scheduler's predicted clean latents (x0) of each step, which the
+    pipeline otherwise discards; a much better preview than the noisy latents"""
+
+    def __init__(self, scheduler, enabled=True):
+        self.scheduler = scheduler
+        self.enabled = enabled
+        self.clean = None
+
+    def __enter__(self):
+        if self.enabled:
+            step = self.scheduler.step
+
+            def recording_step(*args, **kwargs):
+                result = step(*args, **kwargs)
+                if isinstance(result, tuple):
+                    self.clean = result[1] if len(result) > 1 else None
+                else:
+                    self.clean = getattr(result, 'pred_original_sample', None)
+                return result
+
+            # Instance attribute shadowing the class method until __exit__
+            self.scheduler.step = recording_step
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            del self.scheduler.step
+        return False
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Genre -> LoRA style registry for the FAIryTale image server.
+
+app.py loads and fuses one LoRA per run. Here every style a genre maps to is
+loaded once into the warm pipeline as a named adapter and switched per batch
+with set_adapters, so changing style costs a few milliseconds instead of a
+cold start. Loaded adapters are kept under a memory budget and the least
+recently used one is deleted when a new style does not fit.
+
+The genre map comes from STYLE_LORAS ("fantasy=anime_style.safetensors,
+mystery=noir.safetensors") and/or loras/styles.json ({"fantasy": "..."}).
+Genres that are not listed use the "default" entry, which is STYLE_LORA
+unless overridden. A value of "none" renders with the bare base model.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+STYLE_LORA = os.getenv('STYLE_LORA', 'anime_style.safetensors')
+STYLE_LORAS = os.getenv('STYLE_LORAS', '')
+STYLE_MAP_FILE = os.path.join('loras', 'styles.json')
+# Approximate memory (adapter file sizes) allowed for loaded LoRAs
+LORA_MEMORY_MB = int(os.getenv('LORA_MEMORY_MB', '1024'))
+# With a single configured style, fuse it into the weights like app.py (no per-step LoRA cost)
+LORA_FUSE_SINGLE = os.getenv('LORA_FUSE_SINGLE', '1') == '1'
+
+
+def load_style_map(work_dir):
+    """genre -> LoRA filename (or None), from STYLE_LORAS and loras/styles.json"""
+    styles = {'default': STYLE_LORA}
+    map_path = os.path.join(work_dir, STYLE_MAP_FILE)
+    if os.path.exists(map_path):
+        try:
+            with open(map_path) as f:
+                styles.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"[styles] Ignoring unreadable {map_path}: {e}")
+    for entry in STYLE_LORAS.split(','):
+        genre, _, lora = entry.partition('=')
+        if genre.strip() and lora.strip():
+            styles[genre.strip()] = lora.strip()
+    return {genre.lower(): (None if not lora or lora.lower() == 'none' else lora)
+            for genre, lora in styles.items()}
+
+
+_style_maps = {}
+
+
+def style_for_genre(genre, work_dir):
+    """LoRA filename to use for a story genre"""
+    if work_dir not in _style_maps:
+        _style_maps[work_dir] = load_style_map(work_dir)
+    styles = _style_maps[work_dir]
+    return styles.get((genre or '').strip().lower(), styles.get('default'))
+
+
+def adapter_name(style_lora):
+    """Adapter names must be identifiers: 'anime_style.safetensors' -> 'anime_style'"""
+    return re.sub(r'\W', '_', os.path.splitext(style_lora)[0])
+
+
+class LoraRegistry:
+    """Named LoRA adapters loaded into one pipeline, switched per batch under a memory budget"""
+
+    def __init__(self, pipe, lora_dir, max_bytes=LORA_MEMORY_MB * 1024 * 1024, fuse_style=None,
+                 baked_style=None):
+        self.pipe = pipe
+        self.lora_dir = lora_dir
+        self.max_bytes = max_bytes
+        # style -> approximate bytes, least recently used first
+        self.loaded = OrderedDict()
+        self.active = None
+        self.fused = None
+        # Style merged into weights loaded from a pipeline snapshot; it can't be switched off
+        self.baked = baked_style
+        if baked_style:
+            self.active = baked_style
+        self.switches = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if fuse_style:
+            self._load(fuse_style)
+            self.pipe.fuse_lora(adapter_names=[adapter_name(fuse_style)])
+            self.fused = self.active = fuse_style
+
+    def activate(self, style_lora):
+        """Make style_lora (or no LoRA for None) the style of the next denoising call"""
+        with self.lock:
+            if style_lora == self.active:
+                if style_lora in self.loaded:
+                    self.loaded.move_to_end(style_lora)
+                return
+            if self.baked is not None:
+                raise ValueError(f"{self.baked} is baked into the pipeline snapshot; "
+                                 f"set PIPELINE_SNAPSHOT=0 to use other styles")
+            if self.fused is not None:
+                # Another style was asked for after all: fall back to switchable adapters
+                self.pipe.unfuse_lora()
+                self.fused = None
+            start = time.time()
+            if style_lora is None:
+                self.pipe.disable_lora()
+            else:
+                if style_lora not in self.loaded:
+                    self._load(style_lora)
+                self.loaded.move_to_end(style_lora)
+                self.pipe.enable_lora()
+                self.pipe.set_adapters([adapter_name(style_lora)])
+            self.active = style_lora
+            self.switches += 1
+            print(f"[styles] Switched to {style_lora or 'base model'} in {time.time() - start:.2f}s")
+
+    def bake(self):
+        """Drop the fused style's adapter layers and keep only the merged weights, so the
+        pipeline can be saved as a plain snapshot"""
+        with self.lock:
+            self.pipe.unload_lora_weights()
+            self.loaded.clear()
+            self.baked, self.fused = self.fused, None
+
+    def _load(self, style_lora):
+        path = os.path.join(self.lora_dir, style_lora)
+        size = os.path.getsize(path)
+        while self.loaded and sum(self.loaded.values()) + size > self.max_bytes:
+            self._evict(next(iter(self.loaded)))
+        start = time.time()
+        self.pipe.load_lora_weights(path, adapter_name=adapter_name(style_lora))
+        self.loaded[style_lora] = size
+        self.loads += 1
+        print(f"[styles] Loaded {style_lora} in {time.time() - start:.1f}s")
+
+    def _evict(self, style_lora):
+        self.pipe.delete_adapters([adapter_name(style_lora)])
+        del self.loaded[style_lora]
+        if self.active == style_lora:
+            self.active = None
+            self.pipe.disable_lora()
+        self.evictions += 1
+        print(f"[styles] Evicted {style_lora} to stay under the LoRA memory budget")
+
+    def status(self):
+        with self.lock:
+            return {
+                'active': self.active,
+                'fused': self.fused,
+                'baked': self.baked,
+                'loaded': list(self.loaded),
+                'bytes': sum(self.loaded.values()),
+                'max_bytes': self.max_bytes,
+                'loads': self.loads,
+                'switches': self.switches,
+                'evictions': self.evictions,
+            }
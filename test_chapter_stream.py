@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Unit tests for chapter_stream.py: the streaming JSON field scanner fed split
+and escaped chunks, and the helpers /chapter uses once the text is complete.
+
+  python -m pytest test_chapter_stream.py   (or python test_chapter_stream.py)
+"""
+
+import json
+import unittest
+
+from chapter_stream import JsonFieldScanner, first_sentence, parse_chapter
+
+CHAPTER = {
+    'sceneDescription': 'Pip the fox, lantern in paw, enters the "Whispering" cave',
+    'content': 'Pip stepped inside.\nThe walls glowed éclair-gold.',
+    'choices': {'optionA': {'text': 'Go deeper'}, 'optionB': {'text': 'Turn back'}},
+}
+
+
+def scan(chunks, fields=('sceneDescription', 'content')):
+    """Everything the scanner reports, with the index of the chunk that completed it"""
+    scanner = JsonFieldScanner(fields)
+    found = []
+    for i, chunk in enumerate(chunks):
+        found += [(i, field, value) for field, value in scanner.feed(chunk)]
+    return found
+
+
+class JsonFieldScannerTest(unittest.TestCase):
+
+    def test_whole_object_in_one_chunk(self):
+        found = scan([json.dumps(CHAPTER)])
+        self.assertEqual([(field, value) for _, field, value in found],
+                         [('sceneDescription', CHAPTER['sceneDescription']), ('content', CHAPTER['content'])])
+
+    def test_one_character_at_a_time(self):
+        text = json.dumps(CHAPTER)
+        found = scan(list(text))
+        self.assertEqual({field: value for _, field, value in found},
+                         {'sceneDescription': CHAPTER['sceneDescription'], 'content': CHAPTER['content']})
+        # Reported the moment the closing quote arrives, not at the end of the object
+        scene_end = text.index('"', text.index('cave'))
+        self.assertEqual(found[0][0], scene_end)
+
+    def test_escapes_split_across_chunks(self):
+        text = json.dumps({'sceneDescription': 'a "quoted" \\ back\\slash', 'content': 'café'},
+                          ensure_ascii=True)
+        for cut in range(1, len(text)):
+            with self.subTest(cut=cut):
+                found = scan([text[:cut], text[cut:]])
+                self.assertEqual({field: value for _, field, value in found},
+                                 {'sceneDescription': 'a "quoted" \\ back\\slash', 'content': 'café'})
+
+    def test_unicode_escape_split_in_the_middle(self):
+        found = scan(['{"content": "caf\\u00', 'e9 noir"}'])
+        self.assertEqual(found, [(1, 'content', 'café noir')])
+
+    def test_prose_before_the_object_is_skipped(self):
+        found = scan(['Sure! Here is "the" chapter:\n', '{"content": "Once"}'])
+        self.assertEqual(found, [(1, 'content', 'Once')])
+
+    def test_nested_fields_with_the_same_name_are_ignored(self):
+        text = '{"choices": {"content": "nested", "list": ["content", "x"]}, "content": "top"}'
+        self.assertEqual(scan([text]), [(0, 'content', 'top')])
+
+    def test_string_values_are_not_mistaken_for_keys(self):
+        text = '{"title": "content", "sceneDescription": "a hill"}'
+        self.assertEqual(scan([text]), [(0, 'sceneDescription', 'a hill')])
+
+    def test_non_string_values_are_skipped(self):
+        text = '{"content": 3, "sceneDescription": null, "mood": "calm", "content": "later"}'
+        self.assertEqual(scan([text]), [(0, 'content', 'later')])
+
+    def test_each_field_reported_once(self):
+        text = '{"content": "first", "content": "second"}'
+        self.assertEqual(scan([text]), [(0, 'content', 'first')])
+
+    def test_stops_after_the_object_closes(self):
+        scanner = JsonFieldScanner(['content'])
+        self.assertEqual(scanner.feed('{"a": "b"}'), [])
+        self.assertTrue(scanner.closed)
+        self.assertEqual(scanner.feed(' {"content": "late"}'), [])
+
+    def test_unterminated_string_reports_nothing(self):
+        self.assertEqual(scan(['{"sceneDescription": "the model stopped mid'], ('sceneDescription',)), [])
+
+
+class ParseChapterTest(unittest.TestCase):
+
+    def test_object_inside_prose(self):
+        text = 'Here you go:\n```json\n' + json.dumps(CHAPTER) + '\n```\nEnjoy!'
+        self.assertEqual(parse_chapter(text), CHAPTER)
+
+    def test_invalid_json(self):
+        self.assertIsNone(parse_chapter('{"content": "unterminated}'))
+
+    def test_no_object(self):
+        self.assertIsNone(parse_chapter('Once upon a time'))
+
+
+class FirstSentenceTest(unittest.TestCase):
+
+    def test_first_sentence_lowercased_without_punctuation(self):
+        self.assertEqual(first_sentence('Pip, the fox, ran! Then he slept.'), 'pip  the fox  ran')
+
+    def test_limit(self):
+        self.assertEqual(first_sentence('a' * 150), 'a' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Unit tests for result_cache.py: cache keys, hit/miss accounting, LRU eviction
+within the byte budget and the on-disk index.
+
+  python -m pytest test_result_cache.py   (or python test_result_cache.py)
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from result_cache import ResultCache, file_sha256
+
+PARTS = dict(prompt='Pip, walks into the cave', character='Pip', seed=42, steps=25, scale=7.5,
+             style_lora=None, model='fake', reference=None)
+
+
+class CacheKeyTest(unittest.TestCase):
+
+    def test_independent_of_argument_order(self):
+        reordered = dict(reversed(list(PARTS.items())))
+        self.assertEqual(ResultCache.key_for(**PARTS), ResultCache.key_for(**reordered))
+
+    def test_every_part_changes_the_key(self):
+        key = ResultCache.key_for(**PARTS)
+        for name, value in [('prompt', 'Pip, walks out'), ('character', 'Tom'), ('seed', 43), ('steps', 15),
+                            ('scale', 8.0), ('style_lora', 'fantasy.safetensors'), ('model', 'other'),
+                            ('reference', 'abc')]:
+            with self.subTest(part=name):
+                self.assertNotEqual(ResultCache.key_for(**dict(PARTS, **{name: value})), key)
+
+    def test_extra_parts_change_the_key(self):
+        # Continuations add their init image and strength
+        self.assertNotEqual(ResultCache.key_for(**PARTS),
+                            ResultCache.key_for(init='result_x.png', strength=0.5, **PARTS))
+
+    def test_file_sha256(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ref.png')
+        with open(path, 'wb') as f:
+            f.write(b'abc')
+        self.assertEqual(file_sha256(path), 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad')
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.image_dir = os.path.join(self.directory, 'images')
+        self.index_path = os.path.join(self.directory, 'index.json')
+
+    def make_cache(self, max_bytes=1000, delete_files=True):
+        return ResultCache(self.image_dir, self.index_path, max_bytes=max_bytes, delete_files=delete_files)
+
+    @staticmethod
+    def add(cache, key, size=100):
+        with open(cache.path_for(key), 'wb') as f:
+            f.write(b'x' * size)
+        cache.record(key)
+
+    def test_miss_then_hit(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.lookup('a'))
+        self.add(cache, 'a')
+        self.assertEqual(cache.lookup('a'), 'result_a.png')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['bytes']), (1, 1, 100))
+
+    def test_evicts_least_recently_used(self):
+        cache = self.make_cache(max_bytes=250)
+        self.add(cache, 'a')
+        self.add(cache, 'b')
+        cache.lookup('a')
+        self.add(cache, 'c')
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertFalse(os.path.exists(cache.path_for('b')))
+
+    def test_eviction_keeps_files_it_does_not_own(self):
+        cache = self.make_cache(max_bytes=150, delete_files=False)
+        self.add(cache, 'a')
+        self.add(cache, 'b')
+        self.assertEqual(list(cache.entries), ['b'])
+        self.assertIsNone(cache.lookup('a'))
+        self.assertTrue(os.path.exists(cache.path_for('a')))
+
+    def test_newest_entry_stays_even_over_budget(self):
+        cache = self.make_cache(max_bytes=50)
+        self.add(cache, 'big')
+        self.assertEqual(cache.lookup('big'), 'result_big.png')
+
+    def test_recording_again_replaces_the_entry(self):
+        cache = self.make_cache()
+        self.add(cache, 'a', size=100)
+        self.add(cache, 'a', size=300)
+        self.assertEqual(cache.stats()['bytes'], 300)
+
+    def test_file_removed_behind_its_back(self):
+        cache = self.make_cache()
+        self.add(cache, 'a')
+        os.remove(cache.path_for('a'))
+        self.assertIsNone(cache.lookup('a'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_forget(self):
+        cache = self.make_cache()
+        self.add(cache, 'a')
+        cache.forget('result_a.png')
+        cache.forget('job_123.png')
+        self.assertIsNone(cache.lookup('a'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_index_survives_a_restart(self):
+        cache = self.make_cache()
+        self.add(cache, 'a')
+        self.add(cache, 'b')
+        os.remove(cache.path_for('b'))
+        reloaded = self.make_cache()
+        self.assertEqual(list(reloaded.entries), ['a'])
+        self.assertEqual(reloaded.lookup('a'), 'result_a.png')
+
+    def test_unreadable_index_is_ignored(self):
+        os.makedirs(self.image_dir)
+        with open(self.index_path, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(self.make_cache().stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
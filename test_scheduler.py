@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the priority scheduler in batching.py: queue order, preemption,
+the min_steps floor of adaptive steps, and escalation of shared jobs.
+
+Runs on the fake backend, no GPU or model weights needed:
+  python -m pytest test_scheduler.py   (or python test_scheduler.py)
+"""
+
+import threading
+import time
+import unittest
+
+from batching import MicroBatcher, _Pending
+from fake_engine import FakeEngine
+from generation import GenerationCancelled, GenerationRequest
+from jobs import JobManager
+
+
+class RecordingEngine(FakeEngine):
+    """FakeEngine that records the prompts of every batch it starts, and can hold the first one
+    until released"""
+
+    def __init__(self, step_latency_ms=5):
+        super().__init__('.', step_latency_ms=step_latency_ms)
+        self.started = []
+        self.gate = None
+
+    def generate_batch(self, requests):
+        self.started.append([r.prompt for r in requests])
+        if self.gate is not None:
+            gate, self.gate = self.gate, None
+            gate.wait(5)
+        return super().generate_batch(requests)
+
+
+def request(prompt, priority='interactive', steps=10, latency_target=0, **kwargs):
+    return GenerationRequest(prompt, steps=steps, priority=priority, latency_target=latency_target,
+                             style_lora=None, **kwargs)
+
+
+class QueueOrderTest(unittest.TestCase):
+
+    def test_priority_class_then_deadline(self):
+        engine = RecordingEngine()
+        engine.gate = hold = threading.Event()
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0, style_affinity_ms=0,
+                               preempt_before=0).start()
+        futures = [batcher.submit(request('blocker', 'batch'))]
+        time.sleep(0.05)
+        futures += [
+            batcher.submit(request('batch', 'batch')),
+            batcher.submit(request('prefetch', 'prefetch')),
+            batcher.submit(request('interactive-late', latency_target=60)),
+            batcher.submit(request('interactive-early', latency_target=5)),
+        ]
+        hold.set()
+        for future in futures:
+            future.result(10)
+        self.assertEqual([batch[0] for batch in engine.started],
+                         ['blocker', 'interactive-early', 'interactive-late', 'prefetch', 'batch'])
+
+
+class PreemptionTest(unittest.TestCase):
+
+    def test_urgent_request_preempts_and_batch_runs_again(self):
+        engine = RecordingEngine(step_latency_ms=20)
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0, preempt_before=0.9).start()
+        requeued = []
+        background = request('background', 'batch', steps=50)
+        background.on_requeue = lambda: requeued.append(True)
+        background_future = batcher.submit(background)
+        time.sleep(0.1)
+        urgent_future = batcher.submit(request('urgent', steps=5))
+
+        urgent_future.result(10)
+        self.assertFalse(background_future.done())
+        background_future.result(10)
+        self.assertEqual([batch[0] for batch in engine.started], ['background', 'urgent', 'background'])
+        self.assertEqual(requeued, [True])
+        self.assertEqual(batcher.preemptions, 1)
+
+    def test_no_preemption_past_preempt_before(self):
+        engine = RecordingEngine(step_latency_ms=20)
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0, preempt_before=0.1).start()
+        background_future = batcher.submit(request('background', 'batch', steps=20))
+        time.sleep(0.2)
+        urgent_future = batcher.submit(request('urgent', steps=5))
+        background_future.result(10)
+        urgent_future.result(10)
+        self.assertEqual([batch[0] for batch in engine.started], ['background', 'urgent'])
+        self.assertEqual(batcher.preemptions, 0)
+
+    def test_equal_priority_does_not_preempt(self):
+        engine = RecordingEngine(step_latency_ms=20)
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0, preempt_before=0.9).start()
+        first = batcher.submit(request('first', steps=20))
+        time.sleep(0.1)
+        second = batcher.submit(request('second', steps=5))
+        first.result(10)
+        second.result(10)
+        self.assertEqual(batcher.preemptions, 0)
+
+
+class CancellationTest(unittest.TestCase):
+
+    def test_cancelled_batch_is_not_a_failure(self):
+        engine = RecordingEngine(step_latency_ms=20)
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0).start()
+        r = request('a', steps=50)
+        future = batcher.submit(r)
+        time.sleep(0.1)
+        r.cancel()
+        with self.assertRaises(GenerationCancelled):
+            future.result(10)
+        self.assertIsNotNone(batcher.submit(request('b', steps=2)).result(10))
+
+
+class AdaptiveStepsTest(unittest.TestCase):
+
+    def setUp(self):
+        # Never started: _plan_steps is called directly
+        self.batcher = MicroBatcher(RecordingEngine(), max_batch_size=2)
+
+    def test_requested_steps_without_measurements(self):
+        group = [_Pending(request('a', steps=25, latency_target=1))]
+        self.assertEqual(self.batcher._plan_steps(group), 25)
+
+    def test_cut_to_the_deadline(self):
+        self.batcher.step_seconds = {1: 0.1}
+        self.batcher.overhead_seconds = 0.0
+        group = [_Pending(request('a', steps=25, latency_target=2))]
+        self.assertEqual(self.batcher._plan_steps(group), 19)
+
+    def test_never_below_min_steps(self):
+        self.batcher.step_seconds = {1: 10.0}
+        group = [_Pending(request('a', steps=25, latency_target=1))]
+        self.assertEqual(self.batcher._plan_steps(group), 15)
+
+    def test_highest_floor_of_the_group_wins(self):
+        self.batcher.step_seconds = {2: 10.0}
+        group = [_Pending(request('a', steps=25, latency_target=1, min_steps=10)),
+                 _Pending(request('b', steps=25, latency_target=1, min_steps=20))]
+        self.assertEqual(self.batcher._plan_steps(group), 20)
+
+    def test_floor_above_requested_keeps_requested(self):
+        self.batcher.step_seconds = {1: 10.0}
+        group = [_Pending(request('a', steps=10, latency_target=1))]
+        self.assertEqual(self.batcher._plan_steps(group), 10)
+
+    def test_no_target_no_cut(self):
+        self.batcher.step_seconds = {1: 10.0}
+        group = [_Pending(request('a', 'batch', steps=25))]
+        self.assertEqual(self.batcher._plan_steps(group), 25)
+
+    def test_infinite_target_is_no_cut(self):
+        self.batcher.step_seconds = {1: 0.1}
+        group = [_Pending(request('a', steps=25, latency_target=float('inf')))]
+        self.assertEqual(self.batcher._plan_steps(group), 25)
+
+    def test_worker_survives_a_failing_plan(self):
+        engine = RecordingEngine()
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0).start()
+
+        def broken(group):
+            raise OverflowError('boom')
+
+        batcher._plan_steps = broken
+        self.assertIsNotNone(batcher.submit(request('a')).result(10))
+        del batcher._plan_steps
+        self.assertIsNotNone(batcher.submit(request('b')).result(10))
+
+    def test_degraded_request_publishes_under_its_own_name(self):
+        r = request('a', steps=25)
+        r.output_key = 'result_key.png'
+        r.degraded_output_key = 'job_1.png'
+        self.assertEqual(r.publish_key, 'result_key.png')
+        r.steps = 15
+        self.assertTrue(r.degraded)
+        self.assertEqual(r.publish_key, 'job_1.png')
+
+
+class EscalationTest(unittest.TestCase):
+
+    def test_shared_job_takes_the_most_urgent_priority(self):
+        engine = RecordingEngine()
+        engine.gate = hold = threading.Event()
+        batcher = MicroBatcher(engine, max_batch_size=1, max_wait_ms=0, style_affinity_ms=0,
+                               preempt_before=0).start()
+        manager = JobManager(batcher, publish=lambda job, image: ('url', 'path'))
+        jobs = [manager.submit(request('blocker', 'batch'))]
+        time.sleep(0.05)
+        jobs.append(manager.submit(request('prefetch', 'prefetch')))
+        shared = manager.submit(request('batch', 'batch'), dedup_key='same')
+        joined = manager.submit(request('batch', 'interactive'), dedup_key='same')
+        self.assertIs(joined, shared)
+        self.assertEqual(shared.request.priority, 'interactive')
+        hold.set()
+        for job in jobs + [shared]:
+            manager.wait_until_done(job, 10)
+        self.assertEqual([batch[0] for batch in engine.started], ['blocker', 'batch', 'prefetch'])
+
+    def test_escalate_moves_the_deadline_up_only(self):
+        batcher = MicroBatcher(RecordingEngine(), max_batch_size=1)
+        r = request('a', 'prefetch', latency_target=300)
+        batcher.submit(r)
+        item = batcher.pending[0]
+        deadline = item.deadline
+        self.assertTrue(batcher.escalate(r, 'batch', 600))
+        self.assertEqual((r.priority, item.deadline), ('prefetch', deadline))
+        self.assertTrue(batcher.escalate(r, 'interactive', 10))
+        self.assertEqual(r.priority, 'interactive')
+        self.assertLess(item.deadline, deadline)
+
+    def test_escalate_unknown_request(self):
+        batcher = MicroBatcher(RecordingEngine(), max_batch_size=1)
+        self.assertFalse(batcher.escalate(request('a'), 'interactive', 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
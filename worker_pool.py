@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Pool of resident pipeline workers for the FAIryTale image server.
+
+Each worker is a StoryEngine with its own MicroBatcher, pinned to one device
+(a GPU index, or the CPU with a thread budget). New requests go to the least
+loaded worker, preferring one that already has a compatible request waiting
+so it can join that batch. When too many images are already queued the pool
+refuses new work with QueueFull, which the server turns into 429/Retry-After.
+
+WORKER_DEVICES lists one entry per worker, with an optional *N repeat:
+"cuda:0,cuda:1", "cuda:0*2" (two workers sharing a GPU) or "cpu*2". "auto" is
+the GPU when torch can see one and the CPU otherwise.
+"""
+
+import math
+import os
+import threading
+import time
+
+from batching import MicroBatcher, QueueFull
+
+# 'diffusers' for the real StoryEngine, 'fake' for the torch-free benchmark stub
+ENGINE_BACKEND = os.getenv('ENGINE_BACKEND', 'diffusers')
+DEVICE = os.getenv('SD_DEVICE', 'auto')
+WORKER_DEVICES = os.getenv('WORKER_DEVICES', DEVICE)
+# Queued images (all workers) above which new requests are refused
+MAX_QUEUE = int(os.getenv('MAX_QUEUE', '32'))
+# Torch threads per CPU worker; 0 splits the machine's cores evenly between them
+CPU_THREADS_PER_WORKER = int(os.getenv('CPU_THREADS_PER_WORKER', '0'))
+# Retry-After used before any batch has been timed
+DEFAULT_RETRY_AFTER = 10
+
+
+def engine_class(backend=None):
+    """Engine implementation for ENGINE_BACKEND, imported only when chosen"""
+    if (backend or ENGINE_BACKEND) == 'fake':
+        from fake_engine import FakeEngine
+        return FakeEngine
+    from story_engine import StoryEngine
+    return StoryEngine
+
+
+def detect_device():
+    """'cuda' when torch can use a GPU, else 'cpu' (always 'cpu' for the fake backend)"""
+    if ENGINE_BACKEND == 'fake':
+        return 'cpu'
+    try:
+        import torch
+    except ImportError:
+        return 'cpu'
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def parse_devices(spec):
+    """'cuda:0*2,cpu' -> ['cuda:0', 'cuda:0', 'cpu']; 'auto' entries become detect_device()"""
+    devices = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        device, _, count = entry.partition('*')
+        device = device.strip()
+        if device == 'auto':
+            device = detect_device()
+        devices.extend([device] * (int(count) if count else 1))
+    return devices or [detect_device() if DEVICE == 'auto' else DEVICE]
+
+
+class Worker:
+    """One engine + batcher pair pinned to a device"""
+
+    def __init__(self, index, engine, batcher):
+        self.index = index
+        self.engine = engine
+        self.batcher = batcher
+
+    @property
+    def device(self):
+        return self.engine.device
+
+    def status(self):
+        return {
+            'index': self.index,
+            'device': self.device,
+            'engine': self.engine.status(),
+            'batcher': self.batcher.status(),
+        }
+
+
+class WorkerPool:
+    """Dispatches GenerationRequests across workers; same submit/position API as MicroBatcher"""
+
+    def __init__(self, work_dir, devices=None, max_queue=MAX_QUEUE, engine_factory=None):
+        engine_factory = engine_factory or engine_class()
+        self.devices = devices or parse_devices(WORKER_DEVICES)
+        self.max_queue = max_queue
+        self.rejected = 0
+        # True once every worker is loaded and warmed up
+        self.ready = False
+        self.lock = threading.Lock()
+
+        cpu_workers = sum(1 for device in self.devices if device == 'cpu')
+        cpu_threads = CPU_THREADS_PER_WORKER
+        if cpu_workers and not cpu_threads:
+            cpu_threads = max(1, (os.cpu_count() or 1) // cpu_workers)
+
+        self.workers = []
+        for index, device in enumerate(self.devices):
+            threads = cpu_threads if device == 'cpu' else None
+            engine = engine_factory(work_dir, device=device, num_threads=threads)
+            batcher = MicroBatcher(engine, name=f"worker-{index}-{device}", on_start=engine.bind_thread)
+            self.workers.append(Worker(index, engine, batcher))
+
+    def start(self):
+        """Load and warm up every worker's pipeline, then start serving"""
+        start = time.time()
+        for worker in self.workers:
+            print(f"[pool] Loading worker {worker.index} on {worker.device}")
+            worker.engine.load()
+            worker.engine.warmup()
+        for worker in self.workers:
+            worker.batcher.start()
+        self.ready = True
+        print(f"[pool] {len(self.workers)} worker(s) ready in {time.time() - start:.1f}s: {', '.join(self.devices)}")
+        return self
+
+    @property
+    def model_id(self):
+        """Model the workers render with, part of the result cache key"""
+        return self.workers[0].engine.model_id
+
+    def queued(self):
+        return sum(worker.batcher.queued() for worker in self.workers)
+
+    def submit(self, request):
+        """Queue a request on the least loaded worker; raises QueueFull when over the bound"""
+        key = request.batch_key()
+        with self.lock:
+            if self.queued() >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            # Least loaded first; on a tie, a worker that can batch this request with a waiting
+            # one, then one holding the story's latents, then one whose LoRA style is active
+            worker = min(self.workers, key=lambda w: (w.batcher.load(), not w.batcher.has_pending_key(key),
+                                                      not w.engine.has_story(request.story_id),
+                                                      w.batcher.last_style != request.style_lora, w.index))
+            return worker.batcher.submit(request)
+
+    def escalate(self, request, priority, latency_target):
+        """Raise a request's priority and deadline on whichever worker holds it"""
+        return any(worker.batcher.escalate(request, priority, latency_target) for worker in self.workers)
+
+    def position(self, request):
+        """Place of a request in its worker's queue, or None once it is running"""
+        for worker in self.workers:
+            position = worker.batcher.position(request)
+            if position is not None:
+                return position
+        return None
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained below the bound"""
+        timings = [w.batcher.avg_batch_seconds() for w in self.workers]
+        timings = [t for t in timings if t is not None]
+        if not timings:
+            return DEFAULT_RETRY_AFTER
+        batch_seconds = sum(timings) / len(timings)
+        batch_size = self.workers[0].batcher.max_batch_size
+        batches_ahead = self.queued() / (len(self.workers) * batch_size)
+        return max(1, math.ceil(batch_seconds * max(1, batches_ahead)))
+
+    def has_reference(self, key):
+        """Whether every worker already holds a reference's embeddings"""
+        return all(worker.engine.has_reference(key) for worker in self.workers)
+
+    def encode_reference(self, path, key):
+        """Pre-compute a character reference's embeddings on every worker"""
+        for worker in self.workers:
+            worker.engine.encode_reference(path, key)
+
+    def status(self):
+        """Per-worker and pool-wide queue statistics for /health"""
+        return {
+            'ready': self.ready,
+            'workers': [worker.status() for worker in self.workers],
+            'queued': self.queued(),
+            'max_queue': self.max_queue,
+            'rejected': self.rejected,
+        }